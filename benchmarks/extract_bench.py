@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+"""Benchmarks the / and /extract request paths in-process.
+
+Requests are made against server.app through WSGI, with Earth Engine
+replaced by the fake backend (EE_BACKEND=fake, see fake_ee/__init__.py) so
+that what is measured is our own code plus whatever latency is injected.
+Each workload is run for a number of requests, and its throughput, latency
+percentiles, per-stage latency percentiles (from the Server-Timing header,
+see metrics.py) and memory are reported.
+
+A process's peak resident set size only ever grows, so every workload is
+run in a fresh process of its own (unless --in-process), and its peak is
+that workload's alone. Memory is also measured for each timed stage of each
+request: with tracemalloc (Python 3), as the most Python allocated during
+the stage above what it had when the stage began; without, as how much the
+resident set grew over the stage, which misses memory freed before it
+ended. Stages overlap when they run on worker threads, and then count each
+other's memory.
+
+Results can be saved as a baseline and later runs compared against it:
+
+    python benchmarks/extract_bench.py --save benchmarks/baseline.json
+    python benchmarks/extract_bench.py --compare benchmarks/baseline.json
+
+By default the extraction and decoding caches (and any local backends'
+masks, cells and blocks, see zonal.py, gridcache.py, tilestore.py and
+integral.py) are cleared before every request, so that every request does
+the full work; --warm leaves them be.
+"""
+from __future__ import print_function
+
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [_ROOT, os.path.join(_ROOT, 'lib')]
+os.environ.setdefault('EE_BACKEND', 'fake')
+
+import lzstring
+import metrics
+import server
+import webob
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+PERCENTILES = (50, 95, 99)
+
+# Where the generated features are drawn, in central Kansas.
+REGION = (-100.0, 37.5, -97.0, 39.5)
+
+
+def point(rng):
+    return {'type': 'Point', 'coordinates': [rng.uniform(REGION[0], REGION[2]),
+                                             rng.uniform(REGION[1], REGION[3])]}
+
+
+def rectangle(rng, size=0.02):
+    x, y = point(rng)['coordinates']
+    return {'type': 'Polygon', 'coordinates': [[
+        [x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]]}
+
+
+def complex_polygon(rng, vertices=400, radius=0.15):
+    """A wobbly, hand-drawn looking polygon with many vertices."""
+    x, y = point(rng)['coordinates']
+    ring = []
+    for i in range(vertices):
+        angle = 2 * math.pi * i / vertices
+        r = radius * (0.7 + 0.2 * math.sin(7 * angle) + 0.1 * rng.random())
+        ring.append([x + r * math.cos(angle), y + r * math.sin(angle)])
+    return {'type': 'Polygon', 'coordinates': [ring + ring[:1]]}
+
+
+def collection(geometries):
+    return {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'geometry': g, 'properties': {'fid': i}}
+        for i, g in enumerate(geometries)]}
+
+
+def extract_request(features, packed, asset_ids=None):
+    """Returns (method, url, body, headers) for an /extract request.
+
+    packed requests send lzstring and get lzstring back, as the original
+    client did; the others send and receive plain JSON. Collections too big
+    for a query string are POSTed.
+    """
+    asset_ids = asset_ids or [server.HISTORICAL_IMAGE_COLLECTION_ID]
+    text = json.dumps(features)
+    query = ['assetId=' + quote(a, safe='') for a in asset_ids]
+    if not packed:
+        query.append('format=json')
+    if packed:
+        text = lzstring.LZString.compressToEncodedURIComponent(text)
+    if len(text) > 8000:
+        return ('POST', '/extract?' + '&'.join(query), text.encode('utf-8'),
+                {'Content-Type': 'text/plain'})
+    if not packed:
+        query.append('encoding=json')
+    query.append('features=' + quote(text, safe=''))
+    return 'GET', '/extract?' + '&'.join(query), None, {}
+
+
+def workloads(seed):
+    rng = random.Random(seed)
+    both = [server.HISTORICAL_IMAGE_COLLECTION_ID,
+            server.MOST_RECENT_IMAGE_COLLECTION_ID]
+    features = {
+        'point': collection([point(rng)]),
+        'rectangle': collection([rectangle(rng)]),
+        'polygon': collection([complex_polygon(rng)]),
+        'batch1k': collection([point(rng) if i % 2 else rectangle(rng, 0.005)
+                               for i in range(1000)]),
+    }
+    requests = {'page': ('GET', '/', None, {})}
+    for name, fc in features.items():
+        requests[name + '-lz'] = extract_request(fc, True)
+        requests[name + '-json'] = extract_request(fc, False)
+    requests['polygon-2assets-json'] = extract_request(
+        features['polygon'], False, both)
+    return requests
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def summarize(values):
+    summary = dict(('p%d' % p, percentile(values, p)) for p in PERCENTILES)
+    summary['mean'] = sum(values) / len(values) if values else None
+    return summary
+
+
+def parse_server_timing(header):
+    stages = {}
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if params.startswith('dur='):
+            stages[name] = float(params[4:])
+    return stages
+
+
+def clear_caches():
+    server.EXTRACTION_CACHE.clear()
+    server.DECODED_CACHE.clear()
+    for backend in (server.ZONAL, server.PYRAMIDS, server.GRID_CACHE,
+                    server.SPARSE, server.TILE_STORES, server.INTEGRALS):
+        if backend is not None:
+            backend.clear()
+
+
+def peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def rss_kb():
+    """Returns the process's resident set size now, or None where there is
+    no /proc to say."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() // 1024
+
+
+class StageMemory(object):
+    """Kilobytes of memory taken by every timed stage of every request."""
+
+    def __init__(self):
+        self.kb = {}
+        self._open = 0
+        self._lock = threading.Lock()
+
+    def install(self):
+        """Wraps RequestTimer.stage() to measure every stage."""
+        if tracemalloc is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        timed = metrics.RequestTimer.stage
+        memory = self
+
+        @contextlib.contextmanager
+        def stage(timer, name):
+            with memory.measure(name):
+                with timed(timer, name):
+                    yield
+        metrics.RequestTimer.stage = stage
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        with self._lock:
+            outermost = not self._open
+            self._open += 1
+        if tracemalloc is None:
+            start = rss_kb()
+        else:
+            if outermost and hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0] / 1024.0
+        try:
+            yield
+        finally:
+            if tracemalloc is None:
+                end = rss_kb()
+            else:
+                end = tracemalloc.get_traced_memory()[1] / 1024.0
+            with self._lock:
+                self._open -= 1
+                if start is not None and end is not None:
+                    self.kb.setdefault(name, []).append(max(end - start, 0))
+
+
+STAGE_MEMORY = StageMemory()
+
+
+def run(name, request, n, warm):
+    method, url, body, headers = request
+    latencies = []
+    stages = {}
+    statuses = {}
+    STAGE_MEMORY.kb = {}
+    rss_before = peak_rss_kb()
+    started = time.time()
+    for _ in range(n):
+        if not warm:
+            clear_caches()
+        req = webob.Request.blank(url, method=method, headers=headers)
+        if body is not None:
+            req.body = body
+        t = time.time()
+        response = req.get_response(server.app)
+        response.body  # drain streamed responses
+        latencies.append((time.time() - t) * 1000)
+        statuses[response.status_int] = statuses.get(response.status_int, 0) + 1
+        for stage, ms in parse_server_timing(
+                response.headers.get('Server-Timing')).items():
+            stages.setdefault(stage, []).append(ms)
+    elapsed = time.time() - started
+    return {
+        'requests': n,
+        'statuses': dict((str(k), v) for k, v in statuses.items()),
+        'throughput': n / elapsed,
+        'latency_ms': summarize(latencies),
+        'stages_ms': dict((s, summarize(v)) for s, v in stages.items()),
+        'stages_kb': dict((s, summarize(v))
+                          for s, v in STAGE_MEMORY.kb.items()),
+        'peak_rss_kb': peak_rss_kb(),
+        'rss_growth_kb': peak_rss_kb() - rss_before,
+    }
+
+
+def run_child(name, args):
+    """Returns the results of a workload run in a process of its own."""
+    command = [sys.executable, os.path.abspath(__file__), '--child', name,
+               '--requests', str(args.requests), '--latency',
+               str(args.latency), '--jitter', str(args.jitter),
+               '--error-rate', str(args.error_rate), '--seed', str(args.seed)]
+    if args.warm:
+        command.append('--warm')
+    output = subprocess.check_output(command)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def report(results, baseline=None):
+    row = '{0:<22}{1:>9}{2:>10}{3:>10}{4:>10}{5:>12}  {6}'
+    print(row.format('workload', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms',
+                     'peak MB', 'slowest stages (p50 ms)'))
+    for name in sorted(results):
+        result = results[name]
+        latency = result['latency_ms']
+        stages = sorted(((s['p50'], n) for n, s in result['stages_ms'].items()
+                         if n != 'total'), reverse=True)[:3]
+        print(row.format(name, '%.1f' % result['throughput'],
+                         '%.1f' % latency['p50'], '%.1f' % latency['p95'],
+                         '%.1f' % latency['p99'],
+                         '%.1f' % (result['peak_rss_kb'] / 1024.0),
+                         ', '.join('%s %.1f' % (n, ms) for ms, n in stages)))
+        memory = sorted(((s['p50'], n) for n, s in
+                         result.get('stages_kb', {}).items()), reverse=True)
+        if memory:
+            print('{0:<22}{1}'.format(
+                '  stage memory', 'p50 KB: ' + ', '.join(
+                    '%s %.0f' % (n, kb) for kb, n in memory)))
+        before = (baseline or {}).get(name)
+        if before:
+            print(row.format('  vs baseline',
+                             _change(before['throughput'], result['throughput']),
+                             _change(before['latency_ms']['p50'], latency['p50']),
+                             _change(before['latency_ms']['p95'], latency['p95']),
+                             _change(before['latency_ms']['p99'], latency['p99']),
+                             _change(before['peak_rss_kb'], result['peak_rss_kb']),
+                             ''))
+
+
+def _change(before, after):
+    if not before:
+        return '-'
+    return '%+.0f%%' % ((after - before) * 100.0 / before)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=20,
+                        help='requests per workload')
+    parser.add_argument('--workload', action='append',
+                        help='run only these workloads (repeatable)')
+    parser.add_argument('--warm', action='store_true',
+                        help='leave the extraction and decoding caches be')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the fake Earth Engine takes per call')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=2018)
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='compare with results saved earlier')
+    parser.add_argument('--in-process', action='store_true',
+                        help='run every workload in this process, so that '
+                             'peak memory accumulates across them')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if os.environ['EE_BACKEND'] == 'fake':
+        import fake_ee
+        fake_ee.configure(latency=args.latency, jitter=args.jitter,
+                          error_rate=args.error_rate, seed=args.seed)
+    requests = workloads(args.seed)
+    names = args.workload or sorted(requests)
+    unknown = set(names) - set(requests)
+    if unknown:
+        parser.error('unknown workloads: %s (choose from %s)' % (
+            ', '.join(sorted(unknown)), ', '.join(sorted(requests))))
+
+    STAGE_MEMORY.install()
+    if args.child:
+        # one untimed request loads rasters and builds process-wide caches
+        run(args.child, requests[args.child], 1, args.warm)
+        result = run(args.child, requests[args.child], args.requests,
+                     args.warm)
+        print(json.dumps(result))
+        return
+
+    results = {}
+    for name in names:
+        if args.in_process:
+            run(name, requests[name], 1, args.warm)
+            results[name] = run(name, requests[name], args.requests,
+                                args.warm)
+        else:
+            results[name] = run_child(name, args)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'meta': {
+                    'python': platform.python_version(),
+                    'backend': os.environ['EE_BACKEND'],
+                    'argv': sys.argv[1:],
+                    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Benchmarks lib/lzstring against the codec it replaced.
+
+Both codecs compress and decompress the kinds of payloads /extract sees --
+lzstring-packed feature collections coming in, and lzstring-packed
+reduceRegions results going out -- and the outputs are checked to be
+identical before anything is timed. The old codec is read from git
+history, as lib/lzstring was first committed or as of --reference, so run
+from a git checkout of the repository:
+
+    python benchmarks/lzstring_bench.py [--repeat N] [--reference REV]
+"""
+from __future__ import print_function
+
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import timeit
+import types
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(_ROOT, 'lib')]
+
+import lzstring
+
+# The codec, relative to the repository root.
+CODEC_PATH = 'lib/lzstring/__init__.py'
+
+
+def reference_codec(revision=None):
+    """Returns the lzstring module as of a git revision; by default, the
+    one that first added it."""
+    if revision is None:
+        revision = _git('log', '--diff-filter=A', '--format=%H', '--',
+                        CODEC_PATH).decode('ascii').split()[-1]
+    source = _git('show', '%s:%s' % (revision, CODEC_PATH))
+    module = types.ModuleType('lzstring_reference')
+    # Python 2 empties a module's globals once nothing refers to it
+    sys.modules[module.__name__] = module
+    exec(compile(source, '%s:%s' % (revision, CODEC_PATH), 'exec'),
+         module.__dict__)
+    return module
+
+
+def _git(*args):
+    """Returns the output of a git command, as bytes."""
+    return subprocess.check_output(('git',) + args, cwd=_ROOT)
+
+
+def feature_collection(geometries, properties=None):
+    return {
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'geometry': g,
+            'properties': dict(properties or {}, fid=i),
+        } for i, g in enumerate(geometries)],
+    }
+
+
+def drawn_polygon(vertices, rng):
+    """A hand-drawn looking polygon somewhere in Kansas."""
+    x, y = -98.5 + rng.random(), 38.5 + rng.random()
+    ring = [[x + 0.01 * rng.random(), y + 0.01 * rng.random()]
+            for _ in range(vertices)]
+    return {'type': 'Polygon', 'coordinates': [ring + ring[:1]]}
+
+
+def payloads():
+    """Returns [(name, JSON text)] of representative /extract payloads."""
+    rng = random.Random(2018)
+    point = {'type': 'Point', 'coordinates': [-98.123456789, 38.987654321]}
+    points = [{'type': 'Point', 'coordinates': [-102 + 7 * rng.random(),
+                                                37 + 3 * rng.random()]}
+              for _ in range(1000)]
+    with io.open(os.path.join(_ROOT, 'static', 'kansas.json')) as f:
+        kansas = json.load(f)
+    kansas = [ft['geometry'] for ft in kansas.get('features', [kansas])]
+    return [
+        ('point request', json.dumps(feature_collection([point]))),
+        ('rectangle request', json.dumps(
+            feature_collection([drawn_polygon(4, rng)]))),
+        ('drawn polygon request', json.dumps(
+            feature_collection([drawn_polygon(200, rng)]))),
+        ('kansas boundary request', json.dumps(feature_collection(kansas))),
+        ('1k point request', json.dumps(feature_collection(points))),
+        ('1k point response', json.dumps(
+            feature_collection(points, {'mean': 0.4213})['features'])),
+    ]
+
+
+def best_of(fn, repeat):
+    number = 1
+    while timeit.timeit(fn, number=number) < 0.05:
+        number *= 2
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number
+
+
+def main(repeat, reference=None):
+    new, old = lzstring.LZString(), reference_codec(reference).LZString()
+    row = '{0:<26}{1:>10}{2:>12}{3:>12}{4:>9}'
+    print(row.format('payload', 'bytes', 'old (ms)', 'new (ms)', 'speedup'))
+    for name, text in payloads():
+        packed = old.compressToEncodedURIComponent(text)
+        assert new.compressToEncodedURIComponent(text) == packed, name
+        assert new.decompressFromEncodedURIComponent(packed) == text, name
+        for verb, args in (('pack', (text,)), ('unpack', (packed,))):
+            method = ('compressToEncodedURIComponent' if verb == 'pack'
+                      else 'decompressFromEncodedURIComponent')
+            timings = [best_of(lambda: getattr(codec, method)(*args), repeat)
+                       for codec in (old, new)]
+            print(row.format('%s (%s)' % (name, verb), len(args[0]),
+                             '%.2f' % (timings[0] * 1e3),
+                             '%.2f' % (timings[1] * 1e3),
+                             '%.1fx' % (timings[0] / timings[1])))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--reference',
+                        help='git revision of the old codec (default: the '
+                             'one that first added it)')
+    args = parser.parse_args()
+    main(args.repeat, args.reference)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""Caches used to keep Earth Engine round trips off the request path.
+
+LRUCache is a small, thread-safe, process-local cache with optional per-entry
+expiry. It is cheap enough to sit in front of memcache for values that every
+request needs. By default it holds `max_size` entries; given a `weigher` it
+instead holds entries whose weights sum to at most `max_size`.
+
+MapIdCache stores the (mapid, token) pairs handed out by getMapId. Entries
+are looked up in a process-local LRUCache first and in memcache second, so a
+warm instance never leaves the process and a cold instance only pays one
+memcache round trip. Entries carry the time they were minted: once an entry is
+older than `refresh_after` it is still served, but the first caller to find it
+so takes a memcache lease and re-mints it inline (stale-while-revalidate), so
+only that one request waits on EE. Threads can't outlive the request that
+started them on automatically scaled instances, so there is no background
+refresh. Entries older than `lifetime` are never served because the token will
+have stopped working, though the most recent pair is kept as a last known good
+fallback for callers that can't wait.
+"""
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+
+
+class LRUCache(object):
+    """A thread-safe, size-bounded LRU cache with optional per-entry expiry."""
+
+    def __init__(self, max_size, ttl=None, weigher=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._weigher = weigher
+        self._weight = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the value cached for key, or default if missing or expired."""
+        return self.get_many([key], default)[0]
+
+    def get_many(self, keys, default=None):
+        """Returns a list of what get() would return for each of keys."""
+        now = time.time()
+        values = []
+        with self._lock:
+            for key in keys:
+                try:
+                    value, expires, weight = self._entries.pop(key)
+                except KeyError:
+                    values.append(default)
+                    continue
+                if expires is not None and now >= expires:
+                    self._weight -= weight
+                    values.append(default)
+                    continue
+                # re-insert to mark the entry as most recently used
+                self._entries[key] = (value, expires, weight)
+                values.append(value)
+        return values
+
+    def set(self, key, value, ttl=None):
+        """Caches value under key, evicting the least recently used entries."""
+        self.set_many([(key, value)], ttl)
+
+    def set_many(self, items, ttl=None):
+        """Caches (key, value) pairs in order, as set() would one by one."""
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            for key, value in items:
+                weight = self._weigher(value) if self._weigher else 1
+                if weight > self.max_size:
+                    continue
+                self._pop(key)
+                self._entries[key] = (value, expires, weight)
+                self._weight += weight
+            while self._weight > self.max_size:
+                _, (_, _, evicted) = self._entries.popitem(last=False)
+                self._weight -= evicted
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._weight = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._weight -= entry[2]
+
+
+class MapIdCache(object):
+    """Two-tier (process-local LRU, then memcache) cache of EE map IDs."""
+
+    def __init__(self, mint, lifetime, refresh_after, shared=None,
+                 namespace='mapid', max_size=64):
+        # mint(asset_id, options) must return a dict with 'mapid' and 'token'
+        self._mint = mint
+        self._lifetime = lifetime
+        self._refresh_after = refresh_after
+        self._shared = shared
+        self._namespace = namespace
+        self._local = LRUCache(max_size)
+        self._last_good = LRUCache(max_size)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(asset_id, options):
+        """Returns a memcache-safe key for an asset and its visualization."""
+        blob = json.dumps([asset_id, options], sort_keys=True)
+        return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+    def get(self, asset_id, options):
+        """Returns {'mapid': ..., 'token': ...} for the asset, minting if needed."""
+        key = self.key(asset_id, options)
+        entry = self._lookup(key)
+        now = time.time()
+        if entry is None or now >= entry['expires']:
+            return self._refresh(key, asset_id, options)['map_id']
+        if now >= entry['refresh_at']:
+            return self._refresh_under_lease(key, asset_id, options,
+                                             entry['map_id'])
+        return entry['map_id']
+
+    def cached(self, asset_id, options):
+        """Returns the cached map ID if it is still servable, else None.
+
+        A stale entry is only returned while some other caller is re-minting
+        it; otherwise the caller is expected to get() it, and re-mint it.
+        """
+        key = self.key(asset_id, options)
+        entry = self._lookup(key)
+        now = time.time()
+        if entry is None or now >= entry['expires']:
+            return None
+        if now >= entry['refresh_at'] and not self._leased(key):
+            return None
+        return entry['map_id']
+
+    def last_known_good(self, asset_id, options):
+        """Returns the most recently minted map ID, however old, or None."""
+        key = self.key(asset_id, options) + ':good'
+        map_id = self._last_good.get(key)
+        if map_id is None and self._shared is not None:
+            map_id = self._shared.get(key, namespace=self._namespace)
+        return map_id
+
+    def _lookup(self, key):
+        entry = self._local.get(key)
+        if entry is None and self._shared is not None:
+            entry = self._shared.get(key, namespace=self._namespace)
+            if entry is not None:
+                self._local.set(key, entry,
+                                ttl=max(entry['expires'] - time.time(), 0))
+        return entry
+
+    def _refresh(self, key, asset_id, options):
+        map_id = self._mint(asset_id, options)
+        minted = time.time()
+        entry = {
+            'map_id': {'mapid': map_id['mapid'], 'token': map_id['token']},
+            'refresh_at': minted + self._refresh_after,
+            'expires': minted + self._lifetime,
+        }
+        self._local.set(key, entry, ttl=self._lifetime)
+        self._last_good.set(key + ':good', entry['map_id'])
+        if self._shared is not None:
+            self._shared.set(key, entry, time=self._lifetime,
+                             namespace=self._namespace)
+            self._shared.set(key + ':good', entry['map_id'],
+                             namespace=self._namespace)
+        return entry
+
+    def _refresh_under_lease(self, key, asset_id, options, stale):
+        """Re-mints a stale entry and returns the new map ID, unless another
+        caller already is, in which case the stale one is returned."""
+        if not self._lease(key):
+            return stale
+        try:
+            return self._refresh(key, asset_id, options)['map_id']
+        except Exception:
+            # keep serving the stale entry; the next request retries
+            logging.exception('Failed to refresh map ID for %s', asset_id)
+            return stale
+        finally:
+            self._release(key)
+
+    def _lease(self, key):
+        """Returns whether this caller gets to re-mint a given entry: only
+        one thread per process, and one instance at a time, does."""
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+        if self._shared is not None and not self._shared.add(
+                key + ':lease', 1, time=60, namespace=self._namespace):
+            self._refreshing.discard(key)
+            return False
+        return True
+
+    def _leased(self, key):
+        """Returns whether some caller is re-minting a given entry."""
+        with self._lock:
+            if key in self._refreshing:
+                return True
+        return self._shared is not None and self._shared.get(
+            key + ':lease', namespace=self._namespace) is not None
+
+    def _release(self, key):
+        self._refreshing.discard(key)
+        if self._shared is not None:
+            self._shared.delete(key + ':lease', namespace=self._namespace)
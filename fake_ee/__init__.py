@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""A local stand-in for the parts of the Earth Engine API we use.
+
+ee.Image (load, constant, select, rename, addBands/cat, gte, updateMask,
+reduceRegions, getMapId), ee.Reducer (mean, min, max, sum, stdDev, count,
+fixedHistogram, combine), ee.Feature, ee.FeatureCollection, getInfo() and
+the ee.data and ee.serializer functions graphs.py and server.py call are
+implemented over NumPy rasters (see rasters.py and fake_ee/evaluate.py).
+Objects encode into the same JSON graphs the real client sends, and those
+graphs are what gets evaluated, so everything between our handlers and the
+wire runs as it does in production.
+
+install() puts the fake in place of the ee module; server.py does this when
+EE_BACKEND=fake. It is configured from these environment variables, or by
+calling configure():
+
+  FAKE_EE_DATA        directory of local asset copies (see rasters.find)
+  FAKE_EE_SYNTHETIC   0 to fail on assets with no local copy, rather than
+                      making up a synthetic raster for them
+  FAKE_EE_LATENCY     seconds every API call takes
+  FAKE_EE_JITTER      extra seconds, uniformly distributed, per call
+  FAKE_EE_ERROR_RATE  fraction of calls that fail with EEException
+  FAKE_EE_SEED        seed for the latency and error draws
+"""
+import numbers
+import os
+import sys
+
+from fake_ee import data
+from fake_ee import serializer
+from fake_ee.ee_exception import EEException
+
+try:
+    _string_types = (str, unicode)
+except NameError:
+    _string_types = (str,)
+
+
+def configure(data_dir=None, synthetic=None, latency=None, jitter=None,
+              error_rate=None, seed=None):
+    """Changes how the fake behaves; arguments left as None are unchanged."""
+    settings = data.SETTINGS
+    if data_dir is not None:
+        settings.data_dir = data_dir
+    if synthetic is not None:
+        settings.synthetic = synthetic
+    if latency is not None:
+        settings.latency = float(latency)
+    if jitter is not None:
+        settings.jitter = float(jitter)
+    if error_rate is not None:
+        settings.error_rate = float(error_rate)
+    if seed is not None:
+        settings.seed(seed)
+
+
+def configure_from_environ(environ=None):
+    environ = os.environ if environ is None else environ
+    configure(data_dir=environ.get('FAKE_EE_DATA'),
+              synthetic=(environ['FAKE_EE_SYNTHETIC'] != '0'
+                         if 'FAKE_EE_SYNTHETIC' in environ else None),
+              latency=environ.get('FAKE_EE_LATENCY'),
+              jitter=environ.get('FAKE_EE_JITTER'),
+              error_rate=environ.get('FAKE_EE_ERROR_RATE'),
+              seed=environ.get('FAKE_EE_SEED'))
+
+
+def install():
+    """Makes `import ee` import the fake, configured from the environment."""
+    configure_from_environ()
+    module = sys.modules[__name__]
+    sys.modules['ee'] = module
+    sys.modules['ee.data'] = data
+    sys.modules['ee.serializer'] = serializer
+    return module
+
+
+def Initialize(credentials=None, opt_url=None):
+    """Does nothing; the fake needs no credentials."""
+
+
+def ServiceAccountCredentials(email, key_file=None, key_data=None):
+    return None
+
+
+class ComputedObject(object):
+    """An invocation of an API algorithm."""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+    def encode(self, encoder):
+        return {
+            'type': 'Invocation',
+            'functionName': self.func,
+            'arguments': dict((name, encoder(value))
+                              for name, value in self.args.items()
+                              if value is not None),
+        }
+
+    def serialize(self, opt_pretty=False):
+        return serializer.toJSON(self, opt_pretty)
+
+    def getInfo(self):
+        return data.getValue({'json': self.serialize()})
+
+
+class Image(ComputedObject):
+
+    def __init__(self, args=None):
+        if isinstance(args, ComputedObject):
+            super(Image, self).__init__(args.func, args.args)
+        elif isinstance(args, _string_types):
+            super(Image, self).__init__('Image.load', {'id': args})
+        elif isinstance(args, numbers.Number):
+            super(Image, self).__init__('Image.constant', {'value': args})
+        elif isinstance(args, (list, tuple)):
+            combined = Image.cat(*args)
+            super(Image, self).__init__(combined.func, combined.args)
+        else:
+            raise EEException('Unrecognized argument type to convert to an '
+                              'Image: %r' % (args,))
+
+    @staticmethod
+    def cat(*args):
+        if len(args) == 1 and isinstance(args[0], (list, tuple)):
+            args = args[0]
+        if not args:
+            raise EEException('Can\'t combine 0 images.')
+        result = Image(args[0])
+        for image in args[1:]:
+            result = result.addBands(image)
+        return result
+
+    def addBands(self, srcImg, names=None, overwrite=None):
+        return Image(ComputedObject('Image.addBands', {
+            'dstImg': self, 'srcImg': Image(srcImg), 'names': names,
+            'overwrite': overwrite}))
+
+    def select(self, opt_selectors=None, opt_names=None, *args):
+        if not isinstance(opt_selectors, (list, tuple)):
+            opt_selectors = [s for s in (opt_selectors, opt_names) + args
+                             if s is not None]
+            opt_names = None
+        return Image(ComputedObject('Image.select', {
+            'input': self, 'bandSelectors': list(opt_selectors),
+            'newNames': opt_names}))
+
+    def rename(self, names, *args):
+        if not isinstance(names, (list, tuple)):
+            names = [names] + list(args)
+        return Image(ComputedObject('Image.rename', {
+            'input': self, 'names': list(names)}))
+
+    def gte(self, image2):
+        return Image(ComputedObject('Image.gte', {
+            'image1': self, 'image2': Image(image2)}))
+
+    def updateMask(self, mask):
+        return Image(ComputedObject('Image.updateMask', {
+            'image': self, 'mask': Image(mask)}))
+
+    def reduceRegions(self, collection, reducer, scale=None, crs=None,
+                      crsTransform=None, tileScale=None):
+        return FeatureCollection(ComputedObject('Image.reduceRegions', {
+            'image': self, 'collection': collection, 'reducer': reducer,
+            'scale': scale, 'crs': crs, 'crsTransform': crsTransform,
+            'tileScale': tileScale}))
+
+    def getMapId(self, vis_params=None):
+        request = dict(vis_params or {})
+        request['image'] = self.serialize()
+        response = data.getMapId(request)
+        response['image'] = self
+        return response
+
+
+class Reducer(ComputedObject):
+
+    @staticmethod
+    def mean():
+        return Reducer('Reducer.mean', {})
+
+    @staticmethod
+    def min():
+        return Reducer('Reducer.min', {})
+
+    @staticmethod
+    def max():
+        return Reducer('Reducer.max', {})
+
+    @staticmethod
+    def sum():
+        return Reducer('Reducer.sum', {})
+
+    @staticmethod
+    def stdDev():
+        return Reducer('Reducer.stdDev', {})
+
+    @staticmethod
+    def count():
+        return Reducer('Reducer.count', {})
+
+    @staticmethod
+    def fixedHistogram(min, max, steps):
+        return Reducer('Reducer.fixedHistogram',
+                       {'min': min, 'max': max, 'steps': steps})
+
+    def combine(self, reducer2, outputPrefix=None, sharedInputs=None):
+        return Reducer('Reducer.combine', {
+            'reducer1': self, 'reducer2': reducer2,
+            'outputPrefix': outputPrefix, 'sharedInputs': sharedInputs})
+
+
+class Geometry(object):
+    """A GeoJSON geometry literal."""
+
+    def __init__(self, geo_json):
+        if not isinstance(geo_json, dict) or 'type' not in geo_json:
+            raise EEException('Invalid GeoJSON geometry.')
+        self._geo_json = geo_json
+
+    def encode(self, encoder=None):
+        return dict(self._geo_json)
+
+    def toGeoJSON(self):
+        return dict(self._geo_json)
+
+
+class Feature(ComputedObject):
+
+    def __init__(self, geom, opt_properties=None):
+        if isinstance(geom, ComputedObject):
+            super(Feature, self).__init__(geom.func, geom.args)
+        elif isinstance(geom, dict) and geom.get('type') == 'Feature':
+            properties = geom.get('properties', {})
+            if 'id' in geom:
+                properties = dict(properties or {})
+                properties['system:index'] = geom['id']
+            super(Feature, self).__init__('Feature', {
+                'geometry': (Geometry(geom['geometry'])
+                             if geom.get('geometry') is not None else None),
+                'metadata': properties})
+        else:
+            super(Feature, self).__init__('Feature', {
+                'geometry': Geometry(geom) if geom is not None else None,
+                'metadata': opt_properties or None})
+
+
+class FeatureCollection(ComputedObject):
+
+    def __init__(self, args):
+        if isinstance(args, ComputedObject):
+            super(FeatureCollection, self).__init__(args.func, args.args)
+        elif isinstance(args, (list, tuple)):
+            super(FeatureCollection, self).__init__('Collection', {
+                'features': [Feature(f) for f in args]})
+        else:
+            raise EEException('Unrecognized argument type to convert to a '
+                              'FeatureCollection: %r' % (args,))
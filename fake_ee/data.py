@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""The fake Earth Engine's API calls, with injected latency and errors."""
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import rasters
+from fake_ee import evaluate
+from fake_ee.ee_exception import EEException
+
+
+class Settings(object):
+    """How the fake behaves; see fake_ee.configure()."""
+
+    def __init__(self):
+        self.data_dir = None
+        self.synthetic = True
+        self.synthetic_pixel_size = 0.01
+        self.latency = 0.0
+        self.jitter = 0.0
+        self.error_rate = 0.0
+        self._random = random.Random()
+        self._lock = threading.Lock()
+
+    def seed(self, seed):
+        with self._lock:
+            self._random.seed(seed)
+
+    def draw(self):
+        """Returns (seconds to sleep, whether to fail) for one call."""
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            return delay, self._random.random() < self.error_rate
+
+
+SETTINGS = Settings()
+
+
+def _call():
+    delay, fail = SETTINGS.draw()
+    if delay > 0:
+        time.sleep(delay)
+    if fail:
+        raise EEException('Fake Earth Engine: injected error')
+
+
+def getValue(params):
+    """Evaluates params['json'], a serialized graph."""
+    _call()
+    return evaluate.evaluate(json.loads(params['json']), SETTINGS)
+
+
+def getMapId(params):
+    """Checks params['image'] evaluates, and returns a made-up map ID."""
+    _call()
+    evaluate.evaluate(json.loads(params['image']), SETTINGS)
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return {'mapid': 'fake-' + digest.hexdigest()[:20], 'token': 'fake'}
+
+
+def getInfo(id):
+    """Returns an asset's type, ID and version: when its local copy was
+    last modified, in microseconds, or 0 for synthetic assets."""
+    _call()
+    path = SETTINGS.data_dir and rasters.find(SETTINGS.data_dir, id)
+    if not path and not SETTINGS.synthetic:
+        raise EEException('Asset \'%s\' not found.' % id)
+    version = int(os.path.getmtime(path) * 1e6) if path else 0
+    return {'type': 'Image', 'id': id, 'version': version}
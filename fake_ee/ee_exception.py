@@ -0,0 +1,6 @@
+#!/usr/bin/env python
+"""The exception the fake Earth Engine raises, as ee.EEException."""
+
+
+class EEException(Exception):
+    """Raised for failed (or deliberately failed) Earth Engine calls."""
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+"""Evaluates Earth Engine JSON graphs over local NumPy rasters.
+
+Only the algorithms our server uses are implemented. Images are lists of
+bands, each sampled lazily at pixel centers, so a reduceRegions call only
+ever reads the pixels its regions cover. Each band is reduced on the grid of
+the raster it came from, whatever scale is asked for.
+"""
+import hashlib
+import threading
+
+import numpy as np
+
+import rasters
+import zonal
+from fake_ee.ee_exception import EEException
+
+# Region the synthetic stand-ins for missing assets cover (west, south, east,
+# north): the Playa Lakes Joint Venture states.
+SYNTHETIC_BOUNDS = (-109.1, 31.3, -94.4, 41.1)
+
+_RASTERS = {}
+_RASTERS_LOCK = threading.Lock()
+
+
+class Band(object):
+    """One band of an image: a name, the grid it lives on (a Raster, or None
+    for constants) and sample(x, y) -> (values, valid) at points."""
+
+    def __init__(self, name, grid, sample):
+        self.name = name
+        self.grid = grid
+        self.sample = sample
+
+    def renamed(self, name):
+        return Band(name, self.grid, self.sample)
+
+
+def evaluate(node, settings, scope=None):
+    """Evaluates an encoded value; returns plain Python values."""
+    if isinstance(node, list):
+        return [evaluate(n, settings, scope) for n in node]
+    if not isinstance(node, dict):
+        return node
+    kind = node.get('type')
+    if kind == 'Invocation':
+        function = ALGORITHMS.get(node.get('functionName'))
+        if function is None:
+            raise EEException('Fake Earth Engine doesn\'t implement %s' %
+                              node.get('functionName', node.get('function')))
+        arguments = dict((k, evaluate(v, settings, scope))
+                         for k, v in node.get('arguments', {}).items())
+        return function(settings, **arguments)
+    if kind == 'Dictionary':
+        return dict((k, evaluate(v, settings, scope))
+                    for k, v in node['value'].items())
+    if kind == 'CompoundValue':
+        scope = dict(scope or {})
+        for name, value in node['scope']:
+            scope[name] = evaluate(value, settings, scope)
+        return evaluate(node['value'], settings, scope)
+    if kind == 'ValueRef':
+        return scope[node['value']]
+    # anything else, e.g. a GeoJSON geometry, stands for itself
+    return node
+
+
+def load_raster(settings, asset_id):
+    with _RASTERS_LOCK:
+        raster = _RASTERS.get(asset_id)
+        if raster is None:
+            path = settings.data_dir and rasters.find(settings.data_dir, asset_id)
+            if path:
+                raster = rasters.load(path)
+            elif settings.synthetic:
+                raster = synthetic_raster(asset_id, settings.synthetic_pixel_size)
+            else:
+                raise EEException('Image asset \'%s\' not found.' % asset_id)
+            _RASTERS[asset_id] = raster
+        return raster
+
+
+def synthetic_raster(asset_id, pixel_size):
+    """Returns a smooth, wetness-like [0, 1] raster seeded by asset_id."""
+    west, south, east, north = SYNTHETIC_BOUNDS
+    cols = int(round((east - west) / pixel_size))
+    rows = int(round((north - south) / pixel_size))
+    seed = int(hashlib.sha1(asset_id.encode('utf-8')).hexdigest()[:8], 16)
+    rng = np.random.RandomState(seed)
+    y = np.linspace(0, 1, rows, dtype=np.float32)[:, None]
+    x = np.linspace(0, 1, cols, dtype=np.float32)[None, :]
+    fx, fy, px, py = rng.uniform(5, 40, 2).tolist() + rng.uniform(0, 6, 2).tolist()
+    data = 0.5 + 0.25 * np.sin(fx * x + px) * np.cos(fy * y + py)
+    data = data + rng.normal(0, 0.15, (rows, cols)).astype(np.float32)
+    data = np.clip(data, 0, 1).astype(np.float32)
+    # some of every asset is masked, as with cloud cover or the region's edge
+    data[rng.uniform(size=(rows, cols)) < 0.02] = np.nan
+    return rasters.Raster(data, (west, pixel_size, 0, north, 0, -pixel_size))
+
+
+def _raster_band(name, raster):
+    def sample(x, y):
+        rows, cols = raster.index(x, y)
+        inside = ((rows >= 0) & (rows < raster.shape[0]) &
+                  (cols >= 0) & (cols < raster.shape[1]))
+        values = np.full(len(rows), np.nan)
+        values[inside] = raster.data[rows[inside], cols[inside]]
+        return values, inside & raster.valid(values)
+    return Band(name, raster, sample)
+
+
+def _constant_band(value):
+    def sample(x, y):
+        n = len(x)
+        return np.full(n, float(value)), np.ones(n, dtype=bool)
+    return Band('constant', None, sample)
+
+
+def _pairs(image1, image2):
+    """Pairs up the bands of two images for a band-wise operation."""
+    if len(image2) == 1:
+        image2 = image2 * len(image1)
+    elif len(image1) == 1:
+        image1 = image1 * len(image2)
+    if len(image1) != len(image2):
+        raise EEException('Images must have the same number of bands, or 1.')
+    return zip(image1, image2)
+
+
+def image_load(settings, id, version=None):
+    return [_raster_band('b1', load_raster(settings, id))]
+
+
+def image_constant(settings, value):
+    return [_constant_band(value)]
+
+
+def image_select(settings, input, bandSelectors, newNames=None):
+    selected = []
+    for selector in bandSelectors:
+        if isinstance(selector, int):
+            selected.append(input[selector])
+        elif selector == '.*':
+            selected.extend(input)
+        else:
+            selected.extend(b for b in input if b.name == selector)
+    if newNames:
+        selected = [b.renamed(n) for b, n in zip(selected, newNames)]
+    return selected
+
+
+def image_rename(settings, input, names):
+    return [b.renamed(n) for b, n in zip(input, names)]
+
+
+def image_add_bands(settings, dstImg, srcImg, names=None, overwrite=False):
+    return list(dstImg) + list(srcImg)
+
+
+def image_gte(settings, image1, image2):
+    def band(a, b):
+        def sample(x, y):
+            va, ka = a.sample(x, y)
+            vb, kb = b.sample(x, y)
+            with np.errstate(invalid='ignore'):
+                return (va >= vb).astype(float), ka & kb
+        return Band(a.name, a.grid or b.grid, sample)
+    return [band(a, b) for a, b in _pairs(image1, image2)]
+
+
+def image_update_mask(settings, image, mask):
+    def band(a, m):
+        def sample(x, y):
+            values, valid = a.sample(x, y)
+            mask_values, mask_valid = m.sample(x, y)
+            return values, valid & mask_valid & (mask_values != 0)
+        return Band(a.name, a.grid, sample)
+    return [band(a, m) for a, m in _pairs(image, mask)]
+
+
+def _reducer(name, function):
+    return [(name, function)]
+
+
+def _mean(values):
+    return float(values.mean()) if values.size else None
+
+
+def _std_dev(values):
+    return float(values.std()) if values.size else None
+
+
+def _min(values):
+    return float(values.min()) if values.size else None
+
+
+def _max(values):
+    return float(values.max()) if values.size else None
+
+
+def reducer_fixed_histogram(settings, min, max, steps):
+    edges = np.linspace(min, max, int(steps) + 1)
+
+    def histogram(values):
+        counts = np.histogram(values[(values >= min) & (values < max)],
+                              bins=edges)[0]
+        return [[float(lo), int(n)] for lo, n in zip(edges[:-1], counts)]
+    return _reducer('histogram', histogram)
+
+
+def reducer_combine(settings, reducer1, reducer2, outputPrefix='',
+                    sharedInputs=False):
+    return list(reducer1) + [(outputPrefix + name, f) for name, f in reducer2]
+
+
+def image_reduce_regions(settings, image, collection, reducer, scale=None,
+                         crs=None, crsTransform=None, tileScale=None):
+    features = []
+    for i, ft in enumerate(collection['features']):
+        properties = dict(ft.get('properties') or {})
+        for band in image:
+            if band.grid is None:
+                values = np.zeros(0)
+            else:
+                rows, cols = zonal.rasterize(band.grid, ft['geometry']).pixels()
+                values, valid = band.sample(*band.grid.centers(rows, cols))
+                values = values[valid]
+            for output, function in reducer:
+                if len(image) == 1:
+                    name = output
+                elif len(reducer) == 1:
+                    name = band.name
+                else:
+                    name = band.name + '_' + output
+                properties[name] = function(values)
+        features.append({'type': 'Feature', 'id': str(i),
+                         'geometry': ft['geometry'], 'properties': properties})
+    return {'type': 'FeatureCollection', 'columns': {}, 'features': features}
+
+
+def feature(settings, geometry=None, metadata=None):
+    return {'type': 'Feature', 'geometry': geometry,
+            'properties': metadata or {}}
+
+
+def collection(settings, features):
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+ALGORITHMS = {
+    'Image.load': image_load,
+    'Image.constant': image_constant,
+    'Image.select': image_select,
+    'Image.rename': image_rename,
+    'Image.addBands': image_add_bands,
+    'Image.gte': image_gte,
+    'Image.updateMask': image_update_mask,
+    'Image.reduceRegions': image_reduce_regions,
+    'Reducer.mean': lambda settings: _reducer('mean', _mean),
+    'Reducer.min': lambda settings: _reducer('min', _min),
+    'Reducer.max': lambda settings: _reducer('max', _max),
+    'Reducer.sum': lambda settings: _reducer(
+        'sum', lambda values: float(values.sum())),
+    'Reducer.stdDev': lambda settings: _reducer('stdDev', _std_dev),
+    'Reducer.count': lambda settings: _reducer(
+        'count', lambda values: int(values.size)),
+    'Reducer.fixedHistogram': reducer_fixed_histogram,
+    'Reducer.combine': reducer_combine,
+    'Feature': feature,
+    'Collection': collection,
+}
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+"""Encodes fake ee objects into the same JSON graphs as ee.serializer."""
+import json
+import numbers
+
+try:
+    _string_types = (str, unicode)
+except NameError:
+    _string_types = (str,)
+
+
+def encode(obj, is_compound=True):
+    """Encodes an object for an API call.
+
+    Graphs are never factored into shared subtrees; is_compound is accepted
+    for compatibility and ignored.
+    """
+    if obj is None or isinstance(obj, (bool, numbers.Number) + _string_types):
+        return obj
+    if hasattr(obj, 'encode') and not isinstance(obj, _string_types):
+        return obj.encode(encode)
+    if isinstance(obj, (list, tuple)):
+        return [encode(o) for o in obj]
+    if isinstance(obj, dict):
+        return {'type': 'Dictionary',
+                'value': dict((k, encode(v)) for k, v in obj.items())}
+    raise TypeError('Can\'t encode object: %r' % (obj,))
+
+
+def toJSON(obj, opt_pretty=False):
+    return json.dumps(encode(obj), indent=2 if opt_pretty else None)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""GeoJSON helpers for the /extract handler.
+
+Requests for the same point or polygon rarely arrive byte-for-byte identical:
+drags jitter the last few decimal places, the drawing manager may start a
+ring at any vertex and wind it either way, and the client numbers features
+with a positional `fid`. canonical_key() reduces a request to a stable hash so
+that all of these hit the same cached result.
+
+Hand-drawn polygons also carry far more vertices, at far more precision, than
+our 10 m and 30 m rasters can resolve. simplify_features() quantizes
+coordinates and simplifies rings (Douglas-Peucker) with a tolerance derived
+from the pixel size before they are handed to Earth Engine, which keeps
+request graphs small and makes equivalent requests hash alike.
+
+Very large collections are reduced in pieces; partition_features() splits
+them into spatially coherent chunks (consecutive along a Z-order curve) with
+bounded vertex counts and areas.
+"""
+import hashlib
+import json
+import math
+
+# Decimal places kept when hashing coordinates (1e-6 degrees is ~0.1 m,
+# far below the resolution of any of our rasters).
+CANONICAL_PRECISION = 6
+
+# Properties that only identify a feature within its request.
+IGNORED_PROPERTIES = ('fid',)
+
+# Approximate length of a degree of latitude in meters. Longitude degrees are
+# shorter, so tolerances converted with this err on the side of caution.
+METERS_PER_DEGREE = 111320.0
+
+
+def _signed_area(ring):
+    """Shoelace area of an open ring; positive when counter-clockwise."""
+    area = 0.0
+    for i in range(len(ring)):
+        x1, y1 = ring[i - 1][:2]
+        x2, y2 = ring[i][:2]
+        area += x1 * y2 - x2 * y1
+    return area / 2.0
+
+
+def _round(position, precision):
+    return [round(c, precision) for c in position]
+
+
+def canonical_ring(ring, precision=CANONICAL_PRECISION, clockwise=False):
+    """Rounds, winds and rotates a closed linear ring into a canonical form.
+
+    Duplicate consecutive vertices are dropped, the ring is wound
+    counter-clockwise (clockwise for holes) and starts at its smallest
+    vertex.
+    """
+    points = []
+    for position in ring:
+        position = _round(position, precision)
+        if not points or position != points[-1]:
+            points.append(position)
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    if len(points) < 3:
+        return points
+    if (_signed_area(points) < 0) != clockwise:
+        points.reverse()
+    start = points.index(min(points))
+    points = points[start:] + points[:start]
+    return points + [points[0]]
+
+
+def canonical_geometry(geometry, precision=CANONICAL_PRECISION):
+    """Returns a canonical copy of a GeoJSON geometry."""
+    if geometry is None:
+        return None
+    kind = geometry.get('type')
+    coords = geometry.get('coordinates')
+    if kind == 'Point':
+        coords = _round(coords, precision)
+    elif kind in ('MultiPoint', 'LineString'):
+        coords = [_round(p, precision) for p in coords]
+    elif kind == 'MultiLineString':
+        coords = [[_round(p, precision) for p in line] for line in coords]
+    elif kind == 'Polygon':
+        coords = _canonical_polygon(coords, precision)
+    elif kind == 'MultiPolygon':
+        coords = [_canonical_polygon(p, precision) for p in coords]
+    elif kind == 'GeometryCollection':
+        return {'type': kind, 'geometries': [
+            canonical_geometry(g, precision) for g in geometry['geometries']]}
+    return {'type': kind, 'coordinates': coords}
+
+
+def _canonical_polygon(rings, precision):
+    return [canonical_ring(ring, precision, clockwise=i > 0)
+            for i, ring in enumerate(rings)]
+
+
+def canonical_key(asset_id, features, reducer, scale=None,
+                  precision=CANONICAL_PRECISION, tolerance=0):
+    """Returns a hex digest identifying an extraction request.
+
+    features is a GeoJSON FeatureCollection dict. Feature order is kept, but
+    the ignored properties (fid) are not part of the key. Approximate
+    requests (with a tolerance) never share keys with exact ones.
+    """
+    canonical = []
+    for ft in features['features']:
+        properties = dict((k, v) for k, v in (ft.get('properties') or {}).items()
+                          if k not in IGNORED_PROPERTIES)
+        canonical.append([canonical_geometry(ft.get('geometry'), precision),
+                          properties])
+    key = [asset_id, canonical, reducer, scale]
+    if tolerance:
+        key.append(tolerance)
+    blob = json.dumps(key, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+
+def pixel_tolerance(pixel_size, fraction=0.5):
+    """Returns a simplification tolerance (degrees) for a pixel size (m)."""
+    return pixel_size * fraction / METERS_PER_DEGREE
+
+
+def simplify_ring(ring, precision, tolerance):
+    """Quantizes and simplifies a closed linear ring.
+
+    Coordinates are rounded to `precision` decimal places, duplicate and
+    collinear vertices are dropped, and vertices closer than `tolerance`
+    degrees to the simplified outline are removed. Rings that would simplify
+    to fewer than three vertices are only quantized, and rings smaller than
+    the quantization step are left as they are.
+    """
+    points = []
+    for position in ring:
+        position = _round(position, precision)
+        if not points or position != points[-1]:
+            points.append(position)
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    if len(points) < 3:
+        return ring
+    # split the ring at the vertex farthest from its first vertex, so that
+    # both halves can be simplified as open lines
+    far = max(range(len(points)), key=lambda i: _distance(points[0], points[i]))
+    simplified = (_simplify_line(points[:far + 1], tolerance)[:-1] +
+                  _simplify_line(points[far:] + points[:1], tolerance))
+    if len(simplified) < 4:
+        return points + [points[0]]
+    return simplified
+
+
+def simplify_geometry(geometry, precision, tolerance):
+    """Returns a quantized, simplified copy of a GeoJSON geometry."""
+    if geometry is None:
+        return None
+    kind = geometry.get('type')
+    coords = geometry.get('coordinates')
+    if kind == 'Point':
+        coords = _round(coords, precision)
+    elif kind in ('MultiPoint', 'LineString'):
+        coords = [_round(p, precision) for p in coords]
+    elif kind == 'MultiLineString':
+        coords = [[_round(p, precision) for p in line] for line in coords]
+    elif kind == 'Polygon':
+        coords = [simplify_ring(r, precision, tolerance) for r in coords]
+    elif kind == 'MultiPolygon':
+        coords = [[simplify_ring(r, precision, tolerance) for r in p]
+                  for p in coords]
+    elif kind == 'GeometryCollection':
+        return {'type': kind, 'geometries': [
+            simplify_geometry(g, precision, tolerance)
+            for g in geometry['geometries']]}
+    return {'type': kind, 'coordinates': coords}
+
+
+def check_features(features):
+    """Raises ValueError unless features is a FeatureCollection dict whose
+    features are dicts with a geometry dict (or null)."""
+    if not isinstance(features, dict) or \
+            features.get('type') != 'FeatureCollection':
+        raise ValueError('Expected a GeoJSON FeatureCollection')
+    if not isinstance(features.get('features'), list):
+        raise ValueError('FeatureCollection has no list of features')
+    for i, ft in enumerate(features['features']):
+        if not isinstance(ft, dict):
+            raise ValueError('Feature %d is not an object' % i)
+        if not isinstance(ft.get('geometry'), (dict, type(None))):
+            raise ValueError('Feature %d has no geometry object' % i)
+
+
+def simplify_features(features, precision, tolerance):
+    """Returns a copy of a FeatureCollection dict with simplified geometries."""
+    simplified = []
+    for ft in features['features']:
+        ft = dict(ft)
+        ft['geometry'] = simplify_geometry(ft.get('geometry'), precision,
+                                           tolerance)
+        simplified.append(ft)
+    features = dict(features)
+    features['features'] = simplified
+    return features
+
+
+def _distance(a, b):
+    return ((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2) ** 0.5
+
+
+def _segment_distance(p, a, b):
+    """Distance from p to the segment a-b."""
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    length = dx * dx + dy * dy
+    if length == 0:
+        return _distance(p, a)
+    t = ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / length
+    t = max(0.0, min(1.0, t))
+    return _distance(p, (a[0] + t * dx, a[1] + t * dy))
+
+
+def _simplify_line(points, tolerance):
+    """Douglas-Peucker simplification of an open line; keeps both ends."""
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, distance = None, -1.0
+        for i in range(first + 1, last):
+            d = _segment_distance(points[i], points[first], points[last])
+            if d > distance:
+                farthest, distance = i, d
+        # collinear vertices (distance 0) are dropped even with no tolerance
+        if farthest is not None and distance > tolerance and distance > 0:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def partition_features(features, max_vertices, max_area):
+    """Splits GeoJSON features into spatially coherent chunks.
+
+    Returns lists of indices into features. Features are ordered along a
+    Z-order curve through their centroids and cut into chunks of at most
+    max_vertices vertices and max_area square meters; a feature larger than
+    either budget gets a chunk of its own.
+    """
+    stats = [_feature_stats(ft.get('geometry')) for ft in features]
+    centroids = [c for _, _, c in stats if c is not None]
+    if not centroids:
+        return [list(range(len(features)))] if features else []
+    west = min(c[0] for c in centroids)
+    south = min(c[1] for c in centroids)
+    width = max(c[0] for c in centroids) - west or 1.0
+    height = max(c[1] for c in centroids) - south or 1.0
+
+    def z_order(i):
+        centroid = stats[i][2] or (west, south)
+        x = int((centroid[0] - west) / width * 0xFFFF)
+        y = int((centroid[1] - south) / height * 0xFFFF)
+        return _interleave(x) | _interleave(y) << 1
+
+    chunks = []
+    chunk, vertices, area = [], 0, 0.0
+    for i in sorted(range(len(features)), key=z_order):
+        if chunk and (vertices + stats[i][0] > max_vertices or
+                      area + stats[i][1] > max_area):
+            chunks.append(chunk)
+            chunk, vertices, area = [], 0, 0.0
+        chunk.append(i)
+        vertices += stats[i][0]
+        area += stats[i][1]
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _interleave(n):
+    """Spreads the low 16 bits of n out to the even bits of the result."""
+    n &= 0xFFFF
+    n = (n | n << 8) & 0x00FF00FF
+    n = (n | n << 4) & 0x0F0F0F0F
+    n = (n | n << 2) & 0x33333333
+    n = (n | n << 1) & 0x55555555
+    return n
+
+
+def positions(geometry):
+    """Yields every position in a GeoJSON geometry."""
+    if geometry is None:
+        return
+    if geometry.get('type') == 'GeometryCollection':
+        for g in geometry['geometries']:
+            for position in positions(g):
+                yield position
+        return
+    stack = [geometry.get('coordinates')]
+    while stack:
+        coords = stack.pop()
+        if coords and isinstance(coords[0], (int, float)):
+            yield coords
+        elif coords:
+            stack.extend(coords)
+
+
+def polygons(geometry):
+    """Yields the ring lists of every polygon in a GeoJSON geometry."""
+    if geometry is None:
+        return
+    kind = geometry.get('type')
+    if kind == 'Polygon':
+        yield geometry['coordinates']
+    elif kind == 'MultiPolygon':
+        for polygon in geometry['coordinates']:
+            yield polygon
+    elif kind == 'GeometryCollection':
+        for g in geometry['geometries']:
+            for polygon in polygons(g):
+                yield polygon
+
+
+def _feature_stats(geometry):
+    """Returns (vertex count, approximate area in m^2, centroid)."""
+    points = list(positions(geometry))
+    if not points:
+        return 0, 0.0, None
+    centroid = (sum(p[0] for p in points) / float(len(points)),
+                sum(p[1] for p in points) / float(len(points)))
+    # degrees of longitude shrink with latitude
+    scale = METERS_PER_DEGREE ** 2 * math.cos(math.radians(centroid[1]))
+    area = 0.0
+    for rings in polygons(geometry):
+        for i, ring in enumerate(rings):
+            ring_area = abs(_signed_area(ring)) * scale
+            area += ring_area if i == 0 else -ring_area
+    return len(points), max(area, 0.0), centroid
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Earth Engine expression graphs serialized once and reused.
+
+getInfo() and getMapId() re-serialize an object's whole expression graph on
+every call, and the ee client's serializer hashes every node of it (md5 of
+the node's JSON) to factor out shared subtrees. For /extract most of that
+graph -- the stacked asset image and the combined reducer -- is the same on
+every request, and the rest is one node per feature and geometry.
+
+ReduceRegionsGraph serializes a reduceRegions call once, with a placeholder
+where the features go, and splices each request's features into that text.
+The features are encoded straight from their GeoJSON, just as the ee client
+encodes ee.Feature(geojson) without subtree sharing, so no ee.Feature or
+ee.Geometry objects are built per request. MapIdGraph does the same for an
+image handed to getMapId.
+"""
+import json
+
+import ee
+
+# Stands in for the features in a serialized graph until they are spliced in.
+_PLACEHOLDER = '__features__'
+
+
+def encode(obj):
+    """Encodes an ee object the way getInfo() does, minus subtree sharing."""
+    return ee.serializer.encode(obj, is_compound=False)
+
+
+def encode_geometry(geometry):
+    """Encodes a GeoJSON geometry as the ee client encodes ee.Geometry."""
+    encoded = {'type': geometry['type']}
+    if geometry['type'] == 'GeometryCollection':
+        encoded['geometries'] = geometry['geometries']
+    else:
+        encoded['coordinates'] = geometry['coordinates']
+    if 'crs' in geometry:
+        encoded['crs'] = geometry['crs']
+    for option in ('geodesic', 'evenOdd'):
+        if option in geometry:
+            encoded[option] = bool(geometry[option])
+    return encoded
+
+
+def encode_value(value):
+    """Encodes a plain JSON value (e.g. a feature property)."""
+    if isinstance(value, dict):
+        return {'type': 'Dictionary', 'value': dict(
+            (k, encode_value(v)) for k, v in value.items())}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(v) for v in value]
+    return value
+
+
+def encode_feature(feature):
+    """Encodes a GeoJSON feature as the ee client encodes ee.Feature."""
+    properties = feature.get('properties', {})
+    if 'id' in feature:
+        properties = dict(properties or {})
+        properties['system:index'] = feature['id']
+    arguments = {}
+    if feature.get('geometry') is not None:
+        arguments['geometry'] = encode_geometry(feature['geometry'])
+    if properties is not None:
+        arguments['metadata'] = encode_value(properties)
+    return {'type': 'Invocation', 'functionName': 'Feature',
+            'arguments': arguments}
+
+
+def encode_features(features):
+    """Encodes GeoJSON features as the ee client encodes a FeatureCollection
+    made from a list of them."""
+    return {'type': 'Invocation', 'functionName': 'Collection',
+            'arguments': {'features': [encode_feature(ft) for ft in features]}}
+
+
+def get_value(serialized):
+    """Evaluates a serialized graph, as getInfo() does."""
+    return ee.data.getValue({'json': serialized})
+
+
+class ReduceRegionsGraph(object):
+    """image.reduceRegions(features, reducer, scale), serialized up front."""
+
+    def __init__(self, image, reducer, scale):
+        placeholder = ee.FeatureCollection([])
+        graph = encode(image.reduceRegions(placeholder, reducer, scale))
+        encoded = encode(placeholder)
+        # the placeholder is the one argument of the call given as a
+        # FeatureCollection
+        for name, value in graph['arguments'].items():
+            if value == encoded:
+                graph['arguments'][name] = _PLACEHOLDER
+        self._prefix, self._suffix = json.dumps(graph).split(
+            json.dumps(_PLACEHOLDER))
+
+    def serialize(self, features):
+        """Returns the graph's JSON for a list of GeoJSON features."""
+        return ''.join([self._prefix, json.dumps(encode_features(features)),
+                        self._suffix])
+
+
+class MapIdGraph(object):
+    """An image to be handed to getMapId, serialized up front."""
+
+    def __init__(self, image):
+        self._json = json.dumps(encode(image))
+
+    def get_map_id(self, vis_params=None):
+        request = dict(vis_params or {})
+        request['image'] = self._json
+        return ee.data.getMapId(request)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""Cached partial sums over a fixed grid, shared by overlapping polygons.
+
+Every raster with a local copy (see rasters.py) is divided into the same
+hierarchy of cells a pyramid has (see pyramid.py): cell [i, j] of level k
+covers rows [i 2^k, (i + 1) 2^k) and likewise columns. A polygon is walked
+down that quadtree exactly as a pyramid would walk it, and the cells wholly
+inside it contribute their (sum, count); only the cells of BASE_LEVEL that
+its edges run through are read pixel by pixel. Where a pyramid has those
+partials on disk, here they are computed the first time a cell is needed
+and kept in an LRU cache: a cell of BASE_LEVEL from the raster, and a
+coarser one from its four children, reading those that aren't cached from
+the raster and caching them too. Polygons drawn around the same playas and
+fields so reuse each other's interiors, and each other's cells one level
+down, and only pay for their own boundaries. Looking further down for
+cached cells would cost more in cache lookups than reading the pixels.
+
+Answers are exact, and agree with zonal.py's. Only sums, counts and means
+are answered, and pyramids are preferred where an asset has one.
+"""
+import numpy as np
+
+import cache
+import pyramid
+import rasters
+
+# The finest level of cells: 16 x 16 pixels. Boundary cells of this size
+# are read pixel by pixel.
+BASE_LEVEL = 4
+
+
+class CellGrid(pyramid.Cells):
+    """A raster's hierarchy of cells, with partials from a shared cache."""
+
+    def __init__(self, key, raster, partials, base_level=BASE_LEVEL):
+        top = int(np.ceil(np.log2(max(max(raster.shape), 1))))
+        # partials are computed, not stored, so there is no value range to
+        # bound estimates with: only exact answers
+        super(CellGrid, self).__init__(
+            raster, range(base_level, max(top, base_level) + 1))
+        self.key = key
+        self._partials = partials
+
+    def totals(self, level, i, j):
+        """Returns arrays of the sums and valid-pixel counts of cells,
+        computing and caching those that aren't cached."""
+        return self._totals(level, i, j, self._compute)
+
+    def _totals(self, level, i, j, compute):
+        """totals(), computing missing cells with compute(level, i, j)."""
+        sums = np.zeros(len(i), dtype=float)
+        counts = np.zeros(len(i), dtype=np.int64)
+        missing = []
+        partials = self._partials.get_many(
+            (self.key, level, a, b) for a, b in zip(i.tolist(), j.tolist()))
+        for n, partial in enumerate(partials):
+            if partial is None:
+                missing.append(n)
+            else:
+                sums[n], counts[n] = partial
+        if missing:
+            missing = np.array(missing)
+            sums[missing], counts[missing] = compute(
+                level, i[missing], j[missing])
+            self._partials.set_many(
+                ((self.key, level, a, b), (total, count))
+                for a, b, total, count in zip(
+                    i[missing].tolist(), j[missing].tolist(),
+                    sums[missing].tolist(), counts[missing].tolist()))
+        return sums, counts
+
+    def _compute(self, level, i, j):
+        """Returns arrays of the sums and counts of cells: from the raster
+        at the base level, and from their four children above it, where
+        children that aren't cached are read from the raster."""
+        if level == self.levels[0]:
+            return self._read(level, i, j)
+        rows, cols = self.level_shape(level - 1)
+        child_i = (2 * i[:, None] + np.array([0, 0, 1, 1])).ravel()
+        child_j = (2 * j[:, None] + np.array([0, 1, 0, 1])).ravel()
+        parent = np.repeat(np.arange(len(i)), 4)
+        # cells on the last row or column may have fewer children
+        on = (child_i < rows) & (child_j < cols)
+        sums, counts = self._totals(level - 1, child_i[on], child_j[on],
+                                    self._read)
+        return (np.bincount(parent[on], sums, len(i)),
+                np.bincount(parent[on], counts, len(i)).astype(np.int64))
+
+    def _read(self, level, i, j):
+        """Returns arrays of the sums and counts of cells, from the raster,
+        a run of cells side by side in a row at a time."""
+        order = np.lexsort((j, i))
+        i, j = i[order], j[order]
+        starts = np.flatnonzero(np.concatenate([
+            [True], (i[1:] != i[:-1]) | (j[1:] != j[:-1] + 1)]))
+        sums = np.zeros(len(i), dtype=float)
+        counts = np.zeros(len(i), dtype=np.int64)
+        for start, stop in zip(starts, np.append(starts[1:], len(i))):
+            run = order[start:stop]
+            sums[run], counts[run] = self._run(level, i[start], j[start],
+                                               stop - start)
+        return sums, counts
+
+    def _run(self, level, i, j, n):
+        """Returns arrays of the sums and counts of cells [i, j, j + n)."""
+        size = 2 ** level
+        pixels = np.asarray(self.raster.data[i * size:(i + 1) * size,
+                                             j * size:(j + n) * size])
+        valid = self.raster.valid(pixels)
+        values = np.where(valid, pixels, 0)
+        # the raster's last column of cells may be narrower than the rest
+        edges = np.arange(0, pixels.shape[1], size)
+        return (np.add.reduceat(values.sum(axis=0, dtype=float), edges),
+                np.add.reduceat(valid.sum(axis=0, dtype=np.int64), edges))
+
+
+class GridCache(object):
+    """Answers /extract polygon queries from cached cell partials over the
+    local copies in a directory.
+
+    Every asset shares one LRU cache of up to max_cells partials.
+    """
+
+    def __init__(self, data_dir, max_cells=256 * 1024):
+        self.data_dir = data_dir
+        self._grids = rasters.LocalCopies(self._load)
+        self._partials = cache.LRUCache(max_cells)
+
+    def has(self, asset_id):
+        """Returns whether an asset has a local copy."""
+        return self.grid(asset_id) is not None
+
+    def grid(self, asset_id):
+        """Returns an asset's CellGrid, or None."""
+        return self._grids.get(asset_id)
+
+    def _load(self, asset_id):
+        path = rasters.find(self.data_dir, asset_id)
+        return path and CellGrid(asset_id, rasters.load(path), self._partials)
+
+    def clear(self):
+        """Forgets every cached partial."""
+        self._partials.clear()
+
+    @staticmethod
+    def answers(features, names):
+        """Returns whether cell partials can compute statistics names for
+        every feature, i.e. whether they are all polygons."""
+        return pyramid.Pyramids.answers(features, names)
+
+    def extract(self, asset_id, features, names):
+        """Returns reduceRegions-like features for polygon features."""
+        grid = self.grid(asset_id)
+        extracted = []
+        for i, ft in enumerate(features):
+            total, count, _ = grid.reduce(ft.get('geometry'))
+            reduced = {'sum': total, 'count': count,
+                       'mean': total / count if count else None}
+            properties = dict(ft.get('properties') or {})
+            properties.update((name, reduced[name]) for name in names)
+            extracted.append({'type': 'Feature', 'id': str(i),
+                              'geometry': ft.get('geometry'),
+                              'properties': properties})
+        return extracted
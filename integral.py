@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""Summed-area tables, for the sum, count and mean of rectangles in O(1).
+
+An asset's tables are two tile stores (see tilestore.py) one row and one
+column larger than the raster: `sum`, where entry [r, c] is the sum of the
+valid pixels in rows < r and columns < c, and `count`, the number of them.
+Any block of pixels rows [r0, r1) x columns [c0, c1) then sums to
+
+    T[r1, c1] - T[r0, c1] - T[r1, c0] + T[r0, c0]
+
+so a rectangle costs four lookups per table however big it is, and the
+tables are read a block at a time, like any tile store, rather than having
+to fit in memory. Sums are kept as float64 and counts as int64.
+
+A rectangle covers the pixels whose centers it contains, exactly as
+zonal.rasterize() would fill it, so the two agree. Unions of rectangles
+(MultiPolygons) are cut into disjoint blocks first. Anything else, or any
+statistic besides sum, count and mean, is left to the general path.
+
+Tables live under a data directory at their asset's ID, e.g.
+<data dir>/users/kyletaylor/shared/LC8dynamicwater.integral/{sum,count}.tiles.
+To make them from a GeoTIFF (which needs rasterio or GDAL) or a .npy raster:
+
+    python integral.py LC8dynamicwater.tif <data dir> \\
+        users/kyletaylor/shared/LC8dynamicwater
+"""
+import argparse
+import os
+
+import numpy as np
+
+import cache
+import rasters
+import tilestore
+
+# Block edge, in pixels, of the tables. Lookups are scattered, so blocks
+# are smaller than tilestore's: a 64 x 64 float64 block is 32 KiB.
+BLOCK_SIZE = 64
+
+# Extension of table directories.
+EXTENSION = '.integral'
+
+# Statistics the tables can answer.
+STATISTICS = ('mean', 'sum', 'count')
+
+
+class IntegralTables(object):
+    """Answers /extract rectangle queries from the summed-area tables in a
+    directory.
+
+    Every table shares one LRU cache of up to max_block_bytes of blocks.
+    """
+
+    def __init__(self, data_dir, max_block_bytes=32 * 1024 * 1024):
+        self.data_dir = data_dir
+        self._tables = rasters.LocalCopies(self._load)
+        self._blocks = cache.LRUCache(max_block_bytes,
+                                      weigher=lambda b: b.nbytes)
+
+    def has(self, asset_id):
+        """Returns whether an asset has summed-area tables."""
+        return self.tables(asset_id) is not None
+
+    def tables(self, asset_id):
+        """Returns an asset's (sum, count) TileStores, or None."""
+        return self._tables.get(asset_id)
+
+    def _load(self, asset_id):
+        path = find(self.data_dir, asset_id)
+        return path and tuple(
+            tilestore.TileStore(os.path.join(path, name), self._blocks)
+            for name in ('sum.tiles', 'count.tiles'))
+
+    def clear(self):
+        """Forgets every cached block."""
+        self._blocks.clear()
+
+    @staticmethod
+    def answers(features, names):
+        """Returns whether the tables can compute statistics names for
+        every feature, i.e. whether they are all rectangles."""
+        return (all(name in STATISTICS for name in names) and
+                all(rectangles(ft.get('geometry')) for ft in features))
+
+    def extract(self, asset_id, features, names):
+        """Returns reduceRegions-like features for rectangular features."""
+        sums, counts = self.tables(asset_id)
+        # the table entries to add and subtract for every feature
+        which, rows, cols, signs = [], [], [], []
+        for i, ft in enumerate(features):
+            for r0, r1, c0, c1 in pixel_blocks(
+                    sums, rectangles(ft.get('geometry'))):
+                which.extend([i] * 4)
+                rows.extend([r1, r0, r1, r0])
+                cols.extend([c1, c1, c0, c0])
+                signs.extend([1, -1, -1, 1])
+        which, signs = np.array(which, dtype=int), np.array(signs, dtype=float)
+        rows, cols = np.array(rows, dtype=int), np.array(cols, dtype=int)
+        totals = []
+        for table in (sums, counts):
+            values = table.read(rows, cols) if len(rows) else np.zeros(0)
+            totals.append(np.bincount(which, weights=signs * values,
+                                      minlength=len(features)))
+        extracted = []
+        for i, ft in enumerate(features):
+            total, count = float(totals[0][i]), int(round(totals[1][i]))
+            reduced = {'sum': total, 'count': count,
+                       'mean': total / count if count else None}
+            properties = dict(ft.get('properties') or {})
+            properties.update((name, reduced[name]) for name in names)
+            extracted.append({'type': 'Feature', 'id': str(i),
+                              'geometry': ft.get('geometry'),
+                              'properties': properties})
+        return extracted
+
+
+def rectangles(geom):
+    """Returns a geometry as a list of axis-aligned (west, south, east,
+    north) rectangles, or None if it isn't one or a MultiPolygon of them."""
+    kind = (geom or {}).get('type')
+    if kind == 'Polygon':
+        polygons = [geom['coordinates']]
+    elif kind == 'MultiPolygon':
+        polygons = geom['coordinates']
+    else:
+        return None
+    boxes = []
+    for rings in polygons:
+        if len(rings) != 1:
+            return None
+        ring = [tuple(p[:2]) for p in rings[0]]
+        if len(ring) == 5 and ring[0] == ring[-1]:
+            ring = ring[:-1]
+        if len(ring) != 4:
+            return None
+        # every side is either vertical or horizontal, and there are two of
+        # each
+        for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+            if x1 != x2 and y1 != y2:
+                return None
+        xs, ys = set(p[0] for p in ring), set(p[1] for p in ring)
+        if len(xs) != 2 or len(ys) != 2:
+            return None
+        boxes.append((min(xs), min(ys), max(xs), max(ys)))
+    return boxes or None
+
+
+def pixel_blocks(table, boxes):
+    """Returns disjoint (r0, r1, c0, c1) blocks of pixels, rows [r0, r1) x
+    columns [c0, c1), covering the pixels whose centers fall in any of a
+    list of rectangles, on the grid of the raster a table was made from."""
+    west, width, _, north, _, height = table.transform
+    # tables have an extra row and column
+    n_rows, n_cols = table.shape[0] - 1, table.shape[1] - 1
+    blocks = []
+    for x1, y1, x2, y2 in boxes:
+        # centers strictly between x1 and x2, and in [y1, y2) -- the same
+        # pixels zonal.rasterize() fills, computed the same way
+        c0 = int(np.floor((x1 - west) / width - 0.5)) + 1
+        c1 = int(np.ceil((x2 - west) / width - 0.5))
+        r0 = _first_row_below(north, height, y2)
+        r1 = _first_row_below(north, height, y1)
+        r0, r1 = max(r0, 0), min(r1, n_rows)
+        c0, c1 = max(c0, 0), min(c1, n_cols)
+        if r0 < r1 and c0 < c1:
+            blocks.append((r0, r1, c0, c1))
+    if len(blocks) < 2:
+        return blocks
+    # cut overlapping blocks along every edge of every block, and keep the
+    # cells of the resulting grid that any block covers
+    row_edges = sorted(set(b[0] for b in blocks) | set(b[1] for b in blocks))
+    col_edges = sorted(set(b[2] for b in blocks) | set(b[3] for b in blocks))
+    covered = np.zeros((len(row_edges) - 1, len(col_edges) - 1), dtype=bool)
+    for r0, r1, c0, c1 in blocks:
+        covered[row_edges.index(r0):row_edges.index(r1),
+                col_edges.index(c0):col_edges.index(c1)] = True
+    return [(row_edges[i], row_edges[i + 1], col_edges[j], col_edges[j + 1])
+            for i, j in zip(*np.nonzero(covered))]
+
+
+def _first_row_below(north, height, y):
+    """Returns the first row whose center is below y, comparing centers as
+    Raster.centers() computes them."""
+    def below(row):
+        return north + (row + 0.5) * height < y
+    row = int(np.floor((y - north) / height - 0.5)) + 1
+    # the estimate may be off by one where a center lies right on y
+    while below(row - 1):
+        row -= 1
+    while not below(row):
+        row += 1
+    return row
+
+
+def find(data_dir, asset_id):
+    """Returns the path of an asset's summed-area tables, or None."""
+    base = rasters.asset_path(data_dir, asset_id)
+    if base is None:
+        return None
+    path = base + EXTENSION
+    found = all(tilestore.find(path, name) for name in ('sum', 'count'))
+    return path if found else None
+
+
+def build(source, path, block_size=BLOCK_SIZE):
+    """Writes the summed-area tables of a GeoTIFF or .npy raster, reading it
+    a few rows at a time."""
+    for name, dtype in (('sum', np.float64), ('count', np.int64)):
+        shape, _, transform, nodata, read_rows = tilestore.open_rows(source)
+        tilestore.write(
+            os.path.join(path, name + tilestore.EXTENSION),
+            (shape[0] + 1, shape[1] + 1), dtype, transform, None,
+            _prefix_rows(read_rows, rasters.Raster(None, transform, nodata),
+                         shape[1], dtype, name == 'count'),
+            block_size)
+
+
+def _prefix_rows(read_rows, grid, n_cols, dtype, count):
+    """Returns read_rows(start, stop) for a table, from read_rows for its
+    raster; tables rows are read in order, carrying the last one along."""
+    last = np.zeros(n_cols + 1, dtype=dtype)
+
+    def read(start, stop):
+        table = np.zeros((stop - start, n_cols + 1), dtype=dtype)
+        # table row r sums raster rows < r; row 0 is all zeros
+        first = max(start, 1)
+        if first < stop:
+            pixels = np.asarray(read_rows(first - 1, stop - 1))
+            valid = grid.valid(pixels)
+            values = valid if count else np.where(valid, pixels, 0)
+            table[first - start:, 1:] = values.astype(dtype).cumsum(axis=1)
+            table[first - start:] = table[first - start:].cumsum(axis=0)
+            table[first - start:] += last
+        last[:] = table[-1]
+        return table
+    return read
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Makes summed-area tables from a GeoTIFF or .npy raster.')
+    parser.add_argument('source', help='GeoTIFF, or .npy with a .json sidecar')
+    parser.add_argument('data_dir', help='directory of tables')
+    parser.add_argument('asset_id', help='asset the raster is a copy of')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    args = parser.parse_args()
+    path = os.path.join(args.data_dir, *args.asset_id.split('/')) + EXTENSION
+    build(args.source, path, args.block_size)
+    print(path)
+
+
+if __name__ == "__main__":
+    main()
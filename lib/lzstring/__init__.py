@@ -1,23 +1,55 @@
  #!/usr/bin/python
  # -*- coding: utf-8 -*-
 
+"""LZ-String compression for python 2/3.
+
+Produces and reads exactly the same wire format as lz-string 1.0.4 (and the
+JavaScript lz-string the browser uses), but works on whole codes rather than
+single bits: codes are bit-reversed with a lookup table and packed into, or
+read out of, an integer accumulator a character's worth of bits at a time,
+and translation to and from the output alphabets is done in bulk with tables
+built once at import.
+"""
 from __future__ import division
 from __future__ import unicode_literals
 from __future__ import print_function
 from __future__ import absolute_import
-from builtins import range
-from builtins import int
-from builtins import chr
 from future import standard_library
 standard_library.install_aliases()
-from builtins import object
-import math
-import re
+
+from itertools import chain
+
+try:
+    _chr = unichr
+    _string_types = (str, unicode)
+except NameError:
+    _chr = chr
+    _string_types = (str,)
 
 
 keyStrBase64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
 keyStrUriSafe = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+-$"
-baseReverseDic = {};
+
+# character -> index reverse lookups for each alphabet, built once
+baseReverseDic = dict(
+    (alphabet, dict((c, i) for i, c in enumerate(alphabet)))
+    for alphabet in (keyStrBase64, keyStrUriSafe))
+
+# _REVERSED8[b] is the byte b with its bit order reversed
+_REVERSED8 = [int('{0:08b}'.format(b)[::-1], 2) for b in range(256)]
+
+
+class LZStringError(ValueError):
+    """Raised by iterDecompress* for a stream that can't be decoded."""
+
+
+class LimitExceeded(LZStringError):
+    """Raised by iterDecompress* when a stream decodes past a limit."""
+
+
+class _Truncated(LZStringError):
+    pass
+
 
 class Object(object):
     def __init__(self, **kwargs):
@@ -27,363 +59,257 @@ class Object(object):
 
 def getBaseValue(alphabet, character):
     if alphabet not in baseReverseDic:
-        baseReverseDic[alphabet] = {}
-    for i in range(len(alphabet)):
-        baseReverseDic[alphabet][alphabet[i]] = i
+        baseReverseDic[alphabet] = dict((c, i) for i, c in enumerate(alphabet))
     return baseReverseDic[alphabet][character]
 
 
-def _compress(uncompressed, bitsPerChar, getCharFromInt):
-    if (uncompressed is None):
-        return ""
+def _reverse(value, width):
+    """Returns the low `width` bits of value in reverse order."""
+    if width <= 8:
+        return _REVERSED8[value & 0xFF] >> (8 - width)
+    if width <= 16:
+        return ((_REVERSED8[value & 0xFF] << 8 |
+                 _REVERSED8[value >> 8 & 0xFF]) >> (16 - width))
+    return _reverse(value & 0xFFFF, 16) << (width - 16) | \
+        _reverse(value >> 16, width - 16)
 
-    context_dictionary = {}
-    context_dictionaryToCreate= {}
-    context_c = ""
-    context_wc = ""
-    context_w = ""
-    context_enlargeIn = 2 # Compensate for the first entry which should not count
-    context_dictSize = 3
-    context_numBits = 2
-    context_data = []
-    context_data_val = 0
-    context_data_position = 0
-
-    for ii in range(len(uncompressed)):
-        context_c = uncompressed[ii]
-        if context_c not in context_dictionary:
-            context_dictionary[context_c] = context_dictSize
-            context_dictSize += 1
-            context_dictionaryToCreate[context_c] = True
-
-        context_wc = context_w + context_c
-        if context_wc in context_dictionary:
-            context_w = context_wc
-        else:
-            if context_w in context_dictionaryToCreate:
-                if ord(context_w[0]) < 256:
-                    for i in range(context_numBits):
-                        context_data_val = (context_data_val << 1)
-                        if context_data_position == bitsPerChar-1:
-                            context_data_position = 0
-                            context_data.append(getCharFromInt(context_data_val))
-                            context_data_val = 0
-                        else:
-                            context_data_position += 1
-                    value = ord(context_w[0])
-                    for i in range(8):
-                        context_data_val = (context_data_val << 1) | (value & 1)
-                        if context_data_position == bitsPerChar - 1:
-                            context_data_position = 0
-                            context_data.append(getCharFromInt(context_data_val))
-                            context_data_val = 0
-                        else:
-                            context_data_position += 1
-                        value = value >> 1
-
-                else:
-                    value = 1
-                    for i in range(context_numBits):
-                        context_data_val = (context_data_val << 1) | value
-                        if context_data_position == bitsPerChar - 1:
-                            context_data_position = 0
-                            context_data.append(getCharFromInt(context_data_val))
-                            context_data_val = 0
-                        else:
-                            context_data_position += 1
-                        value = 0
-                    value = ord(context_w[0])
-                    for i in range(16):
-                        context_data_val = (context_data_val << 1) | (value & 1)
-                        if context_data_position == bitsPerChar - 1:
-                            context_data_position = 0
-                            context_data.append(getCharFromInt(context_data_val))
-                            context_data_val = 0
-                        else:
-                            context_data_position += 1
-                        value = value >> 1
-                context_enlargeIn -= 1
-                if context_enlargeIn == 0:
-                    context_enlargeIn = math.pow(2, context_numBits)
-                    context_numBits += 1
-                del context_dictionaryToCreate[context_w]
-            else:
-                value = context_dictionary[context_w]
-                for i in range(context_numBits):
-                    context_data_val = (context_data_val << 1) | (value & 1)
-                    if context_data_position == bitsPerChar - 1:
-                        context_data_position = 0
-                        context_data.append(getCharFromInt(context_data_val))
-                        context_data_val = 0
-                    else:
-                        context_data_position += 1
-                    value = value >> 1
-
-            context_enlargeIn -= 1
-            if context_enlargeIn == 0:
-                context_enlargeIn = math.pow(2, context_numBits)
-                context_numBits += 1
-            
-            # Add wc to the dictionary.
-            context_dictionary[context_wc] = context_dictSize
-            context_dictSize += 1
-            context_w = str(context_c)
 
-    # Output the code for w.
-    if context_w != "":
-        if context_w in context_dictionaryToCreate:
-            if ord(context_w[0]) < 256:
-                for i in range(context_numBits):
-                    context_data_val = (context_data_val << 1)
-                    if context_data_position == bitsPerChar-1:
-                        context_data_position = 0
-                        context_data.append(getCharFromInt(context_data_val))
-                        context_data_val = 0
-                    else:
-                        context_data_position += 1
-                value = ord(context_w[0])
-                for i in range(8):
-                    context_data_val = (context_data_val << 1) | (value & 1)
-                    if context_data_position == bitsPerChar - 1:
-                        context_data_position = 0
-                        context_data.append(getCharFromInt(context_data_val))
-                        context_data_val = 0
-                    else:
-                        context_data_position += 1
-                    value = value >> 1
+def _compress_codes(uncompressed, bitsPerChar):
+    """LZ-compresses a string into a list of bitsPerChar-wide integers."""
+    dictionary = {}
+    to_create = set()
+    w = ""
+    enlarge_in = 2  # Compensate for the first entry which should not count
+    dict_size = 3
+    num_bits = 2
+    # (value, width) codes, written out least significant bit first
+    codes = []
+    emit = codes.append
+
+    for c in uncompressed:
+        if c not in dictionary:
+            dictionary[c] = dict_size
+            dict_size += 1
+            to_create.add(c)
+
+        wc = w + c
+        if wc in dictionary:
+            w = wc
+            continue
+
+        if w in to_create:
+            value = ord(w[0])
+            if value < 256:
+                emit((0, num_bits))
+                emit((value, 8))
             else:
-                value = 1
-                for i in range(context_numBits):
-                    context_data_val = (context_data_val << 1) | value
-                    if context_data_position == bitsPerChar - 1:
-                        context_data_position = 0
-                        context_data.append(getCharFromInt(context_data_val))
-                        context_data_val = 0
-                    else:
-                        context_data_position += 1
-                    value = 0
-                value = ord(context_w[0])
-                for i in range(16):
-                    context_data_val = (context_data_val << 1) | (value & 1)
-                    if context_data_position == bitsPerChar - 1:
-                        context_data_position = 0
-                        context_data.append(getCharFromInt(context_data_val))
-                        context_data_val = 0
-                    else:
-                        context_data_position += 1
-                    value = value >> 1
-            context_enlargeIn -= 1
-            if context_enlargeIn == 0:
-                context_enlargeIn = math.pow(2, context_numBits)
-                context_numBits += 1
-            del context_dictionaryToCreate[context_w]
+                emit((1, num_bits))
+                emit((value, 16))
+            enlarge_in -= 1
+            if enlarge_in == 0:
+                enlarge_in = 1 << num_bits
+                num_bits += 1
+            to_create.discard(w)
         else:
-            value = context_dictionary[context_w]
-            for i in range(context_numBits):
-                context_data_val = (context_data_val << 1) | (value & 1)
-                if context_data_position == bitsPerChar - 1:
-                    context_data_position = 0
-                    context_data.append(getCharFromInt(context_data_val))
-                    context_data_val = 0
-                else:
-                    context_data_position += 1
-                value = value >> 1
-
-    context_enlargeIn -= 1
-    if context_enlargeIn == 0:
-        context_enlargeIn = math.pow(2, context_numBits)
-        context_numBits += 1
+            emit((dictionary[w], num_bits))
 
-    # Mark the end of the stream
-    value = 2
-    for i in range(context_numBits):
-        context_data_val = (context_data_val << 1) | (value & 1)
-        if context_data_position == bitsPerChar - 1:
-            context_data_position = 0
-            context_data.append(getCharFromInt(context_data_val))
-            context_data_val = 0
-        else:
-            context_data_position += 1
-        value = value >> 1
+        enlarge_in -= 1
+        if enlarge_in == 0:
+            enlarge_in = 1 << num_bits
+            num_bits += 1
 
-    # Flush the last char
-    while True:
-        context_data_val = (context_data_val << 1)
-        if context_data_position == bitsPerChar - 1:
-            context_data.append(getCharFromInt(context_data_val))
-            break
+        # Add wc to the dictionary.
+        dictionary[wc] = dict_size
+        dict_size += 1
+        w = c
+
+    # Output the code for w.
+    if w != "":
+        if w in to_create:
+            value = ord(w[0])
+            if value < 256:
+                emit((0, num_bits))
+                emit((value, 8))
+            else:
+                emit((1, num_bits))
+                emit((value, 16))
+            enlarge_in -= 1
+            if enlarge_in == 0:
+                enlarge_in = 1 << num_bits
+                num_bits += 1
+            to_create.discard(w)
         else:
-           context_data_position += 1
+            emit((dictionary[w], num_bits))
 
-    return "".join(context_data)
+    enlarge_in -= 1
+    if enlarge_in == 0:
+        enlarge_in = 1 << num_bits
+        num_bits += 1
 
+    # Mark the end of the stream
+    emit((2, num_bits))
+
+    # Pack the codes a character at a time.
+    out = []
+    append = out.append
+    mask = (1 << bitsPerChar) - 1
+    acc = 0
+    acc_bits = 0
+    for value, width in codes:
+        acc = acc << width | _reverse(value, width)
+        acc_bits += width
+        while acc_bits >= bitsPerChar:
+            acc_bits -= bitsPerChar
+            append(acc >> acc_bits & mask)
+        acc &= (1 << acc_bits) - 1
+
+    # Flush the last char; like lz-string, a stream that ends on a character
+    # boundary still gets a padding character.
+    append(acc << (bitsPerChar - acc_bits) & mask)
+    return out
 
-def _decompress(length, resetValue, getNextValue):
-    dictionary = {}
-    enlargeIn = 4
-    dictSize = 4
-    numBits = 3
-    entry = ""
-    result = []
-
-    data = Object(
-        val=getNextValue(0),
-        position=resetValue,
-        index=1
-    )
-
-    for i in range(3):
-        dictionary[i] = i
-
-    bits = 0
-    maxpower = math.pow(2, 2)
-    power = 1
-
-    while power != maxpower:
-        resb = data.val & data.position
-        data.position >>= 1
-        if data.position == 0:
-            data.position = resetValue
-            data.val = getNextValue(data.index)
-            data.index += 1
-
-        bits |= power if resb > 0 else 0
-        power <<= 1;
-
-    next = bits
-    if next == 0:
-        bits = 0
-        maxpower = math.pow(2, 8)
-        power = 1
-        while power != maxpower:
-            resb = data.val & data.position
-            data.position >>= 1
-            if data.position == 0:
-                data.position = resetValue
-                data.val = getNextValue(data.index)
-                data.index += 1
-            bits |= power if resb > 0 else 0
-            power <<= 1
-        c = chr(bits)
-    elif next == 1:
-        bits = 0
-        maxpower = math.pow(2, 16)
-        power = 1
-        while power != maxpower:
-            resb = data.val & data.position
-            data.position >>= 1
-            if data.position == 0:
-                data.position = resetValue;
-                data.val = getNextValue(data.index)
-                data.index += 1
-            bits |= power if resb > 0 else 0
-            power <<= 1
-        c = chr(bits)
-    elif next == 2:
-        return ""
 
-    dictionary[3] = c
+def _compress(uncompressed, bitsPerChar, getCharFromInt):
+    if (uncompressed is None):
+        return ""
+    return "".join([getCharFromInt(code)
+                    for code in _compress_codes(uncompressed, bitsPerChar)])
+
+
+def _compress_to_alphabet(uncompressed, alphabet):
+    codes = _compress_codes(uncompressed, 6)
+    return "".join(map(alphabet.__getitem__, codes))
+
+
+def _iter_decompress(values, bitsPerChar, maxLength=None,
+                     maxDictionarySize=None, chunkSize=4096):
+    """Inverse of _compress_codes, yielding the text in pieces.
+
+    Pieces are yielded roughly every chunkSize characters. LimitExceeded is
+    raised as soon as the output passes maxLength characters or the LZ
+    dictionary passes maxDictionarySize entries, so a small stream that
+    expands enormously is given up on early.
+    """
+    values = iter(values)
+    state = [0, 0]  # accumulator, bits in it
+
+    def read(width):
+        acc, acc_bits = state
+        try:
+            while acc_bits < width:
+                acc = acc << bitsPerChar | next(values)
+                acc_bits += bitsPerChar
+        except StopIteration:
+            raise _Truncated('lzstring stream ends before its end marker')
+        acc_bits -= width
+        state[0] = acc & ((1 << acc_bits) - 1)
+        state[1] = acc_bits
+        return _reverse(acc >> acc_bits, width)
+
+    bits = read(2)
+    if bits == 0:
+        c = _chr(read(8))
+    elif bits == 1:
+        c = _chr(read(16))
+    elif bits == 2:
+        return
+    else:
+        raise LZStringError('invalid lzstring stream')
+
+    dictionary = [0, 1, 2, c]
     w = c
-    result.append(c)
-    counter = 0
+    result = [c]
+    pending = 1  # characters in result
+    length = 0  # characters already yielded
+    enlarge_in = 4
+    num_bits = 3
     while True:
-        counter += 1
-        if data.index > length:
-            return ""
-
-        bits = 0
-        maxpower = math.pow(2, numBits)
-        power = 1
-        while power != maxpower:
-            resb = data.val & data.position
-            data.position >>= 1
-            if data.position == 0:
-                data.position = resetValue;
-                data.val = getNextValue(data.index)
-                data.index += 1
-            bits |= power if resb > 0 else 0
-            power <<= 1
-
-        c = bits
-        if c == 0:
-            bits = 0
-            maxpower = math.pow(2, 8)
-            power = 1
-            while power != maxpower:
-                resb = data.val & data.position
-                data.position >>= 1
-                if data.position == 0:
-                    data.position = resetValue
-                    data.val = getNextValue(data.index)
-                    data.index += 1
-                bits |= power if resb > 0 else 0
-                power <<= 1
-
-            dictionary[dictSize] = chr(bits)
-            dictSize += 1
-            c = dictSize - 1
-            enlargeIn -= 1
-        elif c == 1:
-            bits = 0
-            maxpower = math.pow(2, 16)
-            power = 1
-            while power != maxpower:
-                resb = data.val & data.position
-                data.position >>= 1
-                if data.position == 0:
-                    data.position = resetValue;
-                    data.val = getNextValue(data.index)
-                    data.index += 1
-                bits |= power if resb > 0 else 0
-                power <<= 1
-            dictionary[dictSize] = chr(bits)
-            dictSize += 1
-            c = dictSize - 1
-            enlargeIn -= 1
-        elif c == 2:
-            return "".join(result)
-
-
-        if enlargeIn == 0:
-            enlargeIn = math.pow(2, numBits)
-            numBits += 1
-
-        if c in dictionary:
-            entry = dictionary[c]
+        code = read(num_bits)
+        if code == 0:
+            dictionary.append(_chr(read(8)))
+            code = len(dictionary) - 1
+            enlarge_in -= 1
+        elif code == 1:
+            dictionary.append(_chr(read(16)))
+            code = len(dictionary) - 1
+            enlarge_in -= 1
+        elif code == 2:
+            if maxLength is not None and length + pending > maxLength:
+                raise LimitExceeded(
+                    'lzstring stream decodes to more than %d characters'
+                    % maxLength)
+            yield "".join(result)
+            return
+
+        if enlarge_in == 0:
+            enlarge_in = 1 << num_bits
+            num_bits += 1
+
+        if code < len(dictionary):
+            entry = dictionary[code]
+        elif code == len(dictionary):
+            entry = w + w[0]
         else:
-            if c == dictSize:
-                entry = w + w[0]
-            else:
-                return None
+            raise LZStringError('invalid lzstring stream')
         result.append(entry)
+        pending += len(entry)
+        if pending >= chunkSize:
+            length += pending
+            if maxLength is not None and length > maxLength:
+                raise LimitExceeded(
+                    'lzstring stream decodes to more than %d characters'
+                    % maxLength)
+            yield "".join(result)
+            result = []
+            pending = 0
 
         # Add w+entry[0] to the dictionary.
-        dictionary[dictSize] = w + entry[0]
-        dictSize += 1
-        enlargeIn -= 1
+        dictionary.append(w + entry[0])
+        if (maxDictionarySize is not None
+                and len(dictionary) > maxDictionarySize):
+            raise LimitExceeded(
+                'lzstring dictionary grows past %d entries'
+                % maxDictionarySize)
+        enlarge_in -= 1
 
         w = entry
-        if enlargeIn == 0:
-            enlargeIn = math.pow(2, numBits)
-            numBits += 1
+        if enlarge_in == 0:
+            enlarge_in = 1 << num_bits
+            num_bits += 1
+
+
+def _decompress_values(values, bitsPerChar):
+    """Decompresses a whole stream; returns None for an invalid one."""
+    try:
+        return "".join(_iter_decompress(values, bitsPerChar))
+    except _Truncated:
+        # ran out of input before the end-of-stream marker
+        return ""
+    except LZStringError:
+        return None
+
+
+def _decompress(length, resetValue, getNextValue):
+    return _decompress_values(
+        (getNextValue(i) for i in range(length)), resetValue.bit_length())
 
 
 class LZString(object):
     @staticmethod
     def compress(uncompressed):
-        return _compress(uncompressed, 16, chr)
+        return _compress(uncompressed, 16, _chr)
 
     @staticmethod
     def compressToUTF16(uncompressed):
         if uncompressed is None:
             return ""
-        return _compress(uncompressed, 15, lambda a: chr(a+32)) + " "
+        return _compress(uncompressed, 15, lambda a: _chr(a+32)) + " "
 
     @staticmethod
     def compressToBase64(uncompressed):
         if uncompressed is None:
             return ""
-        res = _compress(uncompressed, 6, lambda a: keyStrBase64[a])
+        res = _compress_to_alphabet(uncompressed, keyStrBase64)
         # To produce valid Base64
         end = len(res) % 4
         if end > 0:
@@ -394,7 +320,7 @@ class LZString(object):
     def compressToEncodedURIComponent(uncompressed):
         if uncompressed is None:
             return ""
-        return _compress(uncompressed, 6, lambda a: keyStrUriSafe[a])
+        return _compress_to_alphabet(uncompressed, keyStrUriSafe)
 
     @staticmethod
     def decompress(compressed):
@@ -402,7 +328,7 @@ class LZString(object):
             return ""
         if compressed == "":
             return None
-        return _decompress(len(compressed), 32768, lambda index: ord(compressed[index]))
+        return _decompress_values(map(ord, compressed), 16)
 
     @staticmethod
     def decompressFromUTF16(compressed):
@@ -410,7 +336,7 @@ class LZString(object):
             return ""
         if compressed == "":
             return None
-        return _decompress(len(compressed), 16384, lambda index: compressed[index] - 32)
+        return _decompress_values((ord(c) - 32 for c in compressed), 15)
 
     @staticmethod
     def decompressFromBase64(compressed):
@@ -418,7 +344,8 @@ class LZString(object):
             return ""
         if compressed == "":
             return None
-        return _decompress(len(compressed), 32, lambda index: getBaseValue(keyStrBase64, compressed[index]))
+        return _decompress_values(
+            map(baseReverseDic[keyStrBase64].__getitem__, compressed), 6)
 
     @staticmethod
     def decompressFromEncodedURIComponent(compressed):
@@ -427,4 +354,28 @@ class LZString(object):
         if compressed == "":
             return None
         compressed = compressed.replace(" ", "+")
-        return _decompress(len(compressed), 32, lambda index: getBaseValue(keyStrUriSafe, compressed[index]))
+        return _decompress_values(
+            map(baseReverseDic[keyStrUriSafe].__getitem__, compressed), 6)
+
+    @staticmethod
+    def iterDecompressFromEncodedURIComponent(compressed, maxLength=None,
+                                              maxDictionarySize=None):
+        """Decompresses compressed, yielding the output in pieces.
+
+        compressed may be a string or an iterable of string pieces, which
+        are consumed only as fast as the output is. Unlike the other
+        decompress methods this raises LZStringError for a stream that can't
+        be decoded, and LimitExceeded once the output passes maxLength
+        characters or the dictionary passes maxDictionarySize entries.
+        """
+        if isinstance(compressed, _string_types):
+            compressed = [compressed]
+        lookup = baseReverseDic[keyStrUriSafe].__getitem__
+        values = chain.from_iterable(
+            map(lookup, piece.replace(" ", "+")) for piece in compressed)
+        try:
+            for piece in _iter_decompress(values, 6, maxLength,
+                                          maxDictionarySize):
+                yield piece
+        except KeyError as e:
+            raise LZStringError('invalid lzstring character %r' % e.args[0])
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""In-process latency and payload size metrics for our handlers.
+
+Each request gets a RequestTimer. Its stages (decoding, parsing, the Earth
+Engine round trip and so on) are timed with `with timer.stage(name):`, and
+payload sizes are noted with timer.size(). When the request finishes, the
+timer records everything into the process-wide REGISTRY of histograms and
+returns a Server-Timing header value for the response.
+
+Histograms use fixed, roughly logarithmic buckets, so recording costs one
+bisect and a lock, and memory doesn't grow with traffic. Percentiles are
+estimated from the buckets. Every App Engine instance keeps its own
+histograms, so /metrics describes the instance that served it.
+"""
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds of the latency buckets, in milliseconds.
+LATENCY_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                     10000, 20000, 60000)
+
+# Upper bounds of the payload size buckets, in bytes.
+SIZE_BOUNDS_BYTES = tuple(2 ** n for n in range(6, 27, 2))
+
+# Percentiles reported by Histogram.snapshot().
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram(object):
+    """A thread-safe histogram over fixed bucket bounds."""
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self._counts = [0] * (len(self.bounds) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = None
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        bucket = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self._counts[bucket] += 1
+            self._count += 1
+            self._sum += value
+            if self._max is None or value > self._max:
+                self._max = value
+
+    def percentile(self, p):
+        """Estimates the p'th percentile (the upper bound of its bucket)."""
+        with self._lock:
+            counts, count, largest = list(self._counts), self._count, self._max
+        if not count:
+            return None
+        rank = p / 100.0 * count
+        seen = 0
+        for bucket, n in enumerate(counts):
+            seen += n
+            if seen >= rank and n:
+                if bucket == len(self.bounds):
+                    return largest
+                return min(self.bounds[bucket], largest)
+        return largest
+
+    def snapshot(self):
+        with self._lock:
+            counts, count = list(self._counts), self._count
+            total, largest = self._sum, self._max
+        snapshot = {
+            'count': count,
+            'sum': total,
+            'mean': total / count if count else None,
+            'max': largest,
+            'buckets': [[bound, n] for bound, n in
+                        zip(self.bounds + ('+Inf',), counts)],
+        }
+        for p in PERCENTILES:
+            snapshot['p%d' % p] = self.percentile(p)
+        return snapshot
+
+
+class Registry(object):
+    """Named histograms, created on first use."""
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, bounds):
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram(bounds))
+        return histogram
+
+    def observe_ms(self, name, ms):
+        self.histogram(name, LATENCY_BOUNDS_MS).observe(ms)
+
+    def observe_bytes(self, name, size):
+        self.histogram(name, SIZE_BOUNDS_BYTES).observe(size)
+
+    def snapshot(self):
+        with self._lock:
+            histograms = dict(self._histograms)
+        return dict((name, h.snapshot()) for name, h in histograms.items())
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+REGISTRY = Registry()
+
+
+class RequestTimer(object):
+    """Stage timings and payload sizes for one request.
+
+    Stages may be entered more than once, and from worker threads; their
+    times add up.
+    """
+
+    def __init__(self, name, registry=None):
+        self.name = name
+        self._registry = REGISTRY if registry is None else registry
+        self._started = time.time()
+        self._stages = []
+        self._durations = {}
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - started)
+
+    def add(self, name, seconds):
+        with self._lock:
+            if name not in self._durations:
+                self._stages.append(name)
+                self._durations[name] = 0.0
+            self._durations[name] += seconds
+
+    def size(self, name, size):
+        with self._lock:
+            self._sizes[name] = self._sizes.get(name, 0) + size
+
+    def server_timing(self):
+        """Returns a Server-Timing header value for the stages so far."""
+        with self._lock:
+            stages = [(name, self._durations[name]) for name in self._stages]
+        stages.append(('total', time.time() - self._started))
+        return ', '.join('%s;dur=%.1f' % (name, seconds * 1000)
+                         for name, seconds in stages)
+
+    def finish(self):
+        """Records the request into the registry; returns Server-Timing."""
+        header = self.server_timing()
+        with self._lock:
+            durations = dict(self._durations)
+            sizes = dict(self._sizes)
+        durations['total'] = time.time() - self._started
+        for stage, seconds in durations.items():
+            self._registry.observe_ms('%s.%s' % (self.name, stage),
+                                      seconds * 1000)
+        for name, size in sizes.items():
+            self._registry.observe_bytes('%s.%s' % (self.name, name), size)
+        return header
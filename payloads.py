@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""Decoding of /extract requests and encoding of its responses.
+
+Feature collections too large for a query string are POSTed as the request
+body instead, either as raw GeoJSON, as the same lzstring
+(compressToEncodedURIComponent) text the client puts in the query string, or
+as gzip/deflate compressed bytes (Content-Encoding: gzip or deflate). The
+body is read and inflated a chunk at a time, and reading stops as soon as
+either the compressed or the decoded size passes its cap, so an oversized or
+maliciously compressed body is rejected before it is held in memory.
+lzstring is decompressed as a stream too, and given up on as soon as its
+output or its dictionary passes a limit, so a few kilobytes of lzstring that
+would expand to gigabytes cost no more than the limit.
+
+Feature collections in the query string are lzstring text unless marked
+otherwise with encoding=json (plain GeoJSON) or encoding=deflate
+(base64url-encoded deflate). Responses are lzstring text unless JSON is asked
+for, in which case they are gzip or deflate compressed as negotiated through
+Accept-Encoding. zlib is C-backed and far cheaper than the pure-Python
+lzstring codec, which is kept for older clients.
+"""
+import base64
+import binascii
+import itertools
+import zlib
+
+import lzstring
+
+# Bytes read from the request body at a time.
+CHUNK_SIZE = 64 * 1024
+
+
+class PayloadError(ValueError):
+    """Raised when a request body can't be decoded."""
+
+
+class PayloadTooLarge(PayloadError):
+    """Raised when a request body is larger than we are willing to decode."""
+
+
+def read_body(stream, content_encoding=None, content_length=None,
+              max_bytes=None, max_decoded_bytes=None, max_dictionary_size=None):
+    """Reads a request body from stream and returns it as JSON text.
+
+    content_encoding is the request's Content-Encoding header ('gzip',
+    'deflate' or None). lzstring bodies are recognized by not looking like
+    JSON once any Content-Encoding has been undone, and are decompressed as
+    they are read.
+    """
+    if (max_bytes is not None and content_length
+            and int(content_length) > max_bytes):
+        raise PayloadTooLarge('Request body is larger than %d bytes' % max_bytes)
+    pieces = _iter_body(stream, _Inflater(content_encoding), max_bytes,
+                        max_decoded_bytes)
+    head = b''
+    for piece in pieces:
+        head += piece
+        if head.strip():
+            break
+    if not head.strip():
+        raise PayloadError('Request body is empty')
+    pieces = itertools.chain([head.lstrip()], pieces)
+    if head.lstrip()[:1] in (b'{', b'['):
+        try:
+            return b''.join(pieces).decode('utf-8')
+        except UnicodeDecodeError:
+            raise PayloadError('Request body is not valid UTF-8')
+    return decode_lzstring((_lzstring_text(p) for p in pieces),
+                           max_decoded_bytes, max_dictionary_size,
+                           what='Request body')
+
+
+def decode_query_features(value, encoding=None, max_decoded_bytes=None,
+                          max_dictionary_size=None):
+    """Returns the JSON text of a features= query parameter.
+
+    encoding is the request's encoding= marker: 'json', 'deflate'
+    (base64url-encoded deflate) or 'lzstring'. Without one, features are
+    lzstring text unless they look like JSON.
+    """
+    if not encoding:
+        encoding = 'json' if value.lstrip()[:1] in ('{', '[') else 'lzstring'
+    encoding = encoding.strip().lower()
+    if encoding == 'json':
+        return value
+    if encoding == 'lzstring':
+        return decode_lzstring(value, max_decoded_bytes, max_dictionary_size)
+    if encoding != 'deflate':
+        raise PayloadError('Unsupported features encoding: %s' % encoding)
+    value = value.strip().encode('ascii')
+    try:
+        data = base64.urlsafe_b64decode(value + b'=' * (-len(value) % 4))
+    except (TypeError, ValueError, binascii.Error):
+        raise PayloadError('features is not valid base64url')
+    inflater = _Inflater('deflate')
+    pieces = inflater.feed(data, max_decoded_bytes)
+    pieces += inflater.flush(_remaining(max_decoded_bytes,
+                                        sum(len(p) for p in pieces)))
+    try:
+        text = b''.join(pieces).decode('utf-8')
+    except UnicodeDecodeError:
+        raise PayloadError('features is not valid UTF-8')
+    if not text:
+        raise PayloadError('features is empty')
+    return text
+
+
+def decode_lzstring(compressed, max_decoded_bytes=None,
+                    max_dictionary_size=None, what='features', expect_json=True):
+    """Decompresses lzstring text, or an iterable of pieces of it.
+
+    Decoding stops as soon as the text passes max_decoded_bytes characters
+    or the lzstring dictionary passes max_dictionary_size entries, and, with
+    expect_json, as soon as the text can be seen not to be JSON.
+    """
+    decoded = lzstring.LZString.iterDecompressFromEncodedURIComponent(
+        compressed, max_decoded_bytes, max_dictionary_size)
+    pieces = []
+    checked = not expect_json
+    try:
+        for piece in decoded:
+            if not checked and piece.strip():
+                if piece.lstrip()[0] not in '{[':
+                    raise PayloadError('%s is not JSON' % what)
+                checked = True
+            pieces.append(piece)
+    except lzstring.LimitExceeded as e:
+        raise PayloadTooLarge('%s is too large once decoded: %s' % (what, e))
+    except lzstring.LZStringError as e:
+        raise PayloadError('%s is not valid lzstring: %s' % (what, e))
+    finally:
+        decoded.close()
+    text = ''.join(pieces)
+    if not text.strip():
+        raise PayloadError('%s is empty' % what)
+    return text
+
+
+def negotiate_encoding(accept_encoding):
+    """Returns 'gzip', 'deflate' or None for an Accept-Encoding header."""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        fields = part.strip().split(';')
+        q = 1.0
+        for param in fields[1:]:
+            name, _, weight = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(weight)
+                except ValueError:
+                    q = 0.0
+        accepted[fields[0].strip().lower()] = q
+    for encoding in ('gzip', 'deflate'):
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+def compressor(encoding, level=6):
+    """Returns a zlib compressobj producing a Content-Encoding stream."""
+    wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+    return zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+
+def encode(data, encoding):
+    """Compresses bytes for a Content-Encoding of 'gzip', 'deflate' or None."""
+    if not encoding:
+        return data
+    deflater = compressor(encoding)
+    return deflater.compress(data) + deflater.flush()
+
+
+def iter_encode(pieces, encoding):
+    """Compresses an iterable of bytes, flushing each piece as it comes.
+
+    Flushing keeps streamed responses streaming, at the cost of a few bytes
+    of compression per piece.
+    """
+    if not encoding:
+        for piece in pieces:
+            yield piece
+        return
+    deflater = compressor(encoding)
+    for piece in pieces:
+        yield deflater.compress(piece) + deflater.flush(zlib.Z_SYNC_FLUSH)
+    yield deflater.flush()
+
+
+def _iter_body(stream, inflater, max_bytes, max_decoded_bytes):
+    """Yields a request body a chunk at a time with its encoding undone."""
+    read = 0
+    decoded = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        read += len(chunk)
+        if max_bytes is not None and read > max_bytes:
+            raise PayloadTooLarge(
+                'Request body is larger than %d bytes' % max_bytes)
+        for piece in inflater.feed(chunk, _remaining(max_decoded_bytes, decoded)):
+            decoded += len(piece)
+            yield piece
+    for piece in inflater.flush(_remaining(max_decoded_bytes, decoded)):
+        decoded += len(piece)
+        yield piece
+
+
+def _lzstring_text(piece):
+    # lzstring text is ASCII; line breaks may have crept in around it
+    try:
+        return piece.decode('ascii').replace('\r', '').replace('\n', '')
+    except UnicodeDecodeError:
+        raise PayloadError('Request body is neither JSON nor lzstring')
+
+
+def _remaining(limit, used):
+    return None if limit is None else limit - used
+
+
+class _Inflater(object):
+    """Incrementally undoes a Content-Encoding, enforcing an output cap."""
+
+    def __init__(self, content_encoding):
+        encoding = (content_encoding or 'identity').strip().lower()
+        if encoding not in ('identity', 'gzip', 'x-gzip', 'deflate'):
+            raise PayloadError('Unsupported Content-Encoding: %s' % encoding)
+        self._encoding = encoding
+        self._inflater = None
+
+    def feed(self, chunk, limit):
+        if self._encoding == 'identity':
+            if limit is not None and len(chunk) > limit:
+                raise PayloadTooLarge('Decoded request body is too large')
+            return [chunk]
+        if self._inflater is None:
+            self._inflater = zlib.decompressobj(self._wbits(chunk))
+        return self._inflate(chunk, limit)
+
+    def flush(self, limit):
+        if self._inflater is None:
+            return []
+        tail = self._inflater.flush()
+        if limit is not None and len(tail) > limit:
+            raise PayloadTooLarge('Decoded request body is too large')
+        return [tail]
+
+    def _inflate(self, data, limit):
+        pieces = []
+        while data:
+            # ask for one byte more than we allow so that overflow shows up
+            try:
+                if limit is None:
+                    piece = self._inflater.decompress(data)
+                else:
+                    piece = self._inflater.decompress(data, limit + 1)
+            except zlib.error as e:
+                raise PayloadError('Request body could not be inflated: %s' % e)
+            if limit is not None:
+                limit -= len(piece)
+                if limit < 0:
+                    raise PayloadTooLarge('Decoded request body is too large')
+            pieces.append(piece)
+            data = self._inflater.unconsumed_tail
+        return pieces
+
+    def _wbits(self, first_chunk):
+        if self._encoding in ('gzip', 'x-gzip'):
+            return 16 + zlib.MAX_WBITS
+        # "deflate" is meant to be zlib-wrapped, but some clients send raw
+        # deflate streams; tell them apart by the zlib header checksum
+        header = bytearray(first_chunk[:2])
+        if (len(header) == 2 and header[0] & 0x0F == 8
+                and (header[0] << 8 | header[1]) % 31 == 0):
+            return zlib.MAX_WBITS
+        return -zlib.MAX_WBITS
@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+"""Mean pyramids, for polygon means whose cost doesn't grow with area.
+
+An asset's pyramid holds, for every level k from BASE_LEVEL up, the sum of
+the valid pixels and their count in every 2^k x 2^k cell of its raster
+(cell [i, j] of level k covers rows [i 2^k, (i + 1) 2^k) and likewise
+columns). A polygon is reduced by walking the cells down from the coarsest
+level that covers it, as a quadtree: cells wholly inside the polygon are
+taken whole, cells wholly outside are dropped, and only cells its edges run
+through are split into their four children. Cells of BASE_LEVEL that are
+still split are resolved pixel by pixel from the raster itself. The work
+done therefore follows the polygon's perimeter, not its area.
+
+"Inside" means what it does to zonal.rasterize(): a pixel belongs to a
+polygon when its center does (even-odd, so holes are left out), and a cell
+is wholly inside or outside when no edge touches the box spanned by its
+pixel centers. Exact answers agree with zonal.py's.
+
+Given a tolerance, the walk stops as soon as the mean is known to within
+it: every cell still being split may hold anywhere from none to all of its
+valid pixels, each worth anywhere between the raster's smallest and largest
+value, which bounds how far the mean can be from one that counts the
+undecided cells whose middle pixels are inside. Big polygons are then answered
+from a few coarse cells. Sums and counts are estimated the same way.
+
+Pyramids live beside an asset's local copy (see rasters.py), e.g.
+<data dir>/users/kyletaylor/shared/LC8dynamicwater.pyramid/, as a meta.json
+and sum_<k>.npy and count_<k>.npy per level, all memory mapped. To make
+one:
+
+    python pyramid.py <data dir> users/kyletaylor/shared/LC8dynamicwater
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+import geometry
+import rasters
+
+# The finest level stored: cells of 8 x 8 pixels. Finer detail is read from
+# the raster itself, so a pyramid takes ~1/20th of the space of its raster.
+BASE_LEVEL = 3
+
+# Extension of pyramid directories.
+EXTENSION = '.pyramid'
+
+# Statistics pyramids can answer.
+STATISTICS = ('mean', 'sum', 'count')
+
+# Rows read at a time while building a pyramid.
+BUILD_ROWS = 1024
+
+
+class Cells(object):
+    """Levels of cells over a raster, walked as a quadtree by reduce().
+
+    Subclasses say what the sums and counts of cells are, with totals().
+    Without a value_range, (min, max) of the raster's values, there is
+    nothing to bound estimates with, and answers are always exact.
+    """
+
+    def __init__(self, raster, levels, value_range=None):
+        self.raster = raster
+        self.levels = levels
+        self.value_range = value_range
+
+    def reduce(self, geom, tolerance=0):
+        """Returns (sum, count, error) of the pixels a polygon covers, where
+        the mean, sum / count, is within error (<= tolerance) of exact."""
+        edges = _edges(geom)
+        empty = (0.0, 0, 0.0)
+        if edges is None:
+            return empty
+        xs, ys = np.concatenate([edges[0], edges[2]]), \
+            np.concatenate([edges[1], edges[3]])
+        window = self.raster.window(xs.min(), ys.min(), xs.max(), ys.max())
+        n_rows = window[0].stop - window[0].start
+        n_cols = window[1].stop - window[1].start
+        if n_rows <= 0 or n_cols <= 0:
+            return empty
+        # start at the coarsest level the polygon spans a few cells of
+        level = int(np.ceil(np.log2(max(n_rows, n_cols))))
+        level = min(max(level, self.levels[0]), self.levels[-1])
+        size = 2 ** level
+        i, j = np.mgrid[
+            window[0].start // size:(window[0].stop - 1) // size + 1,
+            window[1].start // size:(window[1].stop - 1) // size + 1]
+        i, j = i.ravel(), j.ravel()
+        # (cell, edge) pairs that may touch: to begin with, all of them
+        n_edges = len(edges[0])
+        pair_cell = np.repeat(np.arange(len(i)), n_edges)
+        pair_edge = np.tile(np.arange(n_edges), len(i))
+        total, count = 0.0, 0
+        while True:
+            r0, r1, c0, c1 = self._cells(level, i, j)
+            west, south = self.raster.centers(r1, c0)
+            east, north = self.raster.centers(r0, c1)
+            touch = _touches(edges, pair_edge, west[pair_cell],
+                             south[pair_cell], east[pair_cell],
+                             north[pair_cell])
+            pair_cell, pair_edge = pair_cell[touch], pair_edge[touch]
+            split = np.zeros(len(i), dtype=bool)
+            split[pair_cell] = True
+            # a cell no edge touches is wholly inside or outside; its first
+            # pixel says which
+            inside = np.zeros(len(i), dtype=bool)
+            inside[~split] = _contains(self.raster, edges, r0[~split],
+                                       c0[~split])
+            sums, counts = self.totals(level, i[inside], j[inside])
+            total += float(sums.sum())
+            count += int(counts.sum())
+            if not split.any():
+                return total, count, 0.0
+            if tolerance and self.value_range:
+                estimate = self._estimate(level, i[split], j[split], edges,
+                                          total, count, tolerance)
+                if estimate is not None:
+                    return estimate
+            if level == self.levels[0]:
+                break
+            level -= 1
+            # split cells into their children, which inherit their edges
+            parents = np.cumsum(split) - 1
+            i, j, children = _children(i[split], j[split],
+                                       self.level_shape(level))
+            pair_cell = children[parents[pair_cell]].ravel()
+            pair_edge = np.repeat(pair_edge, 4)
+            keep = pair_cell >= 0
+            pair_cell, pair_edge = pair_cell[keep], pair_edge[keep]
+        more_total, more_count = self._resolve(level, i[split], j[split],
+                                               edges)
+        return total + more_total, count + more_count, 0.0
+
+    def totals(self, level, i, j):
+        """Returns arrays of the sums and valid-pixel counts of cells."""
+        raise NotImplementedError
+
+    def level_shape(self, level):
+        """Returns how many rows and columns of cells a level has."""
+        size = 2 ** level
+        rows, cols = self.raster.shape
+        return -(-rows // size), -(-cols // size)
+
+    def _cells(self, level, i, j):
+        """Returns the first and last rows and columns of cells' pixels."""
+        size = 2 ** level
+        rows, cols = self.raster.shape
+        return (i * size, np.minimum((i + 1) * size, rows) - 1,
+                j * size, np.minimum((j + 1) * size, cols) - 1)
+
+    def _estimate(self, level, i, j, edges, total, count, tolerance):
+        """Returns (sum, count, error) counting the undecided cells whose
+        middle pixels are inside, if the mean is then known to within
+        tolerance; otherwise None."""
+        sums, counts = self.totals(level, i, j)
+        undecided = int(counts.sum())
+        low, high = self.value_range
+        if count + undecided == 0:
+            return 0.0, 0, 0.0
+        # the mean with none of the undecided pixels, and with all of them
+        # at either extreme, bound where it can be
+        bounds = [(total + low * undecided) / (count + undecided),
+                  (total + high * undecided) / (count + undecided)]
+        if count:
+            bounds.append(total / count)
+        error = max(bounds) - min(bounds)
+        if error > tolerance:
+            return None
+        r0, r1, c0, c1 = self._cells(level, i, j)
+        centered = _contains(self.raster, edges, (r0 + r1) // 2,
+                             (c0 + c1) // 2)
+        return (total + float(sums[centered].sum()),
+                count + int(counts[centered].sum()), error)
+
+    def _resolve(self, level, i, j, edges):
+        """Returns (sum, count) of the pixels the polygon covers in cells,
+        from the raster."""
+        size = 2 ** level
+        offsets = np.arange(size)
+        rows = (i[:, None, None] * size + offsets[None, :, None] +
+                np.zeros((1, 1, size), dtype=int)).ravel()
+        cols = (j[:, None, None] * size + offsets[None, None, :] +
+                np.zeros((1, size, 1), dtype=int)).ravel()
+        keep = (rows < self.raster.shape[0]) & (cols < self.raster.shape[1])
+        rows, cols = rows[keep], cols[keep]
+        values = np.asarray(self.raster.data[rows, cols])
+        valid = self.raster.valid(values)
+        rows, cols, values = rows[valid], cols[valid], values[valid]
+        inside = _contains(self.raster, edges, rows, cols)
+        values = values[inside].astype(float)
+        return float(values.sum()), int(values.size)
+
+
+class Pyramid(Cells):
+    """The levels of an asset's pyramid, over its (memory mapped) raster."""
+
+    def __init__(self, path, raster):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        super(Pyramid, self).__init__(
+            raster, range(meta['base_level'], meta['top_level'] + 1),
+            (meta['min'], meta['max']))
+        self.sums = {}
+        self.counts = {}
+        for k in self.levels:
+            self.sums[k] = np.load(os.path.join(path, 'sum_%d.npy' % k),
+                                   mmap_mode='r')
+            self.counts[k] = np.load(os.path.join(path, 'count_%d.npy' % k),
+                                     mmap_mode='r')
+
+    def totals(self, level, i, j):
+        return self.sums[level][i, j], self.counts[level][i, j]
+
+
+class Pyramids(object):
+    """Answers /extract polygon queries from the pyramids in a directory."""
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._pyramids = rasters.LocalCopies(self._load)
+
+    def has(self, asset_id):
+        """Returns whether an asset has a pyramid."""
+        return self.pyramid(asset_id) is not None
+
+    def pyramid(self, asset_id):
+        """Returns an asset's Pyramid, or None."""
+        return self._pyramids.get(asset_id)
+
+    def _load(self, asset_id):
+        path = find(self.data_dir, asset_id)
+        return path and Pyramid(
+            path, rasters.load(rasters.find(self.data_dir, asset_id)))
+
+    def clear(self):
+        """Does nothing; pyramids cache nothing but their memory maps."""
+
+    @staticmethod
+    def answers(features, names):
+        """Returns whether pyramids can compute statistics names for every
+        feature, i.e. whether they are all polygons."""
+        return (all(name in STATISTICS for name in names) and
+                all((ft.get('geometry') or {}).get('type') in
+                    ('Polygon', 'MultiPolygon') for ft in features))
+
+    def extract(self, asset_id, features, names, tolerance=0):
+        """Returns reduceRegions-like features for polygon features, with
+        means within tolerance of exact."""
+        pyramid = self.pyramid(asset_id)
+        extracted = []
+        for i, ft in enumerate(features):
+            total, count, _ = pyramid.reduce(ft.get('geometry'), tolerance)
+            reduced = {'sum': total, 'count': count,
+                       'mean': total / count if count else None}
+            properties = dict(ft.get('properties') or {})
+            properties.update((name, reduced[name]) for name in names)
+            extracted.append({'type': 'Feature', 'id': str(i),
+                              'geometry': ft.get('geometry'),
+                              'properties': properties})
+        return extracted
+
+
+def _edges(geom):
+    """Returns (x1, y1, x2, y2, part) arrays of a polygon's edges, where
+    part is which polygon of a MultiPolygon each is part of, or None."""
+    edges = []
+    for part, rings in enumerate(geometry.polygons(geom)):
+        for ring in rings:
+            ring = np.array([p[:2] for p in ring], dtype=float)
+            if len(ring) > 1:
+                edges.append(np.hstack([ring[:-1], ring[1:],
+                                        np.zeros((len(ring) - 1, 1)) + part]))
+    if not edges:
+        return None
+    return tuple(np.vstack(edges).T)
+
+
+def _touches(edges, which, west, south, east, north):
+    """Returns whether edges[which] touch (or cross, or lie in) boxes."""
+    x1, y1, x2, y2 = [e[which] for e in edges[:4]]
+    overlaps = ((np.minimum(x1, x2) <= east) & (np.maximum(x1, x2) >= west) &
+                (np.minimum(y1, y2) <= north) & (np.maximum(y1, y2) >= south))
+    # an overlapping edge misses its box only if all of the box's corners
+    # are strictly on one side of the edge's line
+    sides = [(x2 - x1) * (cy - y1) - (y2 - y1) * (cx - x1)
+             for cx, cy in ((west, south), (west, north), (east, south),
+                            (east, north))]
+    above = (sides[0] > 0) & (sides[1] > 0) & (sides[2] > 0) & (sides[3] > 0)
+    below = (sides[0] < 0) & (sides[1] < 0) & (sides[2] < 0) & (sides[3] < 0)
+    return overlaps & ~above & ~below
+
+
+def _contains(raster, edges, rows, cols):
+    """Returns which pixels' centers are inside a polygon, or any polygon
+    of a MultiPolygon, which may overlap."""
+    rows, cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+    part = edges[4]
+    parts = np.unique(part)
+    if len(parts) == 1:
+        return _contains_part(raster, edges[:4], rows, cols)
+    inside = np.zeros(len(rows), dtype=bool)
+    for which in parts:
+        inside |= _contains_part(
+            raster, [e[part == which] for e in edges[:4]], rows, cols)
+    return inside
+
+
+def _contains_part(raster, edges, rows, cols):
+    """Returns which pixels' centers are inside one polygon, computed just as
+    zonal.rasterize() does: crossings of each pixel row with the edges are
+    found, in (fractional) columns, and a pixel is inside when an odd number
+    of them are strictly to its left and none is exactly at it."""
+    x1, y1, x2, y2 = edges
+    flat = y1 != y2
+    x1, y1, x2, y2 = [e[flat][None, :] for e in (x1, y1, x2, y2)]
+    if not len(rows) or not x1.size:
+        return np.zeros(len(rows), dtype=bool)
+    unique, which = np.unique(rows, return_inverse=True)
+    _, y = raster.centers(unique, 0)
+    y = y[:, None]
+    crosses = (y1 > y) != (y2 > y)
+    row, edge = np.nonzero(crosses)
+    at = (x1[0, edge] + (y[row, 0] - y1[0, edge]) *
+          (x2[0, edge] - x1[0, edge]) / (y2[0, edge] - y1[0, edge]))
+    west, width = raster.transform[0], raster.transform[1]
+    column = (at - west) / width - 0.5
+    # a crossing is strictly left of column c exactly when floor(it) < c;
+    # in integers, so that keys for every row can share one sorted array
+    width_keys = raster.shape[1] + 2
+    left = np.clip(np.floor(column), -1, raster.shape[1]).astype(np.int64)
+    keys = np.sort(row * width_keys + left + 1)
+    exact = np.sort((row * width_keys + left + 1)[column == np.floor(column)])
+    pixels = which * width_keys + cols + 1
+    starts = which * width_keys
+    n_left = (np.searchsorted(keys, pixels - 1, side='right') -
+              np.searchsorted(keys, starts, side='left'))
+    on = (np.searchsorted(exact, pixels, side='right') -
+          np.searchsorted(exact, pixels, side='left')) > 0
+    return (n_left % 2 == 1) & ~on
+
+
+def _children(i, j, shape):
+    """Returns the cells of the next level down that cells i, j split into,
+    leaving out those past the edge of the raster, and for each of i, j the
+    indices of its four children among them (-1 for those left out)."""
+    i = i[:, None] * 2 + np.array([[0, 0, 1, 1]])
+    j = j[:, None] * 2 + np.array([[0, 1, 0, 1]])
+    keep = (i < shape[0]) & (j < shape[1])
+    children = np.zeros(i.shape, dtype=int) - 1
+    children[keep] = np.arange(keep.sum())
+    return i[keep], j[keep], children
+
+
+def find(data_dir, asset_id):
+    """Returns the path of an asset's pyramid, or None. Pyramids are only
+    used alongside the local copy they were made from."""
+    base = rasters.asset_path(data_dir, asset_id)
+    if not rasters.find(data_dir, asset_id):
+        return None
+    found = os.path.exists(os.path.join(base + EXTENSION, 'meta.json'))
+    return base + EXTENSION if found else None
+
+
+def build(raster, path, base_level=BASE_LEVEL):
+    """Writes a raster's pyramid, reading it BUILD_ROWS rows at a time."""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    size = 2 ** base_level
+    rows, cols = raster.shape
+    shape = (-(-rows // size), -(-cols // size))
+    sums = np.lib.format.open_memmap(
+        os.path.join(path, 'sum_%d.npy' % base_level), mode='w+',
+        dtype=np.float64, shape=shape)
+    counts = np.lib.format.open_memmap(
+        os.path.join(path, 'count_%d.npy' % base_level), mode='w+',
+        dtype=np.int64, shape=shape)
+    low, high = np.inf, -np.inf
+    step = max(BUILD_ROWS // size, 1) * size
+    for start in range(0, rows, step):
+        pixels = np.asarray(raster.data[start:start + step])
+        valid = raster.valid(pixels)
+        if valid.any():
+            low = min(low, float(pixels[valid].min()))
+            high = max(high, float(pixels[valid].max()))
+        values = np.where(valid, pixels, 0).astype(np.float64)
+        cells = slice(start // size, start // size + -(-len(pixels) // size))
+        sums[cells] = _sum_cells(values, size)
+        counts[cells] = _sum_cells(valid.astype(np.int64), size)
+    level = base_level
+    while max(sums.shape) > 1:
+        sums, counts = [_write_level(path, name, level + 1,
+                                     _sum_cells(np.asarray(array), 2))
+                        for name, array in (('sum', sums), ('count', counts))]
+        level += 1
+    # the metadata is written last, so find() never sees a partial pyramid
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'base_level': base_level, 'top_level': level,
+                   'min': low if low <= high else 0.0,
+                   'max': high if low <= high else 0.0}, f)
+
+
+def _sum_cells(array, size):
+    """Sums a 2-D array over size x size cells, padding it out with zeros."""
+    rows, cols = array.shape
+    padded = np.zeros((-(-rows // size) * size, -(-cols // size) * size),
+                      dtype=array.dtype)
+    padded[:rows, :cols] = array
+    cells = padded.reshape(padded.shape[0] // size, size,
+                           padded.shape[1] // size, size)
+    return cells.sum(axis=3).sum(axis=1)
+
+
+def _write_level(path, name, level, array):
+    np.save(os.path.join(path, '%s_%d.npy' % (name, level)), array)
+    return array
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Makes the mean pyramid of an asset\'s local copy.')
+    parser.add_argument('data_dir', help='directory of local copies')
+    parser.add_argument('asset_id', help='asset to make a pyramid for')
+    parser.add_argument('--base-level', type=int, default=BASE_LEVEL)
+    args = parser.parse_args()
+    source = rasters.find(args.data_dir, args.asset_id)
+    if source is None:
+        parser.error('no local copy of %s in %s' % (args.asset_id,
+                                                    args.data_dir))
+    path = os.path.join(args.data_dir, *args.asset_id.split('/')) + EXTENSION
+    build(rasters.load(source), path, args.base_level)
+    print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""Local copies of our wetness rasters, as NumPy arrays.
+
+A raster is a 2-D array plus a GDAL-style geotransform
+(west, pixel width, 0, north, 0, -pixel height) in geographic coordinates
+(EPSG:4326), and an optional nodata value. Rasters are stored either as
+GeoTIFFs, which need rasterio or GDAL to read, or as a `.npy` array beside a
+`.json` file holding its transform and nodata value; `.npy` files are memory
+mapped, so opening one costs nothing until its pixels are read.
+
+Local copies of an asset live under a data directory at the asset's ID, e.g.
+<data dir>/users/kyletaylor/shared/LC8dynamicwater.npy.
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+import cache
+
+try:
+    import rasterio
+except ImportError:
+    rasterio = None
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+# File extensions looked for, in order, by find().
+EXTENSIONS = ('.npy', '.tif', '.tiff')
+
+# How many asset IDs without a local copy LocalCopies remembers.
+MAX_MISSING = 1024
+
+
+class Raster(object):
+    """A georeferenced 2-D array."""
+
+    def __init__(self, data, transform, nodata=None):
+        self.data = data
+        self.transform = tuple(float(t) for t in transform)
+        self.nodata = nodata
+        if self.transform[2] or self.transform[4]:
+            raise ValueError('Rotated rasters are not supported')
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def pixel_size(self):
+        """(width, height) of a pixel in degrees."""
+        return self.transform[1], -self.transform[5]
+
+    @property
+    def bounds(self):
+        """(west, south, east, north) in degrees."""
+        west, width, _, north, _, height = self.transform
+        rows, cols = self.shape
+        return west, north + rows * height, west + cols * width, north
+
+    def valid(self, values):
+        """Returns a mask of which values are data (not nodata or NaN)."""
+        valid = ~np.isnan(values) if values.dtype.kind == 'f' else \
+            np.ones(values.shape, dtype=bool)
+        if self.nodata is not None:
+            valid &= values != self.nodata
+        return valid
+
+    def index(self, x, y):
+        """Returns (rows, cols) of the pixels containing points x, y."""
+        west, width, _, north, _, height = self.transform
+        cols = np.floor((np.asarray(x, dtype=float) - west) / width)
+        rows = np.floor((np.asarray(y, dtype=float) - north) / height)
+        return rows.astype(int), cols.astype(int)
+
+    def centers(self, rows, cols):
+        """Returns (x, y) of the centers of pixels at rows, cols."""
+        west, width, _, north, _, height = self.transform
+        return (west + (np.asarray(cols) + 0.5) * width,
+                north + (np.asarray(rows) + 0.5) * height)
+
+    def window(self, west, south, east, north):
+        """Returns (row slice, col slice) of the pixels whose centers may lie
+        within a bounding box, clipped to the raster."""
+        rows, cols = self.index([west, east], [north, south])
+        n_rows, n_cols = self.shape
+        return (slice(max(rows[0], 0), min(rows[1] + 1, n_rows)),
+                slice(max(cols[0], 0), min(cols[1] + 1, n_cols)))
+
+
+class LocalCopies(object):
+    """Whatever load(asset_id) makes of assets' local copies, by asset ID.
+
+    load returns None for an asset without a local copy. What it returns
+    otherwise is kept; of the IDs it has nothing for, only the last
+    max_missing are remembered, since they come from requests.
+    """
+
+    def __init__(self, load, max_missing=MAX_MISSING):
+        self._load = load
+        self._loaded = {}
+        self._missing = cache.LRUCache(max_missing)
+        self._lock = threading.Lock()
+
+    def get(self, asset_id):
+        """Returns what an asset's local copy loads as, or None."""
+        with self._lock:
+            if asset_id in self._loaded:
+                return self._loaded[asset_id]
+            if self._missing.get(asset_id):
+                return None
+            loaded = self._load(asset_id)
+            if loaded is None:
+                self._missing.set(asset_id, True)
+            else:
+                self._loaded[asset_id] = loaded
+            return loaded
+
+
+def asset_path(data_dir, asset_id):
+    """Returns the path of an asset's local copies under data_dir, less
+    their extension, or None if the ID could name a path outside it (it
+    has empty, '.' or '..' segments)."""
+    segments = asset_id.split('/')
+    if '\0' in asset_id or not all(
+            segment and segment not in ('.', '..') for segment in segments):
+        return None
+    return os.path.join(data_dir, *segments)
+
+
+def find(data_dir, asset_id):
+    """Returns the path of an asset's local copy, or None."""
+    base = asset_path(data_dir, asset_id)
+    if base is None:
+        return None
+    for extension in EXTENSIONS:
+        if os.path.exists(base + extension):
+            return base + extension
+    return None
+
+
+def load(path, mmap=True):
+    """Loads a .npy (with its .json sidecar) or GeoTIFF raster."""
+    if path.endswith('.npy'):
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            meta = json.load(f)
+        data = np.load(path, mmap_mode='r' if mmap else None)
+        return Raster(data, meta['transform'], meta.get('nodata'))
+    return _load_geotiff(path)
+
+
+def save(path, raster):
+    """Saves a raster as a .npy file and its .json sidecar."""
+    np.save(path, np.asarray(raster.data))
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump({'transform': list(raster.transform),
+                   'nodata': raster.nodata}, f)
+
+
+def _load_geotiff(path):
+    if rasterio is not None:
+        with rasterio.open(path) as dataset:
+            return Raster(dataset.read(1), dataset.transform.to_gdal(),
+                          dataset.nodata)
+    if gdal is not None:
+        dataset = gdal.Open(path)
+        band = dataset.GetRasterBand(1)
+        return Raster(band.ReadAsArray(), dataset.GetGeoTransform(),
+                      band.GetNoDataValue())
+    raise ImportError('Reading GeoTIFFs needs rasterio or GDAL (osgeo.gdal); '
+                      'or convert %s to .npy' % path)
+
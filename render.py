@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""Map tiles rendered from local copies of our rasters, without Earth Engine.
+
+The map's layers are drawn by EE from GetTrendyMapId: each asset masked to
+its wet pixels (>= the wet threshold) and stretched from min to max over a
+palette, at some opacity. TileRenderer draws the same thing from an asset's
+(memory mapped) local copy, see rasters.py, for the standard XYZ Web
+Mercator tiles of 256 x 256 pixels the client asks for.
+
+A layer's visualization is precomputed into a 256-entry color table: entry
+0 is transparent, for masked pixels and those off the raster, and entries
+1-255 step evenly through the palette from min to max. A tile then samples
+the raster at the center of each of its pixels (nearest neighbor: each
+row of the tile falls on one raster row and each column on one raster
+column, so it is a single outer-indexed read), turns the values into table
+indices with NumPy, and is written out as an 8-bit palette PNG by the small
+encoder below. Rendered tiles are kept in an LRU cache of PNG bytes per
+(layer, z, x, y).
+"""
+import math
+import struct
+import zlib
+
+import numpy as np
+
+import cache
+import rasters
+
+# Edge of a tile, in pixels.
+TILE_SIZE = 256
+
+# Deepest zoom level rendered.
+MAX_ZOOM = 22
+
+# How far north and south Web Mercator goes, in degrees.
+MAX_LATITUDE = 85.0511287798
+
+
+class TileRenderer(object):
+    """Renders map layers from the local copies of assets in a directory.
+
+    layers maps layer names to (asset ID, visualization options), with the
+    options getMapId takes (min, max, palette and opacity). Up to
+    max_cache_bytes of PNGs are cached.
+    """
+
+    def __init__(self, data_dir, layers, wet_threshold,
+                 max_cache_bytes=64 * 1024 * 1024):
+        self.data_dir = data_dir
+        self.layers = layers
+        self.wet_threshold = wet_threshold
+        self._tables = dict((name, color_table(options))
+                            for name, (_, options) in layers.items())
+        self._rasters = rasters.LocalCopies(self._load)
+        self._tiles = cache.LRUCache(max_cache_bytes, weigher=len)
+
+    def has(self, layer):
+        """Returns whether a layer's asset has a local copy."""
+        return layer in self.layers and self.raster(layer) is not None
+
+    def raster(self, layer):
+        """Returns a layer's (memory mapped) local copy, or None."""
+        return self._rasters.get(self.layers[layer][0])
+
+    def _load(self, asset_id):
+        path = rasters.find(self.data_dir, asset_id)
+        return path and rasters.load(path)
+
+    def clear(self):
+        """Forgets every cached tile."""
+        self._tiles.clear()
+
+    def tile(self, layer, z, x, y):
+        """Returns the PNG of a tile, or None if there is no such tile or
+        the layer has no local copy."""
+        if not self.has(layer) or not 0 <= z <= MAX_ZOOM or \
+                not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            return None
+        key = (layer, z, x, y)
+        png = self._tiles.get(key)
+        if png is None:
+            png = encode_png(self.render(layer, z, x, y),
+                             *self._tables[layer])
+            self._tiles.set(key, png)
+        return png
+
+    def render(self, layer, z, x, y):
+        """Returns a tile as a 2-D array of indices into its color table."""
+        raster = self.raster(layer)
+        options = self.layers[layer][1]
+        lon, lat = tile_centers(z, x, y)
+        rows, _ = raster.index(np.zeros(len(lat)), lat)
+        _, cols = raster.index(lon, np.zeros(len(lon)))
+        n_rows, n_cols = raster.shape
+        row_in = (rows >= 0) & (rows < n_rows)
+        col_in = (cols >= 0) & (cols < n_cols)
+        indices = np.zeros((TILE_SIZE, TILE_SIZE), dtype=np.uint8)
+        if not row_in.any() or not col_in.any():
+            return indices
+        values = np.asarray(raster.data[np.ix_(rows[row_in], cols[col_in])])
+        shown = raster.valid(values)
+        shown[shown] = values[shown] >= self.wet_threshold
+        low, high = float(options['min']), float(options['max'])
+        scaled = (values.astype(float) - low) / ((high - low) or 1.0)
+        scaled = np.clip(np.where(shown, scaled, 0), 0, 1)
+        window = (1 + np.round(scaled * 254)).astype(np.uint8)
+        window[~shown] = 0
+        indices[np.ix_(row_in, col_in)] = window
+        return indices
+
+
+def tile_centers(z, x, y):
+    """Returns (longitudes, latitudes) of the centers of the columns and
+    rows of pixels of an XYZ tile."""
+    steps = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    n = 2.0 ** z
+    lon = (x + steps) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * (y + steps) / n))))
+    return lon, np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE)
+
+
+def color_table(options):
+    """Returns (colors, alphas), the 256 RGB colors and alphas of a
+    visualization: transparent first, then min to max along its palette."""
+    palette = str(options.get('palette', '000000, ffffff')).split(',')
+    palette = [p.strip().lstrip('#') for p in palette]
+    stops = np.array([[int(p[i:i + 2], 16) for i in (0, 2, 4)]
+                      for p in palette], dtype=float)
+    # where each of entries 1-255 falls along the palette
+    at = np.linspace(0, len(stops) - 1, 255)
+    colors = np.zeros((256, 3), dtype=np.uint8)
+    for channel in range(3):
+        colors[1:, channel] = np.round(np.interp(
+            at, np.arange(len(stops)), stops[:, channel]))
+    alphas = np.zeros(256, dtype=np.uint8)
+    alphas[1:] = int(round(255 * float(options.get('opacity', 1))))
+    return colors, alphas
+
+
+def encode_png(indices, colors, alphas):
+    """Returns an 8-bit palette PNG of a 2-D array of color table indices."""
+    height, width = indices.shape
+    # every row is preceded by its filter type, 0 (none)
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = indices
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0)),
+        _chunk(b'PLTE', colors.tobytes()),
+        _chunk(b'tRNS', alphas.tobytes()),
+        _chunk(b'IDAT', zlib.compress(rows.tobytes())),
+        _chunk(b'IEND', b''),
+    ])
+
+
+def _chunk(kind, data):
+    return b''.join([struct.pack('>I', len(data)), kind, data,
+                     struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)])
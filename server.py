@@ -33,6 +33,9 @@ into the index.html template through a templating engine called Jinja2,
 which puts information from the Python context into the HTML for the user's
 browser to receive.
 
+Map IDs and their tokens are cached (see cache.py), so a warm page load
+never waits on Earth Engine.
+
 Note: The polygon IDs are determined by looking at the static/polygons
 folder. To add support for another polygon, just add another GeoJSON file to
 that folder.
@@ -61,49 +64,192 @@ requests more quickly.
 import os
 import lzstring
 import json
+import logging
 import math
 
+# EE_BACKEND=fake swaps Earth Engine for a local stand-in over NumPy rasters,
+# for working offline and load testing (see fake_ee/__init__.py).
+if os.environ.get('EE_BACKEND') == 'fake':
+  import fake_ee
+  fake_ee.install()
+
+import cache
 import config
+import geometry
+import graphs
+import metrics
+import payloads
+import tileproxy
+import workers
 import ee
 import jinja2
 import webapp2
 
-from google.appengine.api import memcache
+try:
+  from google.appengine.api import memcache
+except ImportError:
+  # off App Engine map IDs are only cached in-process
+  memcache = None
 
 ###############################################################################
 #                             Web request handlers.                           #
 ###############################################################################
 
 
-class MainHandler(webapp2.RequestHandler):
+class TimedHandler(webapp2.RequestHandler):
+  """A handler whose requests are timed by stage (see metrics.py).
+
+  Stage timings go into metrics.REGISTRY under the handler's METRIC_NAME and
+  back to the client in a Server-Timing header.
+  """
+
+  METRIC_NAME = 'request'
+
+  def initialize(self, request, response):
+    super(TimedHandler, self).initialize(request, response)
+    self.timer = metrics.RequestTimer(self.METRIC_NAME)
+    self._streaming = False
+
+  def dispatch(self):
+    try:
+      super(TimedHandler, self).dispatch()
+    finally:
+      if self._streaming:
+        # only the stages before the first byte make it into the header;
+        # the rest are recorded when the stream ends
+        self.response.headers['Server-Timing'] = self.timer.server_timing()
+      else:
+        self.response.headers['Server-Timing'] = self.timer.finish()
+
+  def stream(self, pieces):
+    """Returns pieces as a response body, recording the request's stages
+    once they have all been written out (or the client has gone)."""
+    self._streaming = True
+    return self._finish_after(pieces)
+
+  def _finish_after(self, pieces):
+    try:
+      for piece in pieces:
+        yield piece
+    finally:
+      self.timer.finish()
+
+
+class MainHandler(TimedHandler):
   """A servlet to handle requests to load the main Trendy Lights web page."""
 
+  METRIC_NAME = 'main'
+
   def get(self, path=''):
     """Returns the main web page, populated with EE map and polygon info."""
-    historicalMapId = GetTrendyMapId(HISTORICAL_IMAGE_COLLECTION_ID)
-    mostRecentMapId = GetTrendyMapId(MOST_RECENT_IMAGE_COLLECTION_ID, options = {
-        'min': '0',
-        'max': '1',
-        'palette' : 'edf8b1, 081d58',
-        'opacity' : '0.95',
-    })
-
-    template_values = {
-        'historicalEeMapId': historicalMapId['mapid'],
-        'mostRecentEeMapId': mostRecentMapId['mapid'],
-        'historicalEeToken': historicalMapId['token'],
-        'mostRecentEeToken': mostRecentMapId['token']
-    }
-    template = JINJA2_ENVIRONMENT.get_template('index.html')
-    self.response.out.write(template.render(template_values))
-
-class BackendFeatureCollectionHandler(webapp2.RequestHandler):
+    # layers with local copies are drawn by LocalTileHandler instead of EE
+    local = [layer for layer in MAP_LAYERS
+             if TILE_RENDERER is not None and TILE_RENDERER.has(layer[0])]
+    with self.timer.stage('mapids'):
+      map_ids = GetMapIds([layer for layer in MAP_LAYERS
+                           if layer not in local])
+
+    template_values = {}
+    for name, map_id in map_ids.items():
+      template_values[name + 'EeMapId'] = map_id['mapid']
+      template_values[name + 'EeToken'] = map_id['token']
+    # the client fetches tiles from us if they are rendered locally or EE's
+    # are proxied through the tile cache, and from EE with the map ID if not
+    for layer in MAP_LAYERS:
+      if layer in local:
+        template_values[layer[0] + 'TileUrl'] = '/localtiles/' + layer[0]
+      elif PROXY_EE_TILES:
+        template_values[layer[0] + 'TileUrl'] = '/tiles/' + layer[0]
+      else:
+        template_values[layer[0] + 'TileUrl'] = ''
+    with self.timer.stage('render'):
+      template = JINJA2_ENVIRONMENT.get_template('index.html')
+      page = template.render(template_values)
+    self.timer.size('response_bytes', len(page))
+    self.response.out.write(page)
+
+
+class LocalTileHandler(TimedHandler):
+  """Serves map tiles rendered from local copies of assets (see render.py),
+  as /localtiles/<layer>/<z>/<x>/<y>[.png]."""
+
+  METRIC_NAME = 'localtiles'
+
+  def get(self, layer, z, x, y):
+    """Returns a tile's PNG, or 404 if it has no local copy."""
+    png = None
+    if TILE_RENDERER is not None:
+      with self.timer.stage('render'):
+        png = TILE_RENDERER.tile(layer, int(z), int(x), int(y))
+    if png is None:
+      self.response.set_status(404)
+      return
+    self.timer.size('response_bytes', len(png))
+    self.response.headers['Content-Type'] = 'image/png'
+    self.response.headers['Cache-Control'] = 'public, max-age=%d' % (
+        LOCAL_TILE_MAX_AGE)
+    self.response.out.write(png)
+
+
+class TileHandler(TimedHandler):
+  """Serves EE map tiles through a cache (see tileproxy.py), as
+  /tiles/<layer>/<z>/<x>/<y>[.png]."""
+
+  METRIC_NAME = 'tiles'
+
+  def get(self, layer, z, x, y):
+    """Returns a tile, from the cache or else from EE."""
+    asset_id, options = MapLayer(layer)
+    z, x, y = int(z), int(x), int(y)
+    if (asset_id is None or z > TILE_MAX_ZOOM or
+        not (x < 2 ** z and y < 2 ** z)):
+      self.response.set_status(404)
+      return
+    try:
+      with self.timer.stage('version'):
+        key = tileproxy.TileCache.key(
+            asset_id, GetAssetVersion(asset_id), options, z, x, y)
+      with self.timer.stage('cache'):
+        tile = TILE_CACHE.get(key)
+      if tile is None:
+        tile = self.fetch(asset_id, options, z, x, y)
+        TILE_CACHE.set(key, tile)
+    except (ee.EEException, tileproxy.UpstreamError) as e:
+      logging.warning('Failed to get tile %s/%d/%d/%d: %s', layer, z, x, y, e)
+      self.response.set_status(502)
+      return
+    self.timer.size('response_bytes', len(tile))
+    self.response.headers['Content-Type'] = tileproxy.content_type(tile)
+    self.response.headers['Cache-Control'] = 'public, max-age=%d' % (
+        TILE_MAX_AGE)
+    self.response.out.write(tile)
+
+  def fetch(self, asset_id, options, z, x, y):
+    """Returns a tile fetched from EE with the asset's current map ID."""
+    with self.timer.stage('mapid'):
+      map_id = GetCachedMapId(asset_id, options)
+    with self.timer.stage('upstream'):
+      status, tile = EE_TILES.get('/map/%s/%d/%d/%d?token=%s' % (
+          map_id['mapid'], z, x, y, map_id['token']))
+    if status != 200:
+      raise tileproxy.UpstreamError('EE returned %d' % status)
+    return tile
+
+
+class BackendFeatureCollectionHandler(TimedHandler):
     """Accepts geojson input for feature collection passed by the user from the GUI that is then used to
      do things on the backend like extracting values and generating plots"""
 
+    METRIC_NAME = 'extract'
+
     def __init__(self, request, response):
         self._ASSET = None
         self._ASSET_ID = None
+        self._ASSET_IDS = []
+        self._REDUCERS = list(DEFAULT_REDUCERS)
+        self._TOLERANCE = 0
+        self._FEATURES = None
+        self._SIMPLIFIED_FEATURES = None
         self._FEATURE_COLLECTION = None
         # initialize our super
         self.initialize(request, response)
@@ -113,11 +259,14 @@ class BackendFeatureCollectionHandler(webapp2.RequestHandler):
             fc = self._FEATURE_COLLECTION
         else:
             fc = args[0]
-        # force json string formatting
-        fc = json.dumps(fc)
-        # decompress
-        fc = lzstring.LZString().\
-            decompressFromEncodedURIComponent(args[0])
+        # the client packs the same few strings over and over
+        return MemoizedDecode(('lzstring', fc), lambda: self._unpack_zlib(fc))
+
+    def _unpack_zlib(self, fc):
+        # decompress, giving up on anything that expands past our limits
+        fc = payloads.decode_lzstring(
+            fc, MAX_EXTRACT_DECODED_BYTES, MAX_LZSTRING_DICTIONARY,
+            expect_json=False)
         # unpack any lurking JS bug-a-boos
         fc = fc.encode("utf-8")
         fc = fc.replace('\'', '"')
@@ -139,21 +288,39 @@ class BackendFeatureCollectionHandler(webapp2.RequestHandler):
         else:
             fc = args[0]
         if type(fc) is not ee.FeatureCollection:
-            # accept a string passed by client using the assetId=
-            # signifier -- throw it at json.loads and see if it raises
-            # any strange errors
-            try:
-                fc = json.loads(fc)
-            except TypeError as e:
-                fc = json.dumps(fc)
-                fc = json.loads(fc)
+            self.load_features(fc)
             # listcomp as ee.Feature() and assign all features to a single FeatureCollection
-            features = [ee.Feature(ft) for ft in fc['features']]
+            features = [ee.Feature(ft)
+                        for ft in self._SIMPLIFIED_FEATURES['features']]
             fc = ee.FeatureCollection(features)
         return fc
 
+    def load_features(self, fc):
+        # accept a string passed by client using the assetId=
+        # signifier -- throw it at json.loads and see if it raises
+        # any strange errors
+        try:
+            fc = json.loads(fc)
+        except TypeError as e:
+            fc = json.dumps(fc)
+            fc = json.loads(fc)
+        geometry.check_features(fc)
+        # keep the GeoJSON as sent around for our response, and send
+        # EE only as much geometry as our rasters can resolve
+        self._FEATURES = fc
+        self._SIMPLIFIED_FEATURES = geometry.simplify_features(
+            fc, COORDINATE_PRECISION,
+            geometry.pixel_tolerance(ExtractionPixelSize(self._ASSET_IDS)))
+        # /extract encodes the GeoJSON itself (see graphs.py); the
+        # ee.FeatureCollection is only built if someone asks for it
+        self._FEATURE_COLLECTION = None
+
     @property
     def feature_collection(self):
+        if self._FEATURE_COLLECTION is None and self._SIMPLIFIED_FEATURES:
+            self._FEATURE_COLLECTION = ee.FeatureCollection(
+                [ee.Feature(ft)
+                 for ft in self._SIMPLIFIED_FEATURES['features']])
         return self._FEATURE_COLLECTION
 
     @feature_collection.setter
@@ -161,14 +328,11 @@ class BackendFeatureCollectionHandler(webapp2.RequestHandler):
         # assign parameters for our extraction if provided
         fc = args[0] if args[0] else self._FEATURE_COLLECTION
         try:
-            json.loads(fc)
-            fc = self.json_to_feature_collection(fc)
+            self.load_features(fc)
         except ValueError as e:
             # if we couldn't make a dict out of the string, assume it's
             # it's a zlib-compressed string and unpack it
-            fc = self.unpack_zlib(fc)
-            fc = self.json_to_feature_collection(fc)
-        self._FEATURE_COLLECTION = fc
+            self.load_features(self.unpack_zlib(fc))
 
     @property
     def asset(self):
@@ -177,32 +341,315 @@ class BackendFeatureCollectionHandler(webapp2.RequestHandler):
     @asset.setter
     def asset(self, *args):
         self._ASSET_ID = self.unpack_zlib(args[0]) if args[0] else self._ASSET_ID
+        self._ASSET_IDS = [self._ASSET_ID]
         # load our asset by id
-        self._ASSET = ee.Image(self._ASSET_ID)
+        self._ASSET = AssetImage(self._ASSET_ID)
+
+    @property
+    def assets(self):
+        return self._ASSET_IDS
+
+    @assets.setter
+    def assets(self, *args):
+        # accept repeated and/or comma-separated assetId= parameters
+        asset_ids = []
+        for packed in args[0]:
+            for asset_id in packed.split(','):
+                # asset ids always have a '/', which lzstring never emits
+                if asset_id and '/' not in asset_id:
+                    asset_id = self.unpack_zlib(asset_id)
+                if asset_id and asset_id not in asset_ids:
+                    asset_ids.append(asset_id)
+        self._ASSET_IDS = asset_ids
+        self._ASSET_ID = asset_ids[0] if asset_ids else self._ASSET_ID
+        self._ASSET = AssetImage(self._ASSET_ID)
+
+    @property
+    def reducers(self):
+        return self._REDUCERS
+
+    @reducers.setter
+    def reducers(self, *args):
+        # accept comma-separated reducers=mean,stdDev,... parameters
+        self._REDUCERS = ParseReducers(args[0])
+
+    @property
+    def tolerance(self):
+        return self._TOLERANCE
+
+    @tolerance.setter
+    def tolerance(self, *args):
+        # tolerance=0.005 accepts means within 0.005 of exact, where that
+        # can be answered more quickly (see pyramid.py)
+        self._TOLERANCE = ParseTolerance(args[0])
 
     def extract(self):
-        result = self._ASSET.reduceRegions(
-          self.feature_collection, ee.Reducer.mean()).getInfo()
-        extractions = [ft for ft in result['features']]
-        return(extractions)
+        """Returns {asset id: reduceRegions features} for all of our assets."""
+        n = len(self._FEATURES['features'])
+        extractions = dict((asset_id, [None] * n)
+                           for asset_id in self._ASSET_IDS)
+        for asset_id, indices, features in self.iter_extractions():
+            for i, ft in zip(indices, features):
+                extractions[asset_id][i] = ft
+        return extractions
+
+    def iter_extractions(self):
+        """Yields (asset id, feature indices, reduceRegions features) for all
+        of our assets, a chunk at a time as chunks complete.
+
+        Assets that aren't cached are band-stacked into a single image and
+        all of our reducers are combined into one, so that every statistic
+        for every asset comes back from one EE round trip (per chunk). Assets
+        with a local copy under ZONAL_DATA_DIR are reduced in-process by
+        zonal.py instead, on their own grid, without using any EE quota.
+        Collections of points, or of rectangles, are answered from an
+        asset's tile store or summed-area tables under TILE_STORE_DIR where
+        it has them (see tilestore.py and integral.py), and the sum, count
+        or mean of polygons from its mean pyramid (see pyramid.py) --
+        to within our tolerance, if we have one.
+        """
+        scale = ExtractionScale(self._ASSET_IDS)
+        keys = dict((asset_id, geometry.canonical_key(
+            asset_id, self._SIMPLIFIED_FEATURES, self._REDUCERS, scale,
+            tolerance=self._TOLERANCE))
+            for asset_id in self._ASSET_IDS)
+        everything = list(range(len(self._FEATURES['features'])))
+        # repeat queries for the same asset and geometry skip EE entirely
+        missing = []
+        for asset_id in self._ASSET_IDS:
+            extractions = EXTRACTION_CACHE.get(keys[asset_id])
+            if extractions is None:
+                missing.append(asset_id)
+            else:
+                yield asset_id, everything, self.restamp(extractions,
+                                                         everything)
+        # assets with local copies are reduced here rather than by EE
+        features = self._SIMPLIFIED_FEATURES['features']
+        local = []
+        for asset_id in missing:
+            stage, backend = LocalBackend(asset_id, features, self._REDUCERS)
+            if backend is None:
+                continue
+            local.append(asset_id)
+            with self.timer.stage(stage):
+                if backend is PYRAMIDS:
+                    extractions = backend.extract(
+                        asset_id, features, self._REDUCERS, self._TOLERANCE)
+                else:
+                    extractions = backend.extract(asset_id, features,
+                                                  self._REDUCERS)
+            if len(everything) <= EXTRACTION_CACHE_MAX_FEATURES:
+                EXTRACTION_CACHE.set(keys[asset_id],
+                                     StripGeometries(extractions))
+            yield asset_id, everything, self.restamp(extractions, everything)
+        missing = [asset_id for asset_id in missing if asset_id not in local]
+        if not missing:
+            return
+        with self.timer.stage('graph'):
+            graph = GetReduceRegionsGraph(missing, self._REDUCERS, scale)
+        renames, reduced = ReducedProperties(len(missing), self._REDUCERS)
+        # collections too big for our result cache aren't collected for it
+        collected = None
+        if len(everything) <= EXTRACTION_CACHE_MAX_FEATURES:
+            collected = dict((asset_id, [None] * len(everything))
+                             for asset_id in missing)
+        for indices, features in self.iter_reduce_regions(graph):
+            for asset_id, rename in zip(missing, renames):
+                extractions = UnstackFeatures(features, rename, reduced)
+                if collected is not None:
+                    for i, ft in zip(indices, StripGeometries(extractions)):
+                        collected[asset_id][i] = ft
+                yield asset_id, indices, self.restamp(extractions, indices)
+        if collected is not None:
+            for asset_id in missing:
+                EXTRACTION_CACHE.set(keys[asset_id], collected[asset_id])
+
+    def iter_reduce_regions(self, graph):
+        """Yields (feature indices, reduceRegions features) for all of our
+        features, given a graphs.ReduceRegionsGraph.
+
+        Large collections are partitioned into spatially coherent chunks
+        that are reduced concurrently, each with its own retries, and
+        yielded as they complete.
+        """
+        features = self._SIMPLIFIED_FEATURES['features']
+        chunks = geometry.partition_features(
+            features, EXTRACT_CHUNK_VERTICES, EXTRACT_CHUNK_AREA)
+        if len(chunks) < 2:
+            yield list(range(len(features))), \
+                self.get_value(self.serialize(graph, features))['features']
+            return
+
+        def reduce_chunk(chunk):
+            serialized = self.serialize(graph, [features[i] for i in chunk])
+            return workers.retry(
+                lambda: self.get_value(serialized),
+                attempts=EXTRACT_CHUNK_ATTEMPTS,
+                retry_on=(ee.EEException,))['features']
+
+        for chunk, result in workers.imap_unordered(
+                reduce_chunk, chunks, max_workers=EXTRACT_WORKERS,
+                max_buffered=EXTRACT_STREAM_BUFFER):
+            yield chunk, result
+
+    def serialize(self, graph, features):
+        with self.timer.stage('serialize'):
+            return graph.serialize(features)
+
+    def get_value(self, serialized):
+        with self.timer.stage('ee'):
+            return graphs.get_value(serialized)
+
+    def restamp(self, extractions, indices):
+        return RestampFeatures(
+            extractions, [self._FEATURES['features'][i] for i in indices])
 
     def get(self):
-        """default get handler for /extract?features=..."""
+        """default get handler for /extract?features=...&assetId=..."""
         # assign parameters for our extraction if provided
-        self.asset = self.request.get('assetId')
-        self.feature_collection = self.request.get('features')
+        try:
+            self.assets = self.request.get_all('assetId')
+            self.reducers = self.request.get('reducers')
+            self.tolerance = self.request.get('tolerance')
+            # features are lzstring text unless marked as encoding=json or
+            # encoding=deflate (base64url)
+            packed = self.request.get('features')
+            encoding = self.request.get('encoding')
+            self.timer.size('request_bytes', len(packed))
+            with self.timer.stage('decode'):
+                features = MemoizedDecode(
+                    ('features', encoding, packed),
+                    lambda: payloads.decode_query_features(
+                        packed, encoding,
+                        max_decoded_bytes=MAX_EXTRACT_DECODED_BYTES,
+                        max_dictionary_size=MAX_LZSTRING_DICTIONARY))
+        except payloads.PayloadTooLarge as e:
+            return self.write_error(413, str(e))
+        except ValueError as e:
+            return self.write_error(400, str(e))
+        # already decoded as encoding= says, so no lzstring fallback here
+        try:
+            with self.timer.stage('parse'):
+                self.load_features(features)
+        except ValueError as e:
+            return self.write_error(400, 'features is not GeoJSON: %s' % e)
+        self.write_extractions()
+
+    def post(self):
+        """post handler for /extract?assetId=... with the features as the
+        request body -- for collections too large for a query string"""
+        # only look at the query string; the body is ours to stream
+        try:
+            self.assets = self.request.GET.getall('assetId')
+            self.reducers = self.request.GET.get('reducers')
+            self.tolerance = self.request.GET.get('tolerance')
+        except payloads.PayloadTooLarge as e:
+            return self.write_error(413, str(e))
+        except ValueError as e:
+            return self.write_error(400, str(e))
+        if self.request.headers.get('Content-Length'):
+            self.timer.size('request_bytes',
+                            int(self.request.headers['Content-Length']))
+        try:
+            with self.timer.stage('decode'):
+                fc = payloads.read_body(
+                    self.request.body_file,
+                    content_encoding=self.request.headers.get(
+                        'Content-Encoding'),
+                    content_length=self.request.headers.get('Content-Length'),
+                    max_bytes=MAX_EXTRACT_BODY_BYTES,
+                    max_decoded_bytes=MAX_EXTRACT_DECODED_BYTES,
+                    max_dictionary_size=MAX_LZSTRING_DICTIONARY)
+        except payloads.PayloadTooLarge as e:
+            return self.write_error(413, str(e))
+        except payloads.PayloadError as e:
+            return self.write_error(400, str(e))
+        try:
+            with self.timer.stage('parse'):
+                self.load_features(fc)
+        except ValueError as e:
+            return self.write_error(400, 'Request body is not GeoJSON: %s' % e)
+        self.write_extractions()
+
+    def write_extractions(self):
+        # plain JSON responses are compressed as negotiated; lzstring ones
+        # are left alone for older clients
+        content_encoding = None
+        if self.wants_ndjson() or self.wants_json():
+            content_encoding = payloads.negotiate_encoding(
+                self.request.headers.get('Accept-Encoding'))
+            self.response.headers['Vary'] = 'Accept-Encoding'
+            if content_encoding:
+                self.response.headers['Content-Encoding'] = content_encoding
+        if self.wants_ndjson():
+            self.response.headers['Content-Type'] = 'application/x-ndjson'
+            self.response.app_iter = self.stream(payloads.iter_encode(
+                self.iter_ndjson(), content_encoding))
+            return
         # process request
         values = self.extract()
-        values = self.pack_zlib(values)
+        # a single asset gets the original list-of-features response, many
+        # assets get those lists keyed by asset id
+        if len(self._ASSET_IDS) == 1:
+            values = values[self._ASSET_ID]
+        with self.timer.stage('encode'):
+            if self.wants_json():
+                content_type = 'application/json'
+                values = payloads.encode(json.dumps(values), content_encoding)
+            else:
+                content_type = 'text'
+                values = self.pack_zlib(values)
+        self.timer.size('response_bytes', len(values))
         # standard handlers for response
-        self.response.headers['Content-Type'] = 'text'
+        self.response.headers['Content-Type'] = content_type
         self.response.out.write(values)
 
+    def wants_json(self):
+        return (self.request.GET.get('format') == 'json' or
+                'application/json' in self.request.headers.get('Accept', ''))
+
+    def wants_ndjson(self):
+        return (self.request.GET.get('format') == 'ndjson' or
+                'application/x-ndjson' in
+                self.request.headers.get('Accept', ''))
+
+    def iter_ndjson(self):
+        """Yields one line of JSON per extracted feature as chunks complete.
+
+        Lines come in completion order rather than fid order. When several
+        assets are extracted each feature names its asset in an assetId
+        member.
+        """
+        for asset_id, indices, features in self.iter_extractions():
+            for ft in features:
+                if len(self._ASSET_IDS) > 1:
+                    ft = dict(ft, assetId=asset_id)
+                yield json.dumps(ft) + '\n'
+
+    def write_error(self, status, message):
+        self.response.set_status(status)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps({'error': message}))
+
+
+class MetricsHandler(webapp2.RequestHandler):
+    """Reports this instance's request metrics (see metrics.py) as JSON."""
+
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps({
+            'instance': os.environ.get('INSTANCE_ID'),
+            'metrics': metrics.REGISTRY.snapshot(),
+        }, sort_keys=True))
+
 # Define webapp2 routing from URL paths to web request handlers. See:
 # http://webapp-improved.appspot.com/tutorials/quickstart.html
 app = webapp2.WSGIApplication(routes=[
     (r'/', MainHandler),
-    (r'/extract', BackendFeatureCollectionHandler)
+    (r'/extract', BackendFeatureCollectionHandler),
+    (r'/localtiles/(\w+)/(\d+)/(\d+)/(\d+)(?:\.png)?', LocalTileHandler),
+    (r'/tiles/(\w+)/(\d+)/(\d+)/(\d+)(?:\.png)?', TileHandler),
+    (r'/metrics', MetricsHandler)
 ], debug=False)
 
 
@@ -215,16 +662,321 @@ def GetTrendyMapId(image_collection_id, options=None):
   """Returns the MapID for the night-time lights trend map."""
   # if no pallet options were specified, assume some sane defaults
   if (options == None):
-      options = {
-        'min': '0.199',
-        'max' : '1',
-        'palette' : 'edf8b1, c7e9b4, 7fcdbb, 41b6c4, 1d91c0, 225ea8, 253494, 081d58',
-        'opacity' : '0.95',
-      }
-  collection = ee.Image(image_collection_id);
-  collection = collection.updateMask(collection.gte(0.199))
+      options = DEFAULT_MAP_OPTIONS
+  return GetWetMapGraph(image_collection_id).get_map_id(options)
+
+
+def GetWetMapGraph(image_collection_id):
+  """Returns the serialized graph of an asset masked to its wet pixels."""
+  key = ('wet-map', image_collection_id)
+  graph = GRAPH_CACHE.get(key)
+  if graph is None:
+    collection = AssetImage(image_collection_id)
+    collection = collection.updateMask(collection.gte(WET_THRESHOLD))
+    graph = graphs.MapIdGraph(collection)
+    GRAPH_CACHE.set(key, graph)
+  return graph
+
+
+def GetCachedMapId(image_collection_id, options=None):
+  """Returns a cached MapID, only calling GetTrendyMapId when it's stale."""
+  if (options == None):
+      options = DEFAULT_MAP_OPTIONS
+  return MAPID_CACHE.get(image_collection_id, options)
+
+
+def GetMapIds(layers, deadline=None):
+  """Returns {layer name: MapID} for (name, asset ID, options) layers.
+
+  Layers that aren't cached are minted concurrently. A layer that misses the
+  deadline falls back to its last known good MapID, and only waits for the
+  mint to finish if it has never been minted before. On App Engine, where a
+  mint can't be left to finish after the request, there is no deadline (see
+  workers.py): only failed mints fall back.
+  """
+  if (deadline == None):
+      deadline = MAPID_DEADLINE
+  map_ids = {}
+  missing = []
+  for name, image_collection_id, options in layers:
+    options = DEFAULT_MAP_OPTIONS if options == None else options
+    map_id = MAPID_CACHE.cached(image_collection_id, options)
+    if map_id is None:
+      missing.append((name, image_collection_id, options))
+    else:
+      map_ids[name] = map_id
+
+  outcomes = workers.map_with_deadline(
+      lambda layer: GetCachedMapId(layer[1], layer[2]), missing,
+      max_workers=MAPID_WORKERS, deadline=deadline)
+  for (name, image_collection_id, options), outcome in zip(missing, outcomes):
+    if not outcome.done or outcome.error is not None:
+      map_id = MAPID_CACHE.last_known_good(image_collection_id, options)
+      if map_id is not None:
+        logging.warning('Serving last known good MapID for %s', name)
+        map_ids[name] = map_id
+        continue
+      outcome.wait()
+    map_ids[name] = outcome.result()
+  return map_ids
+
+def MapLayer(name):
+  """Returns (asset ID, options) of the map layer called name, or
+  (None, None)."""
+  for layer_name, image_collection_id, options in MAP_LAYERS:
+    if layer_name == name:
+      options = DEFAULT_MAP_OPTIONS if options == None else options
+      return image_collection_id, options
+  return None, None
+
+
+def GetAssetVersion(asset_id):
+  """Returns an asset's version, asking EE at most every ASSET_VERSION_TTL
+  seconds."""
+  version = ASSET_VERSION_CACHE.get(asset_id)
+  if version is None:
+    info = ee.data.getInfo(asset_id) or {}
+    version = info.get('version', info.get('updateTime', ''))
+    ASSET_VERSION_CACHE.set(asset_id, version)
+  return version
+
+
+def MemoizedDecode(key, decode):
+  """Returns decode(), remembering the result under key.
+
+  key should include the raw string being decoded. Errors aren't remembered.
+  """
+  decoded = DECODED_CACHE.get(key)
+  if decoded is None:
+    decoded = decode()
+    DECODED_CACHE.set(key, decoded)
+  return decoded
+
+
+def AssetImage(asset_id):
+  """Returns the ee.Image for an asset ID, reusing one built earlier."""
+  image = IMAGE_CACHE.get(asset_id)
+  if image is None:
+    image = ee.Image(asset_id)
+    IMAGE_CACHE.set(asset_id, image)
+  return image
+
+
+def StackAssets(asset_ids, wet_bands=False):
+  """Returns an ee.Image with the first band of each asset, in order.
+
+  With wet_bands, each asset's band is followed by a copy of it masked to
+  its wet pixels, so that a count over that copy counts wet pixels.
+  """
+  if len(asset_ids) == 1 and not wet_bands:
+    return AssetImage(asset_ids[0])
+  bands = []
+  for i, asset_id in enumerate(asset_ids):
+    band = AssetImage(asset_id).select([0], [StackBandName(i)])
+    bands.append(band)
+    if wet_bands:
+      bands.append(band.updateMask(band.gte(WET_THRESHOLD))
+                   .rename(StackBandName(i, wet=True)))
+  return ee.Image.cat(bands)
+
+
+def GetReduceRegionsGraph(asset_ids, reducers, scale):
+  """Returns the serialized reduceRegions graph for our stacked assets.
+
+  The image stack and combined reducer depend only on the assets, reducers
+  and scale, so each combination is only built and serialized once.
+  """
+  key = ('reduce-regions', tuple(asset_ids), tuple(reducers), scale)
+  graph = GRAPH_CACHE.get(key)
+  if graph is None:
+    graph = graphs.ReduceRegionsGraph(
+        StackAssets(asset_ids, 'wetCount' in reducers),
+        CombinedReducer(reducers), scale)
+    GRAPH_CACHE.set(key, graph)
+  return graph
+
+
+def StackBandName(index, wet=False):
+  """Returns the band name StackAssets gives to the index'th asset."""
+  return ('w%d' if wet else 'b%d') % index
+
+
+def ParseReducers(reducers):
+  """Returns the list of statistics named in a reducers= parameter."""
+  names = []
+  for name in (reducers or '').split(','):
+    name = name.strip()
+    if not name or name in names:
+      continue
+    if name not in REDUCERS and name != 'wetCount':
+      raise ValueError('Unknown reducer: %s' % name)
+    names.append(name)
+  return names or list(DEFAULT_REDUCERS)
+
+
+def ParseTolerance(tolerance):
+  """Returns the error a tolerance= parameter accepts in means (0 if none)."""
+  if not tolerance:
+    return 0
+  try:
+    tolerance = float(tolerance)
+  except ValueError:
+    raise ValueError('Invalid tolerance: %s' % tolerance)
+  if not 0 <= tolerance < float('inf'):
+    raise ValueError('Invalid tolerance: %s' % tolerance)
+  return tolerance
+
+
+def ReducerOutputs(names):
+  """Returns the EE reducer outputs needed to report the named statistics."""
+  outputs = [name for name in names if name in REDUCERS]
+  if 'wetCount' in names and 'count' not in outputs:
+    outputs.append('count')
+  return outputs
+
+
+def CombinedReducer(names):
+  """Returns one ee.Reducer computing all named statistics on shared inputs."""
+  reducers = [REDUCERS[output]() for output in ReducerOutputs(names)]
+  reducer = reducers[0]
+  for other in reducers[1:]:
+    reducer = reducer.combine(other, sharedInputs=True)
+  return reducer
+
+
+def ReducedPropertyName(band, output, n_bands, n_outputs):
+  """Returns the property reduceRegions writes a band's output to."""
+  if n_bands == 1:
+    return output
+  if n_outputs == 1:
+    return band
+  return band + '_' + output
+
+
+def ReducedProperties(n_assets, names):
+  """Maps the properties reduceRegions writes back to our statistic names.
+
+  reduceRegions names its output properties after the bands, the reducer
+  outputs, or both, depending on how many there are. Returns a list with
+  {property: statistic} for each of n_assets stacked assets, and the set of
+  every property the reduction writes.
+  """
+  wet_bands = 'wetCount' in names
+  outputs = ReducerOutputs(names)
+  n_bands = n_assets * (2 if wet_bands else 1)
+  properties = []
+  reduced = set()
+  for i in range(n_assets):
+    bands = [StackBandName(i)]
+    if wet_bands:
+      bands.append(StackBandName(i, wet=True))
+    for band in bands:
+      for output in outputs:
+        reduced.add(ReducedPropertyName(band, output, n_bands, len(outputs)))
+    renames = {}
+    for name in names:
+      if name == 'wetCount':
+        band, output = StackBandName(i, wet=True), 'count'
+      else:
+        band, output = StackBandName(i), name
+      renames[ReducedPropertyName(band, output, n_bands, len(outputs))] = name
+    properties.append(renames)
+  return properties, reduced
+
+
+def UnstackFeatures(features, renames, reduced):
+  """Returns features with reduced properties renamed per {property: name}.
+
+  Any other reduced property (e.g. one for another stacked asset) is dropped.
+  """
+  unstacked = []
+  for ft in features:
+    properties = dict((k, v) for k, v in ft.get('properties', {}).items()
+                      if k not in reduced)
+    for prop, name in renames.items():
+      if prop in ft.get('properties', {}):
+        properties[name] = ft['properties'][prop]
+    ft = dict(ft)
+    ft['properties'] = properties
+    unstacked.append(ft)
+  return unstacked
+
+
+def ExtractionScale(asset_ids):
+  """Returns the reduceRegions scale (m) for a set of assets.
+
+  A single asset is reduced at its native scale. Stacked assets are reduced
+  at the finest of their pixel sizes, so that no asset is under-sampled.
+  """
+  if len(asset_ids) < 2:
+    return None
+  return ExtractionPixelSize(asset_ids)
+
+
+def ExtractionPixelSize(asset_ids):
+  """Returns the finest nominal pixel size (m) of a set of assets."""
+  return min([ASSET_PIXEL_SIZES.get(asset_id, DEFAULT_PIXEL_SIZE)
+              for asset_id in asset_ids] or [DEFAULT_PIXEL_SIZE])
+
+
+def AllPoints(features):
+  """Returns whether every feature's geometry is a single point."""
+  return all((ft.get('geometry') or {}).get('type') == 'Point'
+             for ft in features)
+
+
+def LocalBackend(asset_id, features, names):
+  """Returns (Server-Timing stage, backend) to reduce an asset locally with,
+  or (None, None) if it has no local copy and must be reduced by EE.
+
+  Points are best answered from a tile store, the sum, count or mean of
+  rectangles from summed-area tables and of other polygons from a mean
+  pyramid; sparse copies answer either, and the sums of other polygons
+  come from cached cell partials. Anything else takes a full zonal
+  reduction.
+  """
+  if (TILE_STORES is not None and TILE_STORES.has(asset_id) and
+      AllPoints(features)):
+    return 'tiles', TILE_STORES
+  if (INTEGRALS is not None and INTEGRALS.has(asset_id) and
+      INTEGRALS.answers(features, names)):
+    return 'integral', INTEGRALS
+  if (PYRAMIDS is not None and PYRAMIDS.has(asset_id) and
+      PYRAMIDS.answers(features, names)):
+    return 'pyramid', PYRAMIDS
+  if (SPARSE is not None and SPARSE.has(asset_id) and
+      SPARSE.answers(features, names)):
+    return 'sparse', SPARSE
+  if (GRID_CACHE is not None and GRID_CACHE.has(asset_id) and
+      GRID_CACHE.answers(features, names)):
+    return 'gridcache', GRID_CACHE
+  if ZONAL is not None and ZONAL.has(asset_id):
+    return 'zonal', ZONAL
+  return None, None
+
+
+def StripGeometries(features):
+  """Returns copies of GeoJSON features without their geometries."""
+  return [dict((k, v) for k, v in ft.items() if k != 'geometry')
+          for ft in features]
+
+
+def RestampFeatures(extractions, features):
+  """Puts a request's own geometries and properties on (cached) results.
+
+  Cached results were computed for an equivalent, but not necessarily
+  identical, request -- e.g. one with another fid or a rotated ring.
+  """
+  restamped = []
+  for extraction, ft in zip(extractions, features):
+    extraction = dict(extraction)
+    extraction['geometry'] = ft.get('geometry')
+    properties = dict(extraction.get('properties') or {})
+    properties.update(ft.get('properties') or {})
+    extraction['properties'] = properties
+    restamped.append(extraction)
+  return restamped
 
-  return collection.getMapId(options)
 
 ###############################################################################
 #                                   Constants.                                #
@@ -236,11 +988,161 @@ def GetTrendyMapId(image_collection_id, options=None):
 # https://cloud.google.com/appengine/docs/python/memcache/
 MEMCACHE_EXPIRATION = 60 * 60 * 24
 
+# Caps on the size of feature collections sent to /extract, before and
+# after undoing any compression.
+MAX_EXTRACT_BODY_BYTES = 4 * 1024 * 1024
+MAX_EXTRACT_DECODED_BYTES = 16 * 1024 * 1024
+
+# Cap on the entries an lzstring stream may add to its dictionary while it
+# is decoded; each holds a string, so this bounds memory along with the
+# decoded size.
+MAX_LZSTRING_DICTIONARY = 1024 * 1024
+
+# Collections with more vertices or area (m^2) than this are reduced in
+# chunks of at most this size, on up to EXTRACT_WORKERS threads. Each chunk
+# is tried up to EXTRACT_CHUNK_ATTEMPTS times.
+EXTRACT_CHUNK_VERTICES = 5000
+EXTRACT_CHUNK_AREA = 2500 * 1000 * 1000
+EXTRACT_CHUNK_ATTEMPTS = 3
+EXTRACT_WORKERS = 4
+
+# Reduced chunks that may be waiting to be written out before the workers
+# reducing further chunks are made to wait.
+EXTRACT_STREAM_BUFFER = 2
+
+# Decoded assetId= and features= parameters are remembered in-process, by
+# their raw text, up to this many decoded characters in all.
+DECODED_CACHE_MAX_CHARS = 2 * 1024 * 1024
+
+# ee.Images built for asset IDs are reused, for up to this many assets, as
+# are serialized graphs (see graphs.py) for up to this many combinations of
+# assets, reducers and scale.
+IMAGE_CACHE_SIZE = 32
+GRAPH_CACHE_SIZE = 64
+
+# /extract results are cached in-process for the same amount of time, bounded
+# by the total number of features held.
+EXTRACTION_CACHE_MAX_FEATURES = 20000
+
+# Map tokens handed out by getMapId stop working after a while, so cached
+# map IDs are never served past MAPID_EXPIRATION and are re-minted by the
+# first request to find them older than MAPID_REFRESH_AFTER.
+MAPID_EXPIRATION = min(MEMCACHE_EXPIRATION, 60 * 60 * 6)
+MAPID_REFRESH_AFTER = 60 * 60 * 4
+
+# Directory of local copies of assets (see rasters.py), set with ZONAL_DATA.
+# /extract computes statistics for these assets itself (see zonal.py) rather
+# than asking EE, caching the masks of up to ZONAL_MASK_CACHE_CELLS pixels,
+# and uses their mean pyramids (see pyramid.py) where they have them.
+# Run-length encoded copies of mostly dry rasters (see sparse.py) answer
+# points and polygon sums. Other polygons are summed from up to
+# GRID_CACHE_CELLS cached cell partials (see gridcache.py).
+ZONAL_DATA_DIR = os.environ.get('ZONAL_DATA')
+ZONAL_MASK_CACHE_CELLS = 16 * 1024 * 1024
+GRID_CACHE_CELLS = 256 * 1024
+
+# Map layers with local copies are rendered here (see render.py) rather than
+# by EE, keeping up to LOCAL_TILE_CACHE_BYTES of PNGs in memory; browsers may
+# keep them for LOCAL_TILE_MAX_AGE seconds.
+LOCAL_TILE_CACHE_BYTES = 64 * 1024 * 1024
+LOCAL_TILE_MAX_AGE = 60 * 60
+
+# Directory of tile stores and summed-area tables (see tilestore.py and
+# integral.py), set with TILE_STORE_DATA. /extract answers collections of
+# points and of rectangles from these, for assets that have them, keeping up
+# to TILE_BLOCK_CACHE_BYTES and INTEGRAL_BLOCK_CACHE_BYTES of blocks in
+# memory.
+TILE_STORE_DIR = os.environ.get('TILE_STORE_DATA')
+TILE_BLOCK_CACHE_BYTES = 32 * 1024 * 1024
+INTEGRAL_BLOCK_CACHE_BYTES = 16 * 1024 * 1024
+
+# With PROXY_EE_TILES=1, map tiles not rendered locally are served by the
+# app rather than fetched by browsers from EE. They are fetched from EE's
+# tile server at EE_TILE_URL over up to EE_TILE_CONNECTIONS kept-alive
+# connections (none on App Engine, whose URL Fetch keeps none alive; see
+# tileproxy.py), and cached by asset version: in memory up to
+# TILE_CACHE_BYTES and, if TILE_CACHE_DIR is set and writable (it isn't on
+# App Engine), on disk up to TILE_CACHE_DISK_BYTES. Asset versions are looked
+# up at most every ASSET_VERSION_TTL seconds, and browsers may keep tiles for
+# TILE_MAX_AGE.
+PROXY_EE_TILES = os.environ.get('PROXY_EE_TILES') == '1'
+EE_TILE_URL = os.environ.get('EE_TILE_URL',
+                             'https://earthengine.googleapis.com')
+ON_APP_ENGINE = workers.ON_APP_ENGINE
+EE_TILE_CONNECTIONS = 0 if ON_APP_ENGINE else 8
+EE_TILE_TIMEOUT = 10
+TILE_CACHE_BYTES = 32 * 1024 * 1024
+TILE_CACHE_DIR = os.environ.get('TILE_CACHE_DIR')
+TILE_CACHE_DISK_BYTES = 512 * 1024 * 1024
+ASSET_VERSION_TTL = 60 * 10
+TILE_MAX_AGE = 60 * 60
+TILE_MAX_ZOOM = 24
+
+# Visualization used by GetTrendyMapId when no options are given.
+DEFAULT_MAP_OPTIONS = {
+    'min': '0.199',
+    'max' : '1',
+    'palette' : 'edf8b1, c7e9b4, 7fcdbb, 41b6c4, 1d91c0, 225ea8, 253494, 081d58',
+    'opacity' : '0.95',
+}
+
 #IMAGE_COLLECTION_ID = 'NOAA/DMSP-OLS/NIGHTTIME_LIGHTS'
 #IMAGE_COLLECTION_ID = 'users/kyletaylor/published/ks_ls5_wetness_1985_2012'
 MOST_RECENT_IMAGE_COLLECTION_ID = 'users/kyletaylor/shared/LC8dynamicwater'
 HISTORICAL_IMAGE_COLLECTION_ID = 'users/kyletaylor/shared/PLJVLC5historicwetness_10m'
 
+# Nominal pixel sizes (m) of the assets the client extracts from.
+ASSET_PIXEL_SIZES = {
+    HISTORICAL_IMAGE_COLLECTION_ID: 10,
+    MOST_RECENT_IMAGE_COLLECTION_ID: 30,
+    'users/adaniels/shared/LC5historicwetness_10m': 10,
+    'users/kyletaylor/shared/time_of_landsat_mosaic_pixel': 30,
+}
+DEFAULT_PIXEL_SIZE = 30
+
+# Wetness values at or above this are considered wet, both on the map and
+# when counting wet pixels.
+WET_THRESHOLD = 0.199
+
+# Statistics /extract can compute, by the name they are requested and
+# reported under (which is also the name of their EE reducer output).
+# wetCount -- the number of wet pixels -- is handled separately.
+REDUCERS = {
+    'mean': lambda: ee.Reducer.mean(),
+    'min': lambda: ee.Reducer.min(),
+    'max': lambda: ee.Reducer.max(),
+    'sum': lambda: ee.Reducer.sum(),
+    'stdDev': lambda: ee.Reducer.stdDev(),
+    'count': lambda: ee.Reducer.count(),
+    'histogram': lambda: ee.Reducer.fixedHistogram(0, 1, HISTOGRAM_BINS),
+}
+DEFAULT_REDUCERS = ['mean']
+
+# Bins in the wet-frequency histogram, over [0, 1].
+HISTOGRAM_BINS = 10
+
+# Decimal places kept in coordinates sent to EE (1e-5 degrees is ~1 m).
+# Rings are also simplified to within half a pixel of the finest asset.
+COORDINATE_PRECISION = 5
+
+# Map layers rendered on the main page as (template name, asset ID, options).
+# options=None uses DEFAULT_MAP_OPTIONS.
+MAP_LAYERS = [
+    ('historical', HISTORICAL_IMAGE_COLLECTION_ID, None),
+    ('mostRecent', MOST_RECENT_IMAGE_COLLECTION_ID, {
+        'min': '0',
+        'max': '1',
+        'palette' : 'edf8b1, 081d58',
+        'opacity' : '0.95',
+    }),
+]
+
+# Uncached map IDs are minted on up to MAPID_WORKERS threads. A layer that
+# takes longer than MAPID_DEADLINE seconds is served its last known good ID,
+# except on App Engine, where a mint can't outlive the request.
+MAPID_WORKERS = 4
+MAPID_DEADLINE = 10
+
 
 ###############################################################################
 #                               Initialization.                               #
@@ -263,3 +1165,68 @@ JINJA2_ENVIRONMENT = jinja2.Environment(
 
 # Initialize the EE API.
 ee.Initialize(EE_CREDENTIALS)
+
+# Process-local LRUs of decoded request parameters and of per-asset images.
+DECODED_CACHE = cache.LRUCache(DECODED_CACHE_MAX_CHARS, weigher=len)
+IMAGE_CACHE = cache.LRUCache(IMAGE_CACHE_SIZE)
+GRAPH_CACHE = cache.LRUCache(GRAPH_CACHE_SIZE)
+ASSET_VERSION_CACHE = cache.LRUCache(IMAGE_CACHE_SIZE, ttl=ASSET_VERSION_TTL)
+
+# Kept-alive connections to EE's tile server, and the tiles fetched through
+# them.
+EE_TILES = tileproxy.ConnectionPool(
+    EE_TILE_URL, EE_TILE_CONNECTIONS, EE_TILE_TIMEOUT)
+TILE_CACHE = tileproxy.TileCache(
+    TILE_CACHE_BYTES, TILE_CACHE_DIR, TILE_CACHE_DISK_BYTES)
+
+# Process-local LRU of /extract results keyed by geometry.canonical_key().
+EXTRACTION_CACHE = cache.LRUCache(
+    EXTRACTION_CACHE_MAX_FEATURES, ttl=MEMCACHE_EXPIRATION, weigher=len)
+
+# Local zonal statistics engine, mean pyramids and map tile renderer, if
+# there are local copies of any assets. numpy is only needed, and imported,
+# when there are.
+ZONAL = None
+PYRAMIDS = None
+GRID_CACHE = None
+SPARSE = None
+TILE_RENDERER = None
+if ZONAL_DATA_DIR:
+  import gridcache
+  import pyramid
+  import render
+  import sparse
+  import zonal
+  ZONAL = zonal.ZonalEngine(
+      ZONAL_DATA_DIR, ZONAL_MASK_CACHE_CELLS,
+      histogram=(0, 1, HISTOGRAM_BINS), wet_threshold=WET_THRESHOLD)
+  PYRAMIDS = pyramid.Pyramids(ZONAL_DATA_DIR)
+  GRID_CACHE = gridcache.GridCache(ZONAL_DATA_DIR, GRID_CACHE_CELLS)
+  SPARSE = sparse.SparseRasters(
+      ZONAL_DATA_DIR, histogram=(0, 1, HISTOGRAM_BINS),
+      wet_threshold=WET_THRESHOLD)
+  TILE_RENDERER = render.TileRenderer(
+      ZONAL_DATA_DIR,
+      dict((name, (asset_id, options or DEFAULT_MAP_OPTIONS))
+           for name, asset_id, options in MAP_LAYERS),
+      WET_THRESHOLD, LOCAL_TILE_CACHE_BYTES)
+
+# Tile stores for point queries and summed-area tables for rectangles, if
+# there are any.
+TILE_STORES = None
+INTEGRALS = None
+if TILE_STORE_DIR:
+  import integral
+  import tilestore
+  TILE_STORES = tilestore.TileStores(
+      TILE_STORE_DIR, TILE_BLOCK_CACHE_BYTES,
+      histogram=(0, 1, HISTOGRAM_BINS), wet_threshold=WET_THRESHOLD)
+  INTEGRALS = integral.IntegralTables(
+      TILE_STORE_DIR, INTEGRAL_BLOCK_CACHE_BYTES)
+
+# Process-local LRU in front of memcache for map IDs. See cache.py.
+MAPID_CACHE = cache.MapIdCache(
+    GetTrendyMapId,
+    lifetime=MAPID_EXPIRATION,
+    refresh_after=MAPID_REFRESH_AFTER,
+    shared=memcache)
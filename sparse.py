@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+"""Run-length encoded copies of mostly empty rasters.
+
+The surface wetness products are masked by where water has ever been seen
+(see ee_scripts/ee_generate_surface_wetness_assets.py), so across most of
+Kansas they are all one background value, 0 or nodata. A sparse copy keeps
+only the other pixels, as runs along each row: `starts.npy` holds the
+index (row * columns + column) of the first pixel of every run, in order,
+`lengths.npy` how many pixels each run has, and `values.npy` the pixels of
+every run laid end to end. `meta.json` has the raster's shape, dtype,
+geotransform and nodata value (see rasters.py) and the background value.
+
+Runs cost RUN_BYTES each in memory, on top of their pixels' values, so a
+sparse copy only pays off where the wet pixels are few and bunched
+together: a float32 raster whose wet pixels come in runs of 10 is smaller
+sparse while under half of it is wet, but one of isolated wet pixels only
+while under a tenth is. build() refuses to write a sparse copy that would
+be bigger than the raster; such rasters are better kept dense.
+
+Because values are stored in pixel order, the pixels of any span of a row
+are a contiguous slice of them, found by binary search of the run starts;
+running totals over whole runs then give a span's sum and valid-pixel
+count, visiting only the pixels of the runs its ends cut through.
+Polygons are cut into spans the same way zonal.rasterize() fills them, so
+the two agree, and a polygon's cost follows how many rows it spans rather
+than its area. Points look up the run they fall in, if any.
+
+Sparse copies live under a data directory at their asset's ID, e.g.
+<data dir>/users/kyletaylor/shared/LC8dynamicwater.runs. To make one from
+a GeoTIFF (which needs rasterio or GDAL) or a .npy raster:
+
+    python sparse.py LC8dynamicwater.tif <data dir> \\
+        users/kyletaylor/shared/LC8dynamicwater
+"""
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+import geometry
+import rasters
+import tilestore
+import zonal
+
+# Extension of sparse copy directories.
+EXTENSION = '.runs'
+
+# Statistics sparse copies can answer for polygons; points can have any.
+STATISTICS = ('mean', 'sum', 'count')
+
+# Rows read at a time while encoding a raster.
+BUILD_ROWS = 1024
+
+# Bytes a run takes in memory: its start, length and offset among the
+# values, and the running totals before it (see SparseRaster).
+RUN_BYTES = 8 + 4 + 8 + 16
+
+
+class SparseRaster(rasters.Raster):
+    """A raster held as runs of the pixels that aren't its background.
+
+    Its data attribute is None; pixels are read with sample(), and polygons
+    reduced with reduce().
+    """
+
+    def __init__(self, path, mmap=True):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        super(SparseRaster, self).__init__(None, meta['transform'],
+                                           meta.get('nodata'))
+        self._shape = tuple(meta['shape'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.background = meta['background']
+        mode = 'r' if mmap else None
+        self.starts = np.load(os.path.join(path, 'starts.npy'), mmap_mode=mode)
+        self.lengths = np.load(os.path.join(path, 'lengths.npy'),
+                               mmap_mode=mode)
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode=mode)
+        # where each run's pixels begin among the values
+        self.offsets = np.concatenate(
+            [[0], np.cumsum(self.lengths)[:-1]]).astype(np.int64)
+        self._run_totals = None
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def nbytes(self):
+        """Bytes taken by the runs, as opposed to the dense raster's."""
+        totals = sum(t.nbytes for t in self._run_totals or ())
+        return (self.starts.nbytes + self.lengths.nbytes +
+                self.values.nbytes + self.offsets.nbytes + totals)
+
+    def sample(self, x, y):
+        """Returns (values, valid) of the pixels containing points x, y.
+
+        values are floats; valid is False for points outside the raster
+        and for pixels that are nodata.
+        """
+        rows, cols = self.index(x, y)
+        inside = ((rows >= 0) & (rows < self._shape[0]) &
+                  (cols >= 0) & (cols < self._shape[1]))
+        pixels = rows.astype(np.int64) * self._shape[1] + cols
+        values = np.zeros(len(pixels), dtype=float) + self.background
+        run = np.searchsorted(self.starts, pixels, side='right') - 1
+        found = inside & (run >= 0)
+        found[found] = (pixels[found] - self.starts[run[found]] <
+                        self.lengths[run[found]])
+        values[found] = self.values[self.offsets[run[found]] +
+                                    pixels[found] - self.starts[run[found]]]
+        valid = inside.copy()
+        valid[inside] = self.valid(values[inside])
+        return values, valid
+
+    def reduce(self, geom):
+        """Returns (sum, count) of the valid pixels a polygon covers."""
+        positions = list(geometry.positions(geom))
+        if not positions:
+            return 0.0, 0
+        xy = np.array([p[:2] for p in positions], dtype=float)
+        window = self.window(xy[:, 0].min(), xy[:, 1].min(),
+                             xy[:, 0].max(), xy[:, 1].max())
+        width = self._shape[1]
+        begin, end = [], []
+        for rings in geometry.polygons(geom):
+            for start, _, row, first, last in zonal.spans(self, window, rings):
+                pixels = (row + start + window[0].start).astype(np.int64) * \
+                    width + window[1].start
+                begin.append(pixels + first)
+                end.append(pixels + last + 1)
+        # a polygon can have spans and still cover no pixel center
+        if not sum(len(b) for b in begin):
+            return 0.0, 0
+        # the polygons of a MultiPolygon may overlap; pixels count once
+        begin, end = _union(np.concatenate(begin), np.concatenate(end))
+        a, b = self._position(begin), self._position(end)
+        (sum_a, count_a), (sum_b, count_b) = self._before(a), self._before(b)
+        total = float((sum_b - sum_a).sum())
+        count = int((count_b - count_a).sum())
+        # everything in the spans that isn't in a run is background
+        background = int((end - begin).sum() - (b - a).sum())
+        if self.valid(np.array([self.background], dtype=self.dtype))[0]:
+            total += float(self.background) * background
+            count += background
+        return total, count
+
+    def run_totals(self):
+        """Returns the sums and valid-pixel counts of all the runs before
+        each run (and of all of them, last), computed when first needed."""
+        with self._lock:
+            if self._run_totals is None:
+                values = np.asarray(self.values)
+                valid = self.valid(values)
+                sums = np.zeros(len(self.lengths) + 1)
+                counts = np.zeros(len(self.lengths) + 1, dtype=np.int64)
+                if len(values):
+                    sums[1:] = np.add.reduceat(
+                        np.where(valid, values, 0).astype(np.float64),
+                        self.offsets).cumsum()
+                    counts[1:] = np.add.reduceat(
+                        valid.astype(np.int64), self.offsets).cumsum()
+                self._run_totals = sums, counts
+            return self._run_totals
+
+    def _position(self, pixels):
+        """Returns how many run pixels come before each pixel index."""
+        run = np.searchsorted(self.starts, pixels, side='right') - 1
+        found = run >= 0
+        position = np.zeros(len(pixels), dtype=np.int64)
+        position[found] = self.offsets[run[found]] + np.minimum(
+            pixels[found] - self.starts[run[found]],
+            self.lengths[run[found]])
+        return position
+
+    def _before(self, positions):
+        """Returns the sum and valid-pixel count of the run values before
+        each position among them: whole runs from run_totals(), and the
+        pixels of the run a position is part way through one by one."""
+        sums, counts = self.run_totals()
+        run = np.maximum(
+            np.searchsorted(self.offsets, positions, side='right') - 1, 0)
+        start = self.offsets[run]
+        taken = positions - start
+        # the indices of the pixels before each position in its run
+        which = np.repeat(np.arange(len(positions)), taken)
+        index = np.repeat(start - (np.cumsum(taken) - taken), taken) + \
+            np.arange(taken.sum())
+        values = np.asarray(self.values[index])
+        valid = self.valid(values)
+        return (sums[run] + np.bincount(which, minlength=len(positions),
+                                        weights=np.where(valid, values, 0)),
+                counts[run] + np.bincount(which[valid],
+                                          minlength=len(positions)))
+
+
+class SparseRasters(object):
+    """Answers /extract point and polygon queries from the sparse copies in
+    a directory."""
+
+    def __init__(self, data_dir, histogram=(0, 1, 10), wet_threshold=None):
+        self.data_dir = data_dir
+        self.histogram = histogram
+        self.wet_threshold = wet_threshold
+        self._rasters = rasters.LocalCopies(self._load)
+
+    def has(self, asset_id):
+        """Returns whether an asset has a sparse copy."""
+        return self.raster(asset_id) is not None
+
+    def raster(self, asset_id):
+        """Returns an asset's SparseRaster, or None."""
+        return self._rasters.get(asset_id)
+
+    def _load(self, asset_id):
+        path = find(self.data_dir, asset_id)
+        return path and SparseRaster(path)
+
+    def clear(self):
+        """Does nothing; sparse copies cache nothing but their runs."""
+
+    @staticmethod
+    def answers(features, names):
+        """Returns whether sparse copies can compute statistics names for
+        every feature, i.e. whether they are all points, or all polygons
+        and names are ones runs can sum."""
+        kinds = set((ft.get('geometry') or {}).get('type') for ft in features)
+        if kinds <= set(['Point']):
+            return True
+        return (kinds <= set(['Polygon', 'MultiPolygon']) and
+                all(name in STATISTICS for name in names))
+
+    def extract(self, asset_id, features, names):
+        """Returns reduceRegions-like features for GeoJSON Point or polygon
+        features."""
+        raster = self.raster(asset_id)
+        if all(ft['geometry']['type'] == 'Point' for ft in features):
+            xy = np.array([ft['geometry']['coordinates'][:2]
+                           for ft in features], dtype=float).reshape(-1, 2)
+            values, valid = raster.sample(xy[:, 0], xy[:, 1])
+            stats = zonal.point_statistics(values, valid, names,
+                                           self.histogram, self.wet_threshold)
+        else:
+            stats = []
+            for ft in features:
+                total, count = raster.reduce(ft['geometry'])
+                reduced = {'sum': total, 'count': count,
+                           'mean': total / count if count else None}
+                stats.append(dict((name, reduced[name]) for name in names))
+        extracted = []
+        for i, (ft, reduced) in enumerate(zip(features, stats)):
+            properties = dict(ft.get('properties') or {})
+            properties.update(reduced)
+            extracted.append({'type': 'Feature', 'id': str(i),
+                              'geometry': ft.get('geometry'),
+                              'properties': properties})
+        return extracted
+
+
+def _union(begin, end):
+    """Returns the union of half-open intervals [begin, end) as disjoint
+    sorted ones."""
+    if not len(begin):
+        return begin, end
+    order = np.argsort(begin, kind='mergesort')
+    begin, end = begin[order], end[order]
+    reach = np.maximum.accumulate(end)
+    # an interval starts a new group when it begins past all before it
+    new = np.concatenate([[True], begin[1:] > reach[:-1]])
+    last = np.concatenate([np.nonzero(new)[0][1:] - 1, [len(begin) - 1]])
+    return begin[new], reach[last]
+
+
+def find(data_dir, asset_id):
+    """Returns the path of an asset's sparse copy, or None."""
+    base = rasters.asset_path(data_dir, asset_id)
+    path = base and base + EXTENSION
+    return path if path and os.path.exists(os.path.join(path, 'meta.json')) else None
+
+
+def build(source, path, background=0):
+    """Writes the sparse copy of a GeoTIFF or .npy raster, reading it
+    BUILD_ROWS rows at a time.
+
+    Raises ValueError, and writes nothing, if the copy would take more
+    memory than the raster itself.
+    """
+    shape, dtype, transform, nodata, read_rows = tilestore.open_rows(source)
+    dense = shape[0] * shape[1] * np.dtype(dtype).itemsize
+    starts, lengths, values = [], [], []
+    size = 0
+    for first in range(0, shape[0], BUILD_ROWS):
+        pixels = np.asarray(read_rows(first, min(first + BUILD_ROWS,
+                                                 shape[0])))
+        if np.isnan(background):
+            kept = ~np.isnan(pixels)
+        else:
+            kept = pixels != background
+        # runs begin where a kept pixel follows a dropped one, or a row's
+        # start, and end likewise; a column of False pads every row
+        padded = np.zeros((len(pixels), shape[1] + 1), dtype=np.int8)
+        padded[:, 1:] = kept
+        steps = np.diff(np.hstack([padded, padded[:, :1]]), axis=1).ravel()
+        width = shape[1] + 1
+        begins = np.nonzero(steps == 1)[0]
+        ends = np.nonzero(steps == -1)[0]
+        rows = begins // width
+        starts.append((rows + first).astype(np.int64) * shape[1] +
+                      begins % width)
+        lengths.append((ends - begins).astype(np.int32))
+        values.append(pixels[kept])
+        size += len(begins) * RUN_BYTES + \
+            values[-1].size * np.dtype(dtype).itemsize
+        if size > dense:
+            raise ValueError(
+                'A sparse copy of %s would take over %d bytes, more than its '
+                '%d dense: keep it dense' % (source, size, dense))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, 'starts.npy'), np.concatenate(starts))
+    np.save(os.path.join(path, 'lengths.npy'), np.concatenate(lengths))
+    np.save(os.path.join(path, 'values.npy'),
+            np.concatenate(values).astype(dtype))
+    # the metadata is written last, so find() never sees a partial copy
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'shape': list(shape), 'dtype': np.dtype(dtype).str,
+                   'transform': list(transform), 'nodata': nodata,
+                   'background': background}, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Makes a sparse copy of a GeoTIFF or .npy raster.')
+    parser.add_argument('source', help='GeoTIFF, or .npy with a .json sidecar')
+    parser.add_argument('data_dir', help='directory of sparse copies')
+    parser.add_argument('asset_id', help='asset the raster is a copy of')
+    parser.add_argument('--background', type=float, default=0,
+                        help='value left out of runs (0, or nan)')
+    args = parser.parse_args()
+    path = os.path.join(args.data_dir, *args.asset_id.split('/')) + EXTENSION
+    try:
+        build(args.source, path, args.background)
+    except ValueError as e:
+        parser.error(str(e))
+    print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,11 +11,15 @@ kwap = {};  // Our namespace.
  * Starts the web application. The main entry point for the app.
  * @param {string} eeMapId The Earth Engine map ID.
  * @param {string} eeToken The Earth Engine map token.
+ * @param {string} historicalTileUrl Where the app serves the historical
+ *     layer's tiles, rendered locally or cached from EE (if empty, they
+ *     are fetched from EE directly).
+ * @param {string} mostRecentTileUrl Likewise for the most recent layer.
  * @param {string} serializedPolygonIds A serialized array of the IDs of the
  *     polygons to show on the map. For example: "['poland', 'moldova']".
  */
 
-kwap.boot = function(historicalEeMapId, mostRecentEeMapId, historicalEeToken, mostRecentEeToken) {
+kwap.boot = function(historicalEeMapId, mostRecentEeMapId, historicalEeToken, mostRecentEeToken, historicalTileUrl, mostRecentTileUrl) {
   // Load external libraries.
   google.load('visualization', '1.0');
   google.load('jquery', '1');
@@ -28,8 +32,8 @@ kwap.boot = function(historicalEeMapId, mostRecentEeMapId, historicalEeToken, mo
     kwap.App.mostRecentAssetId = 'users/kyletaylor/shared/LC8dynamicwater'
     kwap.App.acquisitionTimeAssetId = 'users/kyletaylor/shared/time_of_landsat_mosaic_pixel'
     /* create layers for each asset */
-    kwap.App.historicalLayer = kwap.App.getEeMapType(historicalEeMapId, historicalEeToken);
-    kwap.App.mostRecentLayer = kwap.App.getEeMapType(mostRecentEeMapId, mostRecentEeToken);
+    kwap.App.historicalLayer = kwap.App.getEeMapType(historicalEeMapId, historicalEeToken, historicalTileUrl);
+    kwap.App.mostRecentLayer = kwap.App.getEeMapType(mostRecentEeMapId, mostRecentEeToken, mostRecentTileUrl);
     // calls createMap() with our historical layer
     kwap.App(kwap.App.historicalLayer);
     kwap.App.addLayer(kwap.App.mostRecentLayer, id='mostRecent');
@@ -479,6 +483,23 @@ kwap.App.featuresToJson = function(features, compress=false) {
   }
   return(_features_geojson)
 }
+/* send an (lzstring-compressed) feature collection to /extract. Small
+ * collections go in the query string; large ones are POSTed as the request
+ * body so that they don't run into URL length limits. We ask for plain
+ * JSON back, which the server gzips and the browser inflates for us
+ */
+kwap.App.extractRequest = function(features, assetIds){
+  query = 'format=json&assetId=' + assetIds.map(encodeURIComponent).join(',')
+  if (features.length <= kwap.App.MAX_QUERY_FEATURES_LENGTH) {
+    return($.get('/extract?features=' + features + '&' + query))
+  }
+  return($.ajax({
+    url: '/extract?' + query,
+    type: 'POST',
+    contentType: 'text/plain',
+    data: features
+  }))
+}
 /* the default response will be a json formatted object with a 'mean'
  * property containing our reduce operation
  */
@@ -498,43 +519,45 @@ kwap.App.unpackFeatureExtractions = function(features){
  * product. Note that the asset ID here is fixed and should never change
  */
 kwap.App.processAcquisitionDate = function(features, callBack=null){
-    // Asynchronously load and show details about the point feature
-    uuAssetId = kwap.App.lzCompress(kwap.App.acquisitionTimeAssetId)
     // extract unix time for our landsat 8 product
-    $.get('/extract?features=' + features + '&assetId=' + uuAssetId).done((function(data) {
+    kwap.App.extractRequest(features, [kwap.App.acquisitionTimeAssetId]).done((function(data) {
         if (data['error']) {
           data = data['error']
         } else {
-          // unpack our json response from the backend
-          date_str = new Date(Math.round(kwap.App.featuresToJson(
-              kwap.App.lzDecompress(data)
-            )[0]['properties']['mean']));
-          kwap.App.acquisition_date_str = date_str.toDateString().split(' ').splice(1,3).join(' ');
+          kwap.App.acquisition_date_str = kwap.App.acquisitionDateString(data);
           callBack(kwap.App.acquisition_date_str)
         }
     }).bind(this));
 }
+kwap.App.acquisitionDateString = function(features){
+  date_str = new Date(Math.round(features[0]['properties']['mean']));
+  return(date_str.toDateString().split(' ').splice(1,3).join(' '))
+}
+/* async handler that extracts several assets in one round trip to the
+ * backend. The callback gets an object of extractions keyed by asset id
+ */
+kwap.App.processAssets = function(features, assetIds, callBack=null){
+  kwap.App.extractRequest(features, assetIds).done((function(data) {
+    // use our user-specified callback
+    if (callBack != null && !data['error']){
+      callBack(data)
+    }
+  }).bind(this));
+}
 kwap.App.processFeatures = function(features, assetId, callBack=null){
   // Asynchronously load and show details about the point feature
-  uuAssetId = kwap.App.lzCompress(assetId)
-  $.get('/extract?features=' + features + '&assetId=' + uuAssetId).done((function(data) {
+  kwap.App.extractRequest(features, [assetId]).done((function(data) {
     if (data['error']) {
-      comp_str = data['error']
-    } else {
-      comp_str = data
+      return
     }
     if(assetId.includes('hist')){
-      kwap.App.historical_ext = kwap.App.featuresToJson(
-        kwap.App.lzDecompress(comp_str)
-      )
+      kwap.App.historical_ext = data
       // use our user-specified callback
       if (callBack != null){
         callBack(kwap.App.historical_ext)
       }
     } else {
-      kwap.App.lastWetScene_ext = kwap.App.featuresToJson(
-        kwap.App.lzDecompress(comp_str)
-      )
+      kwap.App.lastWetScene_ext = data
       // use our user-specified callback
       if (callBack != null){
         callBack(kwap.App.lastWetScene_ext)
@@ -615,12 +638,18 @@ kwap.App.addLocationMarker = function(panTo=true){
  * https://developers.google.com/maps/documentation/javascript/maptypes#ImageMapTypes
  * @param {string} eeMapId The Earth Engine map ID.
  * @param {string} eeToken The Earth Engine map token.
+ * @param {string=} tileUrl Where the app serves the layer's tiles (see
+ *     render.py and tileproxy.py); if given, tiles come from there instead
+ *     of EE.
  * @return {google.maps.ImageMapType} A Google Maps ImageMapType object for the
  *     EE map with the given ID and token.
  */
-kwap.App.getEeMapType = function(eeMapId, eeToken) {
+kwap.App.getEeMapType = function(eeMapId, eeToken, tileUrl) {
   var eeMapOptions = {
     getTileUrl: function(tile, zoom) {
+      if (tileUrl) {
+        return tileUrl + '/' + [zoom, tile.x, tile.y].join('/');
+      }
       var url = kwap.App.EE_URL + '/map/';
       url += [eeMapId, zoom, tile.x, tile.y].join('/');
       url += '?token=' + eeToken;
@@ -636,6 +665,10 @@ kwap.App.getEeMapType = function(eeMapId, eeToken) {
 kwap.App.EE_URL = 'https://earthengine.googleapis.com';
 
 
+/** @type {number} The longest features string sent in a query string. */
+kwap.App.MAX_QUERY_FEATURES_LENGTH = 2000;
+
+
 /** @type {number} The default zoom level for the map. */
 kwap.App.DEFAULT_ZOOM = 9;
 
@@ -1139,8 +1172,19 @@ menu.toggle_help = function(){
 /* GEE processing methods */
 menu.export_features = function(){
   ft = kwap.App.featuresToJson(kwap.App.markers, true)
-  kwap.App.processAcquisitionDate(ft, kwap.App.acquisitionDateCallback)
-  kwap.App.processFeatures(ft, kwap.App.historicalAssetId, kwap.App.pointFeaturesCallback)
+  // historical and most recent wetness and acquisition time come back from
+  // a single request
+  assetIds = [kwap.App.historicalAssetId, kwap.App.mostRecentAssetId,
+              kwap.App.acquisitionTimeAssetId]
+  kwap.App.processAssets(ft, assetIds, function(extractions){
+    kwap.App.historical_ext = extractions[kwap.App.historicalAssetId]
+    kwap.App.lastWetScene_ext = extractions[kwap.App.mostRecentAssetId]
+    kwap.App.pointFeaturesCallback(kwap.App.historical_ext)
+    kwap.App.acquisition_date_str = kwap.App.acquisitionDateString(
+      extractions[kwap.App.acquisitionTimeAssetId]
+    )
+    kwap.App.acquisitionDateCallback(kwap.App.acquisition_date_str)
+  })
   // hide the menu
   if(menu.menuDisplayed == true){
       menu.menuBox.style.display = "none";
@@ -0,0 +1,103 @@
+"""Fixtures shared by the tests: a small synthetic wetness raster.
+
+The tests run under pytest from the repository root, e.g.
+
+    python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# after the standard library, whose modules some of lib/'s would shadow
+sys.path.append(os.path.join(ROOT, 'lib'))
+
+import rasters  # noqa: E402
+
+# Where the synthetic raster is: 0.01 degree pixels from 100 W, 40 N.
+TRANSFORM = (-100.0, 0.01, 0.0, 40.0, 0.0, -0.01)
+SHAPE = (50, 70)
+NODATA = -9999.0
+
+# Assets: mostly dry with wet patches, NaN and nodata; and all dry.
+WET = 'test/wet'
+DRY = 'test/dry'
+
+
+def synthetic_wetness(shape=SHAPE, seed=1):
+    """Returns a float32 raster that is 0 but for a few wet patches, some of
+    whose pixels are NaN or NODATA."""
+    rng = np.random.RandomState(seed)
+    data = np.zeros(shape, dtype=np.float32)
+    for _ in range(12):
+        row, col = rng.randint(0, shape[0]), rng.randint(0, shape[1])
+        height, width = rng.randint(1, 12, 2)
+        patch = data[row:row + height, col:col + width]
+        patch[:] = rng.randint(1, 30, patch.shape)
+    holes = (data > 0) & (rng.rand(*shape) < 0.1)
+    data[holes] = np.where(rng.rand(holes.sum()) < 0.5, np.nan, NODATA)
+    return data
+
+
+@pytest.fixture(scope='module')
+def data_dir(tmpdir_factory):
+    """A data directory holding local copies of the WET and DRY assets."""
+    path = str(tmpdir_factory.mktemp('data'))
+    for asset_id, data in ((WET, synthetic_wetness()),
+                           (DRY, np.zeros(SHAPE, dtype=np.float32))):
+        base = os.path.join(path, *asset_id.split('/'))
+        if not os.path.isdir(os.path.dirname(base)):
+            os.makedirs(os.path.dirname(base))
+        rasters.save(base + '.npy', rasters.Raster(data, TRANSFORM, NODATA))
+    return path
+
+
+def polygon(west, south, east, north):
+    """Returns a GeoJSON Polygon of a bounding box."""
+    return {'type': 'Polygon', 'coordinates': [[
+        [west, south], [east, south], [east, north], [west, north],
+        [west, south]]]}
+
+
+def feature(geometry):
+    return {'type': 'Feature', 'geometry': geometry, 'properties': {}}
+
+
+# Polygons that cover no pixel center, or no pixel at all.
+DEGENERATE = [
+    # between four pixel centers
+    polygon(-99.894, 39.796, -99.886, 39.804),
+    # a sliver with no area
+    {'type': 'Polygon', 'coordinates': [[
+        [-99.9, 39.903], [-99.8, 39.803], [-99.7, 39.703], [-99.9, 39.903]]]},
+    # off the raster
+    polygon(-90.0, 30.0, -89.0, 31.0),
+    {'type': 'Polygon', 'coordinates': []},
+    {'type': 'MultiPolygon', 'coordinates': [
+        polygon(-99.894, 39.796, -99.886, 39.804)['coordinates'],
+        polygon(-99.794, 39.696, -99.786, 39.704)['coordinates']]},
+]
+
+# Polygons of all sizes, with holes and overlapping parts.
+POLYGONS = [
+    polygon(-99.95, 39.55, -99.35, 39.95),
+    polygon(-100.5, 39.0, -99.0, 41.0),
+    polygon(-99.873, 39.612, -99.701, 39.798),
+    {'type': 'Polygon', 'coordinates': [
+        [[-99.9, 39.6], [-99.4, 39.65], [-99.6, 39.95], [-99.9, 39.6]],
+        [[-99.7, 39.7], [-99.6, 39.7], [-99.6, 39.8], [-99.7, 39.7]]]},
+    {'type': 'MultiPolygon', 'coordinates': [
+        polygon(-99.9, 39.6, -99.6, 39.9)['coordinates'],
+        polygon(-99.7, 39.7, -99.4, 39.95)['coordinates']]},
+]
+
+
+def assert_close(actual, expected):
+    """Asserts that two statistics agree, to rounding for floats."""
+    if expected is None or isinstance(expected, int):
+        assert actual == expected
+    else:
+        assert actual == pytest.approx(expected, rel=1e-9, abs=1e-9)
@@ -0,0 +1,97 @@
+import cache
+
+
+class FakeMemcache(object):
+    """The few memcache calls MapIdCache makes, on a dict; times are
+    ignored."""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key, namespace=None):
+        return self.values.get((namespace, key))
+
+    def set(self, key, value, time=0, namespace=None):
+        self.values[(namespace, key)] = value
+
+    def add(self, key, value, time=0, namespace=None):
+        if (namespace, key) in self.values:
+            return False
+        self.values[(namespace, key)] = value
+        return True
+
+    def delete(self, key, namespace=None):
+        self.values.pop((namespace, key), None)
+
+
+def map_ids(shared=None, refresh_after=60):
+    minted = []
+
+    def mint(asset_id, options):
+        minted.append(asset_id)
+        return {'mapid': '%s-%d' % (asset_id, len(minted)), 'token': 't'}
+    return cache.MapIdCache(mint, 120, refresh_after, shared), minted
+
+
+def age(map_id_cache, seconds):
+    """Makes every cached entry seconds older."""
+    for entry, _, _ in map_id_cache._local._entries.values():
+        entry['refresh_at'] -= seconds
+        entry['expires'] -= seconds
+
+
+def test_get_mints_once():
+    map_id_cache, minted = map_ids()
+    assert map_id_cache.cached('a', {}) is None
+    assert map_id_cache.get('a', {})['mapid'] == 'a-1'
+    assert map_id_cache.get('a', {})['mapid'] == 'a-1'
+    assert map_id_cache.cached('a', {})['mapid'] == 'a-1'
+    assert minted == ['a']
+
+
+def test_stale_entries_are_reminted_inline():
+    map_id_cache, minted = map_ids()
+    map_id_cache.get('a', {})
+    age(map_id_cache, 90)
+    # nobody is re-minting it, so the caller should
+    assert map_id_cache.cached('a', {}) is None
+    assert map_id_cache.get('a', {})['mapid'] == 'a-2'
+    assert map_id_cache.cached('a', {})['mapid'] == 'a-2'
+    assert not map_id_cache._refreshing
+
+
+def test_stale_entries_are_served_while_leased():
+    shared = FakeMemcache()
+    map_id_cache, minted = map_ids(shared)
+    map_id_cache.get('a', {})
+    age(map_id_cache, 90)
+    # another instance holds the lease
+    key = map_id_cache.key('a', {})
+    shared.add(key + ':lease', 1, namespace='mapid')
+    assert map_id_cache.cached('a', {})['mapid'] == 'a-1'
+    assert map_id_cache.get('a', {})['mapid'] == 'a-1'
+    assert minted == ['a']
+    shared.delete(key + ':lease', namespace='mapid')
+    assert map_id_cache.get('a', {})['mapid'] == 'a-2'
+    assert shared.get(key + ':lease', namespace='mapid') is None
+
+
+def test_failed_refreshes_serve_the_stale_entry():
+    map_id_cache, minted = map_ids()
+    map_id_cache.get('a', {})
+    age(map_id_cache, 90)
+
+    def fail(asset_id, options):
+        raise RuntimeError('EE is down')
+    map_id_cache._mint = fail
+    assert map_id_cache.get('a', {})['mapid'] == 'a-1'
+    assert not map_id_cache._refreshing
+
+
+def test_expired_entries_are_not_served():
+    map_id_cache, minted = map_ids()
+    map_id_cache.get('a', {})
+    age(map_id_cache, 150)
+    assert map_id_cache.cached('a', {}) is None
+    assert map_id_cache.last_known_good('a', {})['mapid'] == 'a-1'
+    assert map_id_cache.get('a', {})['mapid'] == 'a-2'
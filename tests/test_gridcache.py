@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+
+import gridcache
+import zonal
+from conftest import DEGENERATE, DRY, POLYGONS, WET, assert_close, feature
+
+NAMES = ['mean', 'sum', 'count']
+
+
+@pytest.fixture(scope='module')
+def engines(data_dir):
+    return gridcache.GridCache(data_dir), zonal.ZonalEngine(data_dir)
+
+
+@pytest.mark.parametrize('asset_id', [WET, DRY])
+@pytest.mark.parametrize('geom', DEGENERATE + POLYGONS)
+def test_polygons_match_zonal(engines, asset_id, geom):
+    grids, dense = engines
+    expected = dense.reduce(asset_id, geom, NAMES)
+    # computing partials, and again from the cache
+    for _ in range(2):
+        [extracted] = grids.extract(asset_id, [feature(geom)], NAMES)
+        for name in NAMES:
+            assert_close(extracted['properties'][name], expected[name])
+
+
+@pytest.mark.parametrize('base_level', [1, 3])
+def test_base_levels(data_dir, base_level):
+    grid = gridcache.GridCache(data_dir).grid(WET)
+    fine = gridcache.CellGrid(WET, grid.raster, grid._partials, base_level)
+    dense = zonal.ZonalEngine(data_dir)
+    for geom in POLYGONS:
+        total, count, error = fine.reduce(geom)
+        expected = dense.reduce(WET, geom, ['sum', 'count'])
+        assert (count, error) == (expected['count'], 0)
+        assert_close(total, expected['sum'])
+
+
+def test_partials_are_shared_and_bounded(data_dir):
+    grids = gridcache.GridCache(data_dir, max_cells=8)
+    dense = zonal.ZonalEngine(data_dir)
+    for geom in POLYGONS:
+        [extracted] = grids.extract(WET, [feature(geom)], NAMES)
+        assert len(grids._partials) <= 8
+        expected = dense.reduce(WET, geom, NAMES)
+        for name in NAMES:
+            assert_close(extracted['properties'][name], expected[name])
+    grids.clear()
+    assert len(grids._partials) == 0
+    assert not grids.has('test/missing')
+
+
+def test_coarse_partials_come_from_their_children(data_dir):
+    grid = gridcache.GridCache(data_dir).grid(WET)
+    data = grid.raster.data
+    read = []
+
+    class Counted(object):
+        shape = data.shape
+
+        def __getitem__(self, index):
+            pixels = np.asarray(data[index])
+            read.append(pixels.size)
+            return pixels
+
+    grid.raster.data = Counted()
+    try:
+        top = grid.levels[-1]
+        sums, counts = grid.totals(top, *np.indices(
+            grid.level_shape(top)).reshape(2, -1))
+        # every pixel is read once, whichever level asked for it
+        assert sum(read) == data.size
+        del read[:]
+        grid.totals(top - 1, np.array([0]), np.array([0]))
+        assert read == []
+    finally:
+        grid.raster.data = data
+    valid = data[grid.raster.valid(np.asarray(data))]
+    assert int(counts.sum()) == valid.size
+    assert_close(float(sums.sum()), float(valid.astype(float).sum()))
+
+
+def test_cells_read_in_runs(data_dir):
+    grid = gridcache.GridCache(data_dir).grid(WET)
+    base = grid.levels[0]
+    size = 2 ** base
+    data = np.asarray(grid.raster.data)
+    # out of order, in runs and alone, and up to the raster's last cells
+    last_i, last_j = [n - 1 for n in grid.level_shape(base)]
+    i = np.array([last_i, 0, 1, 0, last_i, 1])
+    j = np.array([last_j, 1, 0, 0, last_j - 1, 2])
+    sums, counts = grid._read(base, i, j)
+    for n in range(len(i)):
+        pixels = data[i[n] * size:(i[n] + 1) * size,
+                      j[n] * size:(j[n] + 1) * size]
+        values = pixels[grid.raster.valid(pixels)]
+        assert counts[n] == values.size
+        assert_close(float(sums[n]), float(values.astype(float).sum()))
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+import integral
+import zonal
+from conftest import (DEGENERATE, DRY, POLYGONS, WET, assert_close, feature,
+                      polygon)
+
+NAMES = ['mean', 'sum', 'count']
+
+RECTANGLES = [g for g in DEGENERATE + POLYGONS if integral.rectangles(g)] + [
+    # a row and a column of pixels, and one pixel
+    polygon(-99.9, 39.8, -99.5, 39.81),
+    polygon(-99.9, 39.6, -99.89, 39.8),
+    polygon(-99.87, 39.73, -99.86, 39.74),
+]
+
+
+@pytest.fixture(scope='module')
+def engines(data_dir):
+    for asset_id in (WET, DRY):
+        base = os.path.join(data_dir, *asset_id.split('/'))
+        integral.build(base + '.npy', base + integral.EXTENSION, block_size=16)
+    return integral.IntegralTables(data_dir), zonal.ZonalEngine(data_dir)
+
+
+def test_rectangles():
+    assert len(RECTANGLES) >= 6
+    assert not integral.rectangles(POLYGONS[3])
+    assert not integral.IntegralTables.answers(
+        [feature(g) for g in POLYGONS], NAMES)
+    assert not integral.IntegralTables.answers(
+        [feature(RECTANGLES[0])], ['histogram'])
+
+
+@pytest.mark.parametrize('asset_id', [WET, DRY])
+@pytest.mark.parametrize('geom', RECTANGLES)
+def test_rectangles_match_zonal(engines, asset_id, geom):
+    tables, dense = engines
+    [extracted] = tables.extract(asset_id, [feature(geom)], NAMES)
+    expected = dense.reduce(asset_id, geom, NAMES)
+    for name in NAMES:
+        assert_close(extracted['properties'][name], expected[name])
+
+
+def test_many_rectangles_at_once(engines):
+    tables, dense = engines
+    extracted = tables.extract(WET, [feature(g) for g in RECTANGLES], NAMES)
+    for ft in extracted:
+        expected = dense.reduce(WET, ft['geometry'], NAMES)
+        for name in NAMES:
+            assert_close(ft['properties'][name], expected[name])
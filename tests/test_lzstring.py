@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import random
+
+import pytest
+
+import lzstring
+
+CODEC = lzstring.LZString
+
+# (compress, decompress) method names of each output format.
+FORMATS = [
+    ('compress', 'decompress'),
+    ('compressToUTF16', 'decompressFromUTF16'),
+    ('compressToBase64', 'decompressFromBase64'),
+    ('compressToEncodedURIComponent', 'decompressFromEncodedURIComponent'),
+]
+
+
+def texts():
+    rng = random.Random(11)
+    points = [{'type': 'Point', 'coordinates': [-102 + 7 * rng.random(),
+                                                37 + 3 * rng.random()]}
+              for _ in range(300)]
+    return [
+        'a',
+        'aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa',
+        'ab' * 5000,
+        'Wetness – ümlauts and 水',
+        ''.join(chr(rng.randint(32, 126)) for _ in range(5000)),
+        json.dumps({'type': 'FeatureCollection', 'features': points}),
+    ]
+
+
+@pytest.mark.parametrize('compress,decompress', FORMATS)
+@pytest.mark.parametrize('text', texts())
+def test_round_trip(compress, decompress, text):
+    packed = getattr(CODEC, compress)(text)
+    assert getattr(CODEC, decompress)(packed) == text
+
+
+def test_known_output():
+    # as produced by the JavaScript lz-string the client uses
+    assert CODEC.compressToEncodedURIComponent('hello') == 'BYUwNmD2Q'
+    assert CODEC.compressToBase64('hello') == 'BYUwNmD2Q==='
+    assert CODEC.decompressFromEncodedURIComponent('BYUwNmD2Q') == 'hello'
+
+
+def test_empty_and_none():
+    for compress, decompress in FORMATS:
+        assert getattr(CODEC, compress)(None) == ''
+        assert getattr(CODEC, decompress)(None) == ''
+        assert getattr(CODEC, decompress)('') is None
+
+
+def test_spaces_are_pluses():
+    # as query strings decode them
+    packed = CODEC.compressToEncodedURIComponent('ichc4j}]')
+    assert packed == 'JYYwFiAsBWC+C6Q'
+    assert CODEC.decompressFromEncodedURIComponent(
+        packed.replace('+', ' ')) == 'ichc4j}]'
+    assert ''.join(CODEC.iterDecompressFromEncodedURIComponent(
+        packed.replace('+', ' '))) == 'ichc4j}]'
+
+
+def test_invalid_characters():
+    with pytest.raises(KeyError):
+        CODEC.decompressFromEncodedURIComponent('BYUw!mD2Q')
+    with pytest.raises(lzstring.LZStringError):
+        list(CODEC.iterDecompressFromEncodedURIComponent('BYUw!mD2Q'))
+    with pytest.raises(lzstring.LZStringError):
+        list(CODEC.iterDecompressFromEncodedURIComponent(['BYUw', 'm/2Q']))
+
+
+def test_invalid_streams():
+    # the first code of a stream is a character width, 0 or 1, or the end
+    assert CODEC.decompressFromEncodedURIComponent('w') is None
+    with pytest.raises(lzstring.LZStringError):
+        list(CODEC.iterDecompressFromEncodedURIComponent('w'))
+    # cut short, before the end marker
+    packed = CODEC.compressToEncodedURIComponent('hello, world')
+    assert CODEC.decompressFromEncodedURIComponent(packed[:4]) == ''
+    with pytest.raises(lzstring.LZStringError):
+        list(CODEC.iterDecompressFromEncodedURIComponent(packed[:4]))
+
+
+def test_iter_decompress_in_pieces():
+    text = texts()[-1]
+    packed = CODEC.compressToEncodedURIComponent(text)
+    # any split of the input decodes the same
+    pieces = [packed[i:i + 7] for i in range(0, len(packed), 7)]
+    output = list(CODEC.iterDecompressFromEncodedURIComponent(iter(pieces)))
+    assert len(output) > 1
+    assert ''.join(output) == text
+
+
+def test_max_length():
+    text = 'ab' * 50000
+    packed = CODEC.compressToEncodedURIComponent(text)
+    assert ''.join(CODEC.iterDecompressFromEncodedURIComponent(
+        packed, maxLength=len(text))) == text
+    with pytest.raises(lzstring.LimitExceeded):
+        list(CODEC.iterDecompressFromEncodedURIComponent(
+            packed, maxLength=len(text) - 1))
+    # a short output is checked at the end marker
+    with pytest.raises(lzstring.LimitExceeded):
+        list(CODEC.iterDecompressFromEncodedURIComponent(
+            CODEC.compressToEncodedURIComponent('hello'), maxLength=4))
+
+
+def test_max_length_stops_early():
+    # a few kilobytes that would expand to gigabytes
+    packed = CODEC.compressToEncodedURIComponent('a' * 10 ** 6)
+    consumed = []
+
+    def pieces():
+        for i in range(0, len(packed), 10):
+            consumed.append(i)
+            yield packed[i:i + 10]
+        for _ in range(10 ** 6):
+            consumed.append(None)
+            yield packed[-10:]
+    with pytest.raises(lzstring.LimitExceeded):
+        list(CODEC.iterDecompressFromEncodedURIComponent(
+            pieces(), maxLength=10 ** 4))
+    # given up on within the real stream, long before the padding
+    assert None not in consumed
+
+
+def test_max_dictionary_size():
+    text = ''.join(chr(32 + i % 95) + chr(32 + i // 95 % 95)
+                   for i in range(3000))
+    packed = CODEC.compressToEncodedURIComponent(text)
+    with pytest.raises(lzstring.LimitExceeded):
+        list(CODEC.iterDecompressFromEncodedURIComponent(
+            packed, maxDictionarySize=1000))
+    assert ''.join(CODEC.iterDecompressFromEncodedURIComponent(
+        packed, maxDictionarySize=10 ** 5)) == text
+    assert issubclass(lzstring.LimitExceeded, lzstring.LZStringError)
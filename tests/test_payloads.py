@@ -0,0 +1,180 @@
+import gzip
+import io
+import json
+import zlib
+
+import pytest
+
+import lzstring
+import payloads
+
+FEATURES = json.dumps({'type': 'FeatureCollection', 'features': [
+    {'type': 'Feature', 'properties': {'fid': i},
+     'geometry': {'type': 'Point', 'coordinates': [-98.5 + i / 1e3, 38.5]}}
+    for i in range(200)]})
+
+
+class Stream(io.BytesIO):
+    """A request body that records how much of it was read."""
+
+    def __init__(self, data):
+        io.BytesIO.__init__(self, data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = io.BytesIO.read(self, size)
+        self.bytes_read += len(data)
+        return data
+
+
+def gzipped(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def raw_deflated(data):
+    deflater = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return deflater.compress(data) + deflater.flush()
+
+
+def bomb(size=16 * 1024 * 1024):
+    """Returns a JSON-looking body that inflates to size bytes."""
+    return b'[' + b' ' * (size - 1)
+
+
+@pytest.mark.parametrize('encoding,encode', [
+    (None, lambda b: b),
+    ('gzip', gzipped),
+    ('deflate', zlib.compress),
+    ('deflate', raw_deflated),
+])
+def test_read_body(encoding, encode):
+    body = encode(FEATURES.encode('utf-8'))
+    assert payloads.read_body(Stream(body), encoding, len(body),
+                              max_bytes=len(body),
+                              max_decoded_bytes=len(FEATURES)) == FEATURES
+
+
+def test_read_lzstring_body():
+    body = lzstring.LZString.compressToEncodedURIComponent(FEATURES)
+    body = body.encode('ascii') + b'\r\n'
+    assert payloads.read_body(Stream(body)) == FEATURES
+    assert payloads.read_body(Stream(gzipped(body)), 'gzip') == FEATURES
+
+
+def test_oversized_body():
+    body = FEATURES.encode('utf-8')
+    # said to be too large: nothing is read
+    stream = Stream(body)
+    with pytest.raises(payloads.PayloadTooLarge):
+        payloads.read_body(stream, content_length=str(len(body)),
+                           max_bytes=len(body) - 1)
+    assert stream.bytes_read == 0
+    # found to be, without a Content-Length
+    stream = Stream(body * 100)
+    with pytest.raises(payloads.PayloadTooLarge):
+        payloads.read_body(stream, max_bytes=len(body))
+    assert stream.bytes_read <= len(body) + payloads.CHUNK_SIZE
+
+
+@pytest.mark.parametrize('encoding,encode', [
+    ('gzip', gzipped),
+    ('deflate', zlib.compress),
+    ('deflate', raw_deflated),
+])
+def test_compression_bombs(encoding, encode):
+    body = encode(bomb())
+    assert len(body) < 256 * 1024
+    with pytest.raises(payloads.PayloadTooLarge):
+        payloads.read_body(Stream(body), encoding, len(body),
+                           max_bytes=len(body),
+                           max_decoded_bytes=1024 * 1024)
+
+
+def test_deflate_query_bomb():
+    packed = payloads.base64.urlsafe_b64encode(zlib.compress(bomb()))
+    with pytest.raises(payloads.PayloadTooLarge):
+        payloads.decode_query_features(packed.decode('ascii'), 'deflate',
+                                       max_decoded_bytes=1024 * 1024)
+    packed = payloads.base64.urlsafe_b64encode(
+        zlib.compress(FEATURES.encode('utf-8')))
+    assert payloads.decode_query_features(
+        packed.decode('ascii').rstrip('='), 'deflate') == FEATURES
+
+
+def test_lzstring_limits():
+    packed = lzstring.LZString.compressToEncodedURIComponent(FEATURES)
+    assert payloads.decode_query_features(packed) == FEATURES
+    with pytest.raises(payloads.PayloadTooLarge):
+        payloads.decode_query_features(packed,
+                                       max_decoded_bytes=len(FEATURES) - 1)
+    with pytest.raises(payloads.PayloadTooLarge):
+        payloads.decode_query_features(packed, max_dictionary_size=100)
+    with pytest.raises(payloads.PayloadTooLarge):
+        payloads.read_body(Stream(packed.encode('ascii')),
+                           max_dictionary_size=100)
+    # a couple of kilobytes that expand to a megabyte
+    packed = lzstring.LZString.compressToEncodedURIComponent(
+        '[' + ' ' * (1024 * 1024))
+    assert len(packed) < 4096
+    with pytest.raises(payloads.PayloadTooLarge):
+        payloads.decode_query_features(packed, max_decoded_bytes=64 * 1024)
+
+
+@pytest.mark.parametrize('value,encoding', [
+    ('not lzstring!', None),
+    (lzstring.LZString.compressToEncodedURIComponent('not json'), None),
+    ('%%%', 'deflate'),
+    ('abc', 'brotli'),
+    ('', 'lzstring'),
+])
+def test_bad_query_features(value, encoding):
+    with pytest.raises(payloads.PayloadError):
+        payloads.decode_query_features(value, encoding)
+
+
+@pytest.mark.parametrize('body,encoding', [
+    (b'', None),
+    (b'  \r\n', None),
+    (b'\xff\xfe', None),
+    (b'{"\xff": 1}', None),
+    (b'not gzip', 'gzip'),
+    (b'{}', 'br'),
+])
+def test_bad_bodies(body, encoding):
+    with pytest.raises(payloads.PayloadError):
+        payloads.read_body(Stream(body), encoding)
+
+
+@pytest.fixture(scope='module')
+def app():
+    """The app, on the fake EE backend; it needs the App Engine libraries."""
+    pytest.importorskip('webapp2')
+    import os
+    os.environ.setdefault('EE_BACKEND', 'fake')
+    import server
+    return server
+
+
+def test_extract_answers_413(app):
+    import webob
+    body = gzipped(bomb(app.MAX_EXTRACT_DECODED_BYTES + 1))
+    for headers in ({'Content-Length': str(app.MAX_EXTRACT_BODY_BYTES + 1)},
+                    {'Content-Encoding': 'gzip'}):
+        request = webob.Request.blank(
+            '/extract?assetId=%s' % app.HISTORICAL_IMAGE_COLLECTION_ID,
+            method='POST', body=body, headers=headers)
+        if 'Content-Length' in headers:
+            request.headers.update(headers)
+        assert request.get_response(app.app).status_int == 413
+
+
+def test_extract_answers_400(app):
+    import webob
+    for body in (b'{"type": "FeatureCollection", "features": [', b'\xff'):
+        request = webob.Request.blank(
+            '/extract?assetId=%s' % app.HISTORICAL_IMAGE_COLLECTION_ID,
+            method='POST', body=body)
+        assert request.get_response(app.app).status_int == 400
@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+import pyramid
+import rasters
+import zonal
+from conftest import DEGENERATE, DRY, POLYGONS, WET, assert_close, feature
+
+NAMES = ['mean', 'sum', 'count']
+
+
+@pytest.fixture(scope='module')
+def engines(data_dir):
+    for asset_id in (WET, DRY):
+        path = os.path.join(data_dir, *asset_id.split('/'))
+        # cells of 4 x 4 pixels, so polygons span several levels
+        pyramid.build(rasters.load(rasters.find(data_dir, asset_id)),
+                      path + pyramid.EXTENSION, base_level=2)
+    return pyramid.Pyramids(data_dir), zonal.ZonalEngine(data_dir)
+
+
+@pytest.mark.parametrize('asset_id', [WET, DRY])
+@pytest.mark.parametrize('geom', DEGENERATE + POLYGONS)
+def test_polygons_match_zonal(engines, asset_id, geom):
+    pyramids, dense = engines
+    [extracted] = pyramids.extract(asset_id, [feature(geom)], NAMES)
+    expected = dense.reduce(asset_id, geom, NAMES)
+    for name in NAMES:
+        assert_close(extracted['properties'][name], expected[name])
+
+
+@pytest.mark.parametrize('tolerance', [0.1, 1, 5, 30])
+@pytest.mark.parametrize('geom', POLYGONS)
+def test_means_are_within_tolerance(engines, tolerance, geom):
+    pyramids, dense = engines
+    exact = dense.reduce(WET, geom, ['mean'])['mean']
+    total, count, error = pyramids.pyramid(WET).reduce(geom, tolerance)
+    assert 0 <= error <= tolerance
+    if count:
+        assert abs(total / count - exact) <= error + 1e-9
+    else:
+        assert exact is None or error > 0
+
+
+def test_value_range(engines):
+    pyramids, _ = engines
+    assert pyramids.pyramid(WET).value_range[0] == 0
+    assert pyramids.pyramid(WET).value_range[1] > 0
+    assert pyramids.pyramid(DRY).value_range == (0, 0)
+    # every mean of an all-dry raster is exact, whatever the tolerance
+    for geom in POLYGONS:
+        assert pyramids.pyramid(DRY).reduce(geom, 100)[2] == 0
+
+
+def test_answers():
+    polygons = [feature(g) for g in POLYGONS]
+    point = feature({'type': 'Point', 'coordinates': [-99.8, 39.8]})
+    assert pyramid.Pyramids.answers(polygons, NAMES)
+    assert not pyramid.Pyramids.answers(polygons + [point], NAMES)
+    assert not pyramid.Pyramids.answers(polygons, ['histogram'])
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+
+import rasters
+import zonal
+from conftest import WET
+
+
+@pytest.mark.parametrize('asset_id', [
+    '../outside', 'test/../../outside', '/outside', 'test//wet', 'test/./wet',
+    '', 'test/wet\0',
+])
+def test_ids_outside_the_data_dir_are_not_found(data_dir, asset_id):
+    outside = os.path.join(os.path.dirname(data_dir), 'outside.npy')
+    open(outside, 'wb').close()
+    assert rasters.asset_path(data_dir, asset_id) is None
+    assert rasters.find(data_dir, asset_id) is None
+    assert not zonal.ZonalEngine(data_dir).has(asset_id)
+
+
+def test_found_ids(data_dir):
+    assert rasters.find(data_dir, WET) == os.path.join(
+        data_dir, 'test', 'wet.npy')
+
+
+def test_local_copies_remember_only_some_misses():
+    loads = []
+
+    def load(asset_id):
+        loads.append(asset_id)
+        return asset_id.upper() if asset_id.startswith('a') else None
+
+    copies = rasters.LocalCopies(load, max_missing=2)
+    assert copies.get('a') == copies.get('a') == 'A'
+    for asset_id in ('x', 'y', 'y', 'z', 'x'):
+        assert copies.get(asset_id) is None
+    # 'x' was forgotten once 'z' had pushed it out
+    assert loads == ['a', 'x', 'y', 'z', 'x']
+    assert len(copies._missing) == 2
@@ -0,0 +1,49 @@
+import struct
+import zlib
+
+import numpy as np
+
+import render
+from conftest import WET
+
+OPTIONS = {'min': 0, 'max': 30, 'palette': '0000ff, 00ff00', 'opacity': 0.5}
+
+
+def chunks(png):
+    """Returns {kind: data} of a PNG's chunks."""
+    assert png.startswith(b'\x89PNG\r\n\x1a\n')
+    found, at = {}, 8
+    while at < len(png):
+        length, = struct.unpack('>I', png[at:at + 4])
+        kind, data = png[at + 4:at + 8], png[at + 8:at + 8 + length]
+        crc, = struct.unpack('>I', png[at + 8 + length:at + 12 + length])
+        assert crc == zlib.crc32(kind + data) & 0xffffffff
+        found[kind] = data
+        at += 12 + length
+    return found
+
+
+def test_encode_png():
+    indices = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    colors, alphas = render.color_table(OPTIONS)
+    found = chunks(render.encode_png(indices, colors, alphas))
+    assert struct.unpack('>IIBBBBB', found[b'IHDR']) == (4, 3, 8, 3, 0, 0, 0)
+    assert found[b'PLTE'] == colors.tobytes()
+    assert found[b'tRNS'] == alphas.tobytes()
+    rows = np.frombuffer(zlib.decompress(found[b'IDAT']), dtype=np.uint8)
+    rows = rows.reshape(3, 5)
+    assert (rows[:, 0] == 0).all()
+    assert (rows[:, 1:] == indices).all()
+
+
+def test_tiles(data_dir):
+    renderer = render.TileRenderer(data_dir, {'wet': (WET, OPTIONS)}, 1)
+    # the tile the raster is in at zoom 10, and one far from it
+    x, y = int((180 - 99.7) / 360 * 2 ** 10), 388
+    indices = renderer.render('wet', 10, x, y)
+    assert indices.shape == (render.TILE_SIZE, render.TILE_SIZE)
+    assert indices.any()
+    assert not renderer.render('wet', 10, 0, 0).any()
+    assert renderer.tile('wet', 10, x, y).startswith(b'\x89PNG')
+    assert renderer.tile('wet', 10, 2 ** 10, 0) is None
+    assert renderer.tile('dry', 10, x, y) is None
@@ -0,0 +1,80 @@
+import json
+import os
+
+import pytest
+
+webapp2 = pytest.importorskip('webapp2')
+os.environ.setdefault('EE_BACKEND', 'fake')
+
+import metrics  # noqa: E402
+import server  # noqa: E402
+import webob  # noqa: E402
+
+
+def count(name):
+    return (metrics.REGISTRY.snapshot().get(name) or {}).get('count', 0)
+
+
+def extract(fmt):
+    features = json.dumps({'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {},
+         'geometry': {'type': 'Point', 'coordinates': [-98.5 + i / 1e2, 38.5]}}
+        for i in range(5)]})
+    return webob.Request.blank(
+        '/extract?format=%s&encoding=json&assetId=%s&features=%s' % (
+            fmt, server.HISTORICAL_IMAGE_COLLECTION_ID,
+            webob.compat.url_quote(features)))
+
+
+def test_streamed_stages_are_recorded():
+    server.EXTRACTION_CACHE.clear()
+    before = count('extract.ee'), count('extract.total')
+    response = extract('ndjson').get_response(server.app)
+    assert response.status_int == 200
+    assert 'total' in response.headers['Server-Timing']
+    lines = response.body.decode('utf-8').splitlines()
+    assert len(lines) == 5
+    assert (count('extract.ee'), count('extract.total')) == (
+        before[0] + 1, before[1] + 1)
+
+
+def test_stages_are_recorded_once():
+    server.EXTRACTION_CACHE.clear()
+    before = count('extract.total')
+    response = extract('json').get_response(server.app)
+    assert response.status_int == 200
+    assert 'ee;dur=' in response.headers['Server-Timing']
+    assert count('extract.total') == before + 1
+
+
+@pytest.mark.parametrize('features, encoding', [
+    ('{bad', 'json'),
+    ('[1,2]', 'json'),
+    ('{}', 'json'),
+    ('{"type": "FeatureCollection"}', 'json'),
+    ('{"type": "FeatureCollection", "features": [1]}', 'json'),
+    ('{"type": "FeatureCollection", "features": [{"geometry": 1}]}', 'json'),
+    ('{bad', 'lzstring'),
+    ('not-a-string!', None),
+])
+def test_malformed_query_features_answer_400(features, encoding):
+    url = '/extract?assetId=%s&features=%s' % (
+        server.HISTORICAL_IMAGE_COLLECTION_ID,
+        webob.compat.url_quote(features))
+    if encoding:
+        url += '&encoding=' + encoding
+    response = webob.Request.blank(url).get_response(server.app)
+    assert response.status_int == 400
+
+
+@pytest.mark.parametrize('body', [
+    b'{bad', b'{}', b'[1,2]', b'"text"', b'{"type": "FeatureCollection"}',
+    b'{"type": "FeatureCollection", "features": {}}',
+])
+def test_malformed_body_features_answer_400(body):
+    request = webob.Request.blank(
+        '/extract?assetId=%s' % server.HISTORICAL_IMAGE_COLLECTION_ID,
+        method='POST', body=body)
+    request.content_type = 'application/json'
+    response = request.get_response(server.app)
+    assert response.status_int == 400
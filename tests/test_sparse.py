@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+
+import rasters
+import sparse
+import zonal
+from conftest import (DEGENERATE, DRY, POLYGONS, TRANSFORM, WET, assert_close,
+                      feature, synthetic_wetness)
+
+NAMES = ['mean', 'sum', 'count']
+
+
+@pytest.fixture(scope='module')
+def engines(data_dir):
+    for asset_id in (WET, DRY):
+        base = os.path.join(data_dir, *asset_id.split('/'))
+        sparse.build(base + '.npy', base + sparse.EXTENSION)
+    return sparse.SparseRasters(data_dir), zonal.ZonalEngine(data_dir)
+
+
+@pytest.mark.parametrize('asset_id', [WET, DRY])
+@pytest.mark.parametrize('geom', DEGENERATE + POLYGONS)
+def test_polygons_match_zonal(engines, asset_id, geom):
+    runs, dense = engines
+    [extracted] = runs.extract(asset_id, [feature(geom)], NAMES)
+    expected = dense.reduce(asset_id, geom, NAMES)
+    for name in NAMES:
+        assert_close(extracted['properties'][name], expected[name])
+
+
+def test_degenerate_polygons_are_empty(engines):
+    runs, _ = engines
+    extracted = runs.extract(WET, [feature(g) for g in DEGENERATE], NAMES)
+    for ft in extracted:
+        assert ft['properties'] == {'mean': None, 'sum': 0.0, 'count': 0}
+
+
+def test_points_match_zonal(engines):
+    runs, dense = engines
+    x = np.linspace(-100.2, -99.2, 37)
+    y = np.linspace(39.4, 40.1, 37)
+    points = [feature({'type': 'Point', 'coordinates': [a, b]})
+              for a in x for b in y]
+    names = ['mean', 'count']
+    extracted = runs.extract(WET, points, names)
+    for ft in extracted:
+        expected = dense.reduce(WET, ft['geometry'], names)
+        for name in names:
+            assert_close(ft['properties'][name], expected[name])
+
+
+def test_union_of_no_intervals():
+    begin, end = sparse._union(np.array([], dtype=np.int64),
+                               np.array([], dtype=np.int64))
+    assert len(begin) == len(end) == 0
+
+
+def test_nan_background(tmpdir):
+    data = synthetic_wetness()
+    data[data == 0] = np.nan
+    rasters.save(str(tmpdir.join('wet.npy')), rasters.Raster(data, TRANSFORM))
+    path = str(tmpdir.join('wet' + sparse.EXTENSION))
+    sparse.build(str(tmpdir.join('wet.npy')), path, background=float('nan'))
+    raster = sparse.SparseRaster(path)
+    dense = zonal.ZonalEngine(str(tmpdir))
+    for geom in DEGENERATE + POLYGONS:
+        total, count = raster.reduce(geom)
+        expected = dense.reduce('wet', geom, ['sum', 'count'])
+        assert count == expected['count']
+        assert_close(total, expected['sum'])
+
+
+def test_refuses_copies_bigger_than_dense(tmpdir):
+    rng = np.random.RandomState(0)
+    data = np.where(rng.rand(70, 90) < 0.3, 1, 0).astype(np.float32)
+    source = str(tmpdir.join('speckled.npy'))
+    rasters.save(source, rasters.Raster(data, TRANSFORM))
+    path = str(tmpdir.join('speckled' + sparse.EXTENSION))
+    with pytest.raises(ValueError):
+        sparse.build(source, path)
+    assert sparse.find(str(tmpdir), 'speckled') is None
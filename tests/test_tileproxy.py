@@ -0,0 +1,105 @@
+import os
+import stat
+
+import pytest
+
+import tileproxy
+
+
+def key(n):
+    return tileproxy.TileCache.key('a', 1, {}, 10, n, 0)
+
+
+def test_memory_only():
+    tiles = tileproxy.TileCache(100)
+    assert tiles.directory is None
+    tiles.set(key(1), b'x' * 60)
+    assert tiles.get(key(1)) == b'x' * 60
+    # evicted to stay within 100 bytes
+    tiles.set(key(2), b'y' * 60)
+    assert tiles.get(key(1)) is None
+    assert tiles.get(key(2)) == b'y' * 60
+
+
+def test_disk(tmpdir):
+    directory = str(tmpdir.join('tiles'))
+    tiles = tileproxy.TileCache(100, directory, max_disk_bytes=150)
+    assert tiles.directory == directory
+    for n in range(3):
+        tiles.set(key(n), b'%d' % n * 60)
+    tiles.clear()
+    # the oldest was evicted from disk to stay within 150 bytes
+    assert tiles.get(key(0)) is None
+    assert tiles.get(key(1)) == b'1' * 60
+    # tiles on disk are found again by a new cache
+    tiles = tileproxy.TileCache(100, directory, max_disk_bytes=150)
+    assert tiles.get(key(2)) == b'2' * 60
+    assert os.listdir(directory) != []
+
+
+@pytest.mark.skipif(not hasattr(os, 'geteuid') or os.geteuid() == 0,
+                    reason='root can write to read-only directories')
+def test_read_only_disk_is_not_used(tmpdir):
+    directory = tmpdir.join('tiles')
+    directory.mkdir()
+    os.chmod(str(directory), stat.S_IRUSR | stat.S_IXUSR)
+    try:
+        tiles = tileproxy.TileCache(100, str(directory))
+        assert tiles.directory is None
+        tiles.set(key(1), b'x')
+        assert tiles.get(key(1)) == b'x'
+    finally:
+        os.chmod(str(directory), stat.S_IRWXU)
+
+
+def test_unmakeable_disk_is_not_used(tmpdir):
+    # a directory can't be made inside a file
+    blocker = tmpdir.join('file')
+    blocker.write('')
+    tiles = tileproxy.TileCache(100, str(blocker.join('tiles')))
+    assert tiles.directory is None
+
+
+@pytest.fixture
+def server():
+    """An HTTP/1.1 server on a free port that answers every GET with its
+    path, and records the client port of each request."""
+    try:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    import threading
+
+    ports = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            ports.append(self.client_address[1])
+            body = self.path.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d/base' % httpd.server_address[1], ports
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.mark.parametrize('size,connections', [(2, 1), (0, 3)])
+def test_pool(server, size, connections):
+    url, ports = server
+    pool = tileproxy.ConnectionPool(url, size=size)
+    for n in range(3):
+        assert pool.get('/%d' % n) == (200, b'/base/%d' % n)
+    pool.close()
+    assert len(set(ports)) == connections
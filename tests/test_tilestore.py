@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import pytest
+
+import tilestore
+import zonal
+from conftest import DRY, NODATA, SHAPE, WET, assert_close, feature
+
+NAMES = ['mean', 'count', 'histogram']
+
+
+@pytest.fixture(scope='module')
+def engines(data_dir):
+    for asset_id in (WET, DRY):
+        base = os.path.join(data_dir, *asset_id.split('/'))
+        # blocks smaller than the raster, which doesn't fill the last ones
+        tilestore.import_raster(base + '.npy', base + tilestore.EXTENSION,
+                                block_size=16)
+    return tilestore.TileStores(data_dir), zonal.ZonalEngine(data_dir)
+
+
+def points():
+    # a grid running off every side of the raster
+    x = np.linspace(-100.05, -99.25, 41)
+    y = np.linspace(39.45, 40.05, 41)
+    return [feature({'type': 'Point', 'coordinates': [a, b]})
+            for a in x for b in y]
+
+
+@pytest.mark.parametrize('asset_id', [WET, DRY])
+def test_points_match_zonal(engines, asset_id):
+    stores, dense = engines
+    extracted = stores.extract(asset_id, points(), NAMES)
+    for ft in extracted:
+        expected = dense.reduce(asset_id, ft['geometry'], NAMES)
+        for name in ('mean', 'count'):
+            assert_close(ft['properties'][name], expected[name])
+        assert ft['properties']['histogram'] == expected['histogram']
+
+
+def test_sample(engines, data_dir):
+    stores, _ = engines
+    store = stores.store(WET)
+    assert store.shape == SHAPE
+    data = np.load(os.path.join(data_dir, 'test', 'wet.npy'))
+    rows, cols = np.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+    x, y = store.centers(rows.ravel(), cols.ravel())
+    values, valid = store.sample(x, y)
+    expected = data.ravel()
+    assert (valid == (~np.isnan(expected) & (expected != NODATA))).all()
+    assert (values[valid] == expected[valid]).all()
+    # outside the raster
+    values, valid = store.sample(np.array([-101.0, -99.0]),
+                                 np.array([39.7, 39.7]))
+    assert not valid.any()
+
+
+def test_missing_store(engines):
+    stores, _ = engines
+    assert stores.has(WET)
+    assert not stores.has('test/missing')
@@ -0,0 +1,29 @@
+import threading
+
+import workers
+
+
+def test_deadline_leaves_slow_calls_in_the_background():
+    release = threading.Event()
+    outcomes = workers.map_with_deadline(
+        lambda n: release.wait(5) and n, [1, 2], deadline=0.05,
+        background=True)
+    assert not any(outcome.done for outcome in outcomes)
+    release.set()
+    assert [outcome.wait(5) and outcome.result() for outcome in outcomes] == \
+        [1, 2]
+
+
+def test_without_background_threads_every_call_is_waited_for():
+    outcomes = workers.map_with_deadline(
+        lambda n: threading.Event().wait(0.1) or n, [1, 2], deadline=0.01,
+        background=False)
+    assert [outcome.done for outcome in outcomes] == [True, True]
+    assert [outcome.result() for outcome in outcomes] == [1, 2]
+
+
+def test_errors_are_kept():
+    def fail(n):
+        raise ValueError(n)
+    [outcome] = workers.map_with_deadline(fail, [1])
+    assert outcome.done and isinstance(outcome.error, ValueError)
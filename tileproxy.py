@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""Earth Engine map tiles, fetched over kept-alive connections and cached.
+
+By default the client fetches every map tile from EE itself, with a map ID
+and token from the page, so each pan and zoom waits on EE and nothing is
+shared between users. With PROXY_EE_TILES set, /tiles/<layer>/<z>/<x>/<y>
+(see TileHandler in server.py) fetches them for it instead. Every tile then
+costs a request to the app, so this only pays where many users view the
+same tiles, so that most are served from the cache, or EE is slower to
+reach from browsers than from the app.
+
+ConnectionPool keeps a few HTTP(S) connections to EE's tile server open
+between requests, so a tile costs one round trip rather than a TCP and TLS
+handshake as well. A connection that turns out to have been closed while
+idle is replaced and the request retried once. On App Engine's python27
+runtime httplib is URL Fetch underneath, which keeps no connection open,
+so there the pool has no room and every tile gets a connection of its own.
+
+TileCache holds tiles in a process-local LRU and, given a directory it can
+write to, on disk too, each bounded in bytes. App Engine's file system is
+read-only, so there tiles are only cached in memory. Tiles are keyed by
+their asset's version and visualization rather than by map ID: map IDs are
+re-minted every few hours (see cache.MapIdCache) but the pixels only change
+when the asset does, so cached tiles stay good until it is re-uploaded.
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+
+try:
+    import httplib
+    from urlparse import urlparse
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlparse
+
+import cache
+
+# Names of cached tiles, and of tiles part way through being written.
+_KEY = re.compile(r'^[0-9a-f]{40}$')
+_PARTIAL = re.compile(r'^[0-9a-f]{40}\.\d+\.\d+$')
+
+
+class UpstreamError(Exception):
+    """A tile couldn't be fetched from upstream."""
+
+
+class ConnectionPool(object):
+    """Keeps up to `size` idle keep-alive connections to one server; with
+    a size of 0, every request has a connection of its own."""
+
+    def __init__(self, url, size=8, timeout=10):
+        parsed = urlparse(url)
+        self.secure = parsed.scheme == 'https'
+        self.host = parsed.netloc
+        self.prefix = parsed.path.rstrip('/')
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Returns (status, body) of a GET of path on the server."""
+        connection, reused = self._take()
+        while True:
+            try:
+                return self._get(connection, path)
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                if not reused:
+                    raise UpstreamError('GET %s failed: %s' % (path, e))
+            # the server may have closed an idle connection; try a new one
+            connection, reused = self._connect(), False
+
+    def close(self):
+        """Closes every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def _get(self, connection, path):
+        connection.request('GET', self.prefix + path,
+                           headers={'Connection': 'keep-alive'})
+        response = connection.getresponse()
+        body = response.read()
+        if response.will_close:
+            connection.close()
+        else:
+            self._give(connection)
+        return response.status, body
+
+    def _take(self):
+        """Returns (connection, whether it has been used before)."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._connect(), False
+
+    def _give(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def _connect(self):
+        kind = httplib.HTTPSConnection if self.secure else \
+            httplib.HTTPConnection
+        return kind(self.host, timeout=self.timeout)
+
+
+class TileCache(object):
+    """Tiles in memory, up to max_memory_bytes, and on disk in directory,
+    if given and writable, up to max_disk_bytes."""
+
+    def __init__(self, max_memory_bytes, directory=None,
+                 max_disk_bytes=256 * 1024 * 1024):
+        self._memory = cache.LRUCache(max_memory_bytes, weigher=len)
+        self.directory = directory if directory and _writable(directory) \
+            else None
+        self.max_disk_bytes = max_disk_bytes
+        # bytes of each tile on disk, least recently used first
+        self._disk = collections.OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        if self.directory:
+            self._scan()
+
+    @staticmethod
+    def key(asset_id, version, options, z, x, y):
+        """Returns the key of a tile of an asset's version, as visualized
+        with options."""
+        blob = json.dumps([asset_id, version, options, z, x, y],
+                          sort_keys=True)
+        return hashlib.sha1(blob.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns a cached tile's bytes, or None."""
+        tile = self._memory.get(key)
+        if tile is not None or not self.directory:
+            return tile
+        with self._lock:
+            if key not in self._disk:
+                return None
+            # re-insert to mark the tile as most recently used
+            self._disk[key] = self._disk.pop(key)
+        try:
+            with open(self._path(key), 'rb') as f:
+                tile = f.read()
+        except IOError:
+            return None
+        self._memory.set(key, tile)
+        return tile
+
+    def set(self, key, tile):
+        """Caches a tile."""
+        self._memory.set(key, tile)
+        if not self.directory or len(tile) > self.max_disk_bytes:
+            return
+        path = self._path(key)
+        # written aside and renamed, so readers never see part of a tile
+        partial = '%s.%d.%d' % (path, os.getpid(),
+                                threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(partial, 'wb') as f:
+                f.write(tile)
+            os.rename(partial, path)
+        except (IOError, OSError):
+            logging.exception('Failed to cache tile %s on disk', key)
+            return
+        evicted = []
+        with self._lock:
+            self._disk_bytes -= self._disk.pop(key, 0)
+            self._disk[key] = len(tile)
+            self._disk_bytes += len(tile)
+            while self._disk_bytes > self.max_disk_bytes:
+                old, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                evicted.append(old)
+        for old in evicted:
+            _remove(self._path(old))
+
+    def clear(self):
+        """Forgets the tiles in memory; those on disk are kept."""
+        self._memory.clear()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _scan(self):
+        """Indexes the tiles already on disk, oldest first."""
+        found = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if _KEY.match(name):
+                    found.append((os.path.getmtime(path), name,
+                                  os.path.getsize(path)))
+                elif _PARTIAL.match(name):
+                    # left over from a write that didn't finish
+                    _remove(path)
+        for _, key, size in sorted(found):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+
+def content_type(tile):
+    """Returns the MIME type of a tile: EE serves PNGs, or JPEGs for tiles
+    without transparency."""
+    return 'image/png' if tile.startswith(b'\x89PNG') else 'image/jpeg'
+
+
+def _writable(directory):
+    """Returns whether files can be written in a directory, making it if
+    need be."""
+    probe = os.path.join(directory, '.probe.%d' % os.getpid())
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(probe, 'wb') as f:
+            f.write(b'')
+    except (IOError, OSError) as e:
+        logging.warning('Not caching tiles on disk in %s: %s', directory, e)
+        return False
+    _remove(probe)
+    return True
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""Local rasters stored in fixed-size blocks, for fast point queries.
+
+A tile store is a directory holding `blocks.bin`, the raster cut into
+square blocks of block_size x block_size pixels (edge blocks padded out)
+laid end to end in row-major block order, and `meta.json` with its shape,
+dtype, block size, geotransform and nodata value (see rasters.py for the
+conventions). Each block is contiguous on disk, so reading a pixel touches
+one block; blocks.bin is memory mapped, and blocks that have been read are
+kept in an LRU cache shared by every store in the process.
+
+Points are sampled in batches: they are sorted by the block they fall in,
+and each block is fetched once and indexed for all of its points at once.
+
+Stores live under a data directory at their asset's ID, e.g.
+<data dir>/users/kyletaylor/shared/LC8dynamicwater.tiles. To make one from
+a GeoTIFF (which needs rasterio or GDAL) or a .npy raster:
+
+    python tilestore.py LC8dynamicwater.tif <data dir> \\
+        users/kyletaylor/shared/LC8dynamicwater
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+import cache
+import rasters
+import zonal
+
+# Default block edge, in pixels. A 256 x 256 float32 block is 256 KiB.
+BLOCK_SIZE = 256
+
+# Extension of tile store directories.
+EXTENSION = '.tiles'
+
+
+class TileStore(rasters.Raster):
+    """A raster read a block at a time from a tile store directory.
+
+    Its data attribute is None; pixels are read with block(), read() and
+    sample().
+    """
+
+    def __init__(self, path, block_cache=None):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        super(TileStore, self).__init__(None, meta['transform'],
+                                        meta.get('nodata'))
+        self.path = path
+        self.block_size = meta['block_size']
+        self._shape = tuple(meta['shape'])
+        self.blocks = np.memmap(
+            os.path.join(path, 'blocks.bin'), dtype=meta['dtype'], mode='r',
+            shape=_block_shape(self._shape, self.block_size))
+        if block_cache is None:
+            block_cache = cache.LRUCache(64 * 1024 * 1024,
+                                         weigher=lambda b: b.nbytes)
+        self._block_cache = block_cache
+
+    @property
+    def shape(self):
+        return self._shape
+
+    def block(self, block_row, block_col):
+        """Returns a block's pixels, reading them if they aren't cached."""
+        key = (self.path, block_row, block_col)
+        pixels = self._block_cache.get(key)
+        if pixels is None:
+            pixels = np.array(self.blocks[block_row, block_col])
+            self._block_cache.set(key, pixels)
+        return pixels
+
+    def sample(self, x, y):
+        """Returns (values, valid) of the pixels containing points x, y.
+
+        values are floats; valid is False for points outside the raster
+        and for pixels that are nodata.
+        """
+        rows, cols = self.index(x, y)
+        inside = ((rows >= 0) & (rows < self._shape[0]) &
+                  (cols >= 0) & (cols < self._shape[1]))
+        values = np.zeros(len(rows), dtype=float)
+        valid = inside.copy()
+        if inside.any():
+            values[inside] = self.read(rows[inside], cols[inside])
+            valid[inside] = self.valid(values[inside])
+        return values, valid
+
+    def read(self, rows, cols):
+        """Returns the pixels at rows, cols (which must be in the raster) as
+        floats, reading each block they fall in once."""
+        size, per_row = self.block_size, self.blocks.shape[1]
+        values = np.empty(len(rows), dtype=float)
+        blocks = (rows // size) * per_row + cols // size
+        order = np.argsort(blocks, kind='mergesort')
+        rows, cols, blocks = rows[order], cols[order], blocks[order]
+        # each run of pixels in the same block is read with one lookup
+        bounds = [0] + (np.nonzero(np.diff(blocks))[0] + 1).tolist() + \
+            [len(blocks)]
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            pixels = self.block(*divmod(int(blocks[start]), per_row))
+            values[order[start:stop]] = pixels[rows[start:stop] % size,
+                                               cols[start:stop] % size]
+        return values
+
+
+class TileStores(object):
+    """Answers /extract point queries from the tile stores in a directory.
+
+    Every store shares one LRU cache of up to max_block_bytes of blocks.
+    """
+
+    def __init__(self, data_dir, max_block_bytes=64 * 1024 * 1024,
+                 histogram=(0, 1, 10), wet_threshold=None):
+        self.data_dir = data_dir
+        self.histogram = histogram
+        self.wet_threshold = wet_threshold
+        self._stores = rasters.LocalCopies(self._load)
+        self._blocks = cache.LRUCache(max_block_bytes,
+                                      weigher=lambda b: b.nbytes)
+
+    def has(self, asset_id):
+        """Returns whether an asset has a tile store."""
+        return self.store(asset_id) is not None
+
+    def store(self, asset_id):
+        """Returns an asset's TileStore, or None."""
+        return self._stores.get(asset_id)
+
+    def _load(self, asset_id):
+        path = find(self.data_dir, asset_id)
+        return path and TileStore(path, self._blocks)
+
+    def clear(self):
+        """Forgets every cached block."""
+        self._blocks.clear()
+
+    def extract(self, asset_id, features, names):
+        """Returns reduceRegions-like features for GeoJSON Point features."""
+        xy = np.array([ft['geometry']['coordinates'][:2] for ft in features],
+                      dtype=float).reshape(-1, 2)
+        values, valid = self.store(asset_id).sample(xy[:, 0], xy[:, 1])
+        stats = zonal.point_statistics(values, valid, names, self.histogram,
+                                       self.wet_threshold)
+        extracted = []
+        for i, (ft, reduced) in enumerate(zip(features, stats)):
+            properties = dict(ft.get('properties') or {})
+            properties.update(reduced)
+            extracted.append({'type': 'Feature', 'id': str(i),
+                              'geometry': ft.get('geometry'),
+                              'properties': properties})
+        return extracted
+
+
+def find(data_dir, asset_id):
+    """Returns the path of an asset's tile store, or None."""
+    base = rasters.asset_path(data_dir, asset_id)
+    path = base and base + EXTENSION
+    return path if path and os.path.exists(os.path.join(path, 'meta.json')) else None
+
+
+def write(path, shape, dtype, transform, nodata, read_rows,
+          block_size=BLOCK_SIZE):
+    """Writes a tile store from read_rows(start, stop), which returns the
+    raster's rows [start, stop) as a 2-D array. It is called a row of blocks
+    at a time, in order from the top."""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    blocks = np.memmap(os.path.join(path, 'blocks.bin'), dtype=dtype,
+                       mode='w+', shape=_block_shape(shape, block_size))
+    for block_row in range(blocks.shape[0]):
+        start = block_row * block_size
+        stop = min(start + block_size, shape[0])
+        rows = read_rows(start, stop)
+        for block_col in range(blocks.shape[1]):
+            left = block_col * block_size
+            right = min(left + block_size, shape[1])
+            blocks[block_row, block_col, :stop - start, :right - left] = \
+                rows[:, left:right]
+    blocks.flush()
+    del blocks
+    # the metadata is written last, so find() never sees a partial store
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'shape': list(shape), 'dtype': np.dtype(dtype).str,
+                   'block_size': block_size, 'transform': list(transform),
+                   'nodata': nodata}, f)
+
+
+def import_raster(source, path, block_size=BLOCK_SIZE):
+    """Writes a tile store from a GeoTIFF or .npy raster."""
+    shape, dtype, transform, nodata, read_rows = open_rows(source)
+    write(path, shape, dtype, transform, nodata, read_rows, block_size)
+
+
+def open_rows(source):
+    """Opens a GeoTIFF or .npy raster to be read a few rows at a time, so
+    that it never has to fit in memory.
+
+    Returns (shape, dtype, transform, nodata, read_rows), where
+    read_rows(start, stop) returns rows [start, stop) as a 2-D array.
+    """
+    if source.endswith('.npy'):
+        raster = rasters.load(source)
+        return (raster.shape, raster.data.dtype, raster.transform,
+                raster.nodata, lambda start, stop: raster.data[start:stop])
+    if rasters.rasterio is not None:
+        dataset = rasters.rasterio.open(source)
+        return ((dataset.height, dataset.width), dataset.dtypes[0],
+                dataset.transform.to_gdal(), dataset.nodata,
+                lambda start, stop: dataset.read(
+                    1, window=((start, stop), (0, dataset.width))))
+    if rasters.gdal is not None:
+        dataset = rasters.gdal.Open(source)
+        band = dataset.GetRasterBand(1)
+        width = dataset.RasterXSize
+        return ((dataset.RasterYSize, width),
+                band.ReadAsArray(0, 0, width, 1).dtype,
+                dataset.GetGeoTransform(), band.GetNoDataValue(),
+                lambda start, stop: band.ReadAsArray(
+                    0, start, width, stop - start))
+    raise ImportError('Reading GeoTIFFs needs rasterio or GDAL (osgeo.gdal); '
+                      'or convert %s to .npy' % source)
+
+
+def _block_shape(shape, block_size):
+    return (-(-shape[0] // block_size), -(-shape[1] // block_size),
+            block_size, block_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Makes a tile store from a GeoTIFF or .npy raster.')
+    parser.add_argument('source', help='GeoTIFF, or .npy with a .json sidecar')
+    parser.add_argument('data_dir', help='directory of tile stores')
+    parser.add_argument('asset_id', help='asset the raster is a copy of')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+    args = parser.parse_args()
+    path = os.path.join(args.data_dir, *args.asset_id.split('/')) + EXTENSION
+    import_raster(args.source, path, args.block_size)
+    print(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""A small bounded thread pool for fanning out Earth Engine calls.
+
+Threads on App Engine's automatically scaled python27 instances can't outlive
+the request that started them, so rather than keeping a long-lived pool this
+module starts at most `max_workers` threads per call. A process-wide
+semaphore bounds how many of them talk to Earth Engine at once across all
+concurrent requests. For the same reason, map_with_deadline() only leaves
+calls that miss its deadline running in the background off App Engine; on
+it, it waits for them.
+"""
+import os
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Upper bound on worker threads doing work at once in this process.
+MAX_THREADS = 8
+
+# Whether we're on App Engine (or its development server), where threads
+# end with their request.
+ON_APP_ENGINE = os.environ.get('SERVER_SOFTWARE', '').startswith(
+    ('Google App Engine', 'Development'))
+
+_SLOTS = threading.BoundedSemaphore(MAX_THREADS)
+
+
+class Outcome(object):
+    """The result of one call made by map_with_deadline."""
+
+    def __init__(self):
+        self.value = None
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Blocks until the call has finished; returns whether it has."""
+        self._done.wait(timeout)
+        return self.done
+
+    def result(self):
+        """Returns the call's value, re-raising anything it raised."""
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def retry(fn, attempts=3, backoff=0.5, retry_on=(Exception,)):
+    """Calls fn(), retrying with exponential backoff on retry_on exceptions."""
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except retry_on:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def map_with_deadline(fn, items, max_workers=4, deadline=None,
+                      background=None):
+    """Calls fn(item) for every item on at most max_workers threads.
+
+    Returns one Outcome per item, in item order, as soon as every call has
+    finished or `deadline` seconds have passed, whichever comes first. Calls
+    still running at the deadline keep going in the background and fill in
+    their Outcome when they finish.
+
+    That needs threads that can outlive the request, so with background
+    false (the default on App Engine) the deadline is ignored and every
+    call is waited for.
+    """
+    if background is None:
+        background = not ON_APP_ENGINE
+    if not background:
+        deadline = None
+    items = list(items)
+    outcomes = [Outcome() for _ in items]
+    pending = list(range(len(items)))
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index = pending.pop(0)
+            outcome = outcomes[index]
+            with _SLOTS:
+                try:
+                    outcome.value = fn(items[index])
+                except Exception as e:
+                    outcome.error = e
+            outcome._done.set()
+
+    for _ in range(min(max_workers, len(items))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    stop_at = time.time() + deadline if deadline is not None else None
+    for outcome in outcomes:
+        if stop_at is None:
+            outcome.wait()
+        elif not outcome.wait(max(stop_at - time.time(), 0)):
+            break
+    return outcomes
+
+
+def imap_unordered(fn, items, max_workers=4, max_buffered=None):
+    """Yields (item, fn(item)) for every item, in the order calls finish.
+
+    At most max_buffered finished results wait for the caller to consume
+    them; beyond that, workers wait before starting on further items.
+    Anything a call raises is re-raised from the generator, and closing the
+    generator early stops the workers picking up more items.
+    """
+    items = list(items)
+    results = queue.Queue(maxsize=max_buffered or 0)
+    pending = list(range(len(items)))
+    lock = threading.Lock()
+    closed = threading.Event()
+
+    def work():
+        while not closed.is_set():
+            with lock:
+                if not pending:
+                    return
+                index = pending.pop(0)
+            with _SLOTS:
+                try:
+                    done = (index, fn(items[index]), None)
+                except Exception as e:
+                    done = (index, None, e)
+            while not closed.is_set():
+                try:
+                    results.put(done, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    for _ in range(min(max_workers, len(items))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for _ in range(len(items)):
+            index, value, error = results.get()
+            if error is not None:
+                raise error
+            yield items[index], value
+    finally:
+        closed.set()